@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+
+import collections
+import threading
+
+from rtree.utils import intersect_mask
+from rtree.utils import rect_bounds
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_INF = float('inf')
+
+
+class QueryCache(object):
+    """
+    A bounded LRU cache of range query results, keyed by query rectangle.
+
+    The query rectangles are kept as rows of one (capacity, 2N) array of
+    bounds, N being the dimension of the first query cached, so a change to
+    the tree invalidates exactly the cached queries whose rectangles intersect
+    the changed MBRs with a single vectorized comparison. Bounds of other
+    dimensions are compared over the axes both have, which can only
+    over-invalidate. Empty slots hold an inverted, infinite box, which never
+    intersects anything. The cache may be shared by reader threads, so every
+    operation holds a lock.
+    """
+
+    def __init__(self, capacity):
+        assert np is not None, "QueryCache requires numpy."
+        assert capacity > 0
+        self.capacity = capacity
+        self._results = collections.OrderedDict()
+        self._bounds = None
+        self._slot_keys = [None]*capacity
+        self._free = range(capacity - 1, -1, -1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key):
+        """ Returns the cached result for key, marking it most recently used, or
+        None.
+        """
+        with self._lock:
+            item = self._results.pop(key, None)
+            if item is None:
+                return None
+            self._results[key] = item
+            return item[1]
+
+    def put(self, key, query_rectangle, result):
+        """ Caches the result of the query on query_rectangle under key, evicting
+        the least recently used result if the cache is full.
+        """
+        with self._lock:
+            if key in self._results:
+                return
+            if not self._free:
+                _, (slot, _) = self._results.popitem(last = False)
+                self._release(slot)
+            bounds = np.array([query_rectangle.bounds], dtype = np.float64)
+            if self._bounds is None:
+                self._bounds = np.tile((_INF, -_INF), (self.capacity, bounds.shape[1]//2))
+            slot = self._free.pop()
+            self._bounds[slot] = _fit(bounds, self._bounds.shape[1])[0]
+            self._slot_keys[slot] = key
+            self._results[key] = (slot, result)
+
+    def invalidate(self, mbrs):
+        """ Drops the cached results of every query whose rectangle intersects,
+        or touches, any of mbrs. Returns how many were dropped.
+        """
+        with self._lock:
+            if not self._results or not mbrs:
+                return 0
+            mbrs = _fit(rect_bounds(mbrs), self._bounds.shape[1])
+            hits = intersect_mask(self._bounds, mbrs, closed = True).any(axis = 1)
+            slots = np.flatnonzero(hits).tolist()
+            for slot in slots:
+                del self._results[self._slot_keys[slot]]
+                self._release(slot)
+            return len(slots)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._bounds = None
+            self._slot_keys = [None]*self.capacity
+            self._free = range(self.capacity - 1, -1, -1)
+
+    def _release(self, slot):
+        self._bounds[slot, 0::2] = _INF
+        self._bounds[slot, 1::2] = -_INF
+        self._slot_keys[slot] = None
+        self._free.append(slot)
+
+
+def _fit(bounds, width):
+    """ Returns rows of bounds cut or widened to width columns. Added axes are
+    unbounded, so they never rule out an intersection.
+    """
+    if bounds.shape[1] >= width:
+        return bounds[:, :width]
+    pad = np.tile((-_INF, _INF), (len(bounds), (width - bounds.shape[1])//2))
+    return np.hstack([bounds, pad])
@@ -0,0 +1,253 @@
+from __future__ import absolute_import
+
+import itertools
+
+import numpy as np
+
+from rtree.rtree import PointerEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.types import Rectangle
+from rtree.utils import intersect_mask
+from rtree.utils import point_bounds
+from rtree.utils import rect_bounds
+
+
+class ColumnarRTree(object):
+    """
+    A frozen, query-only, array-backed copy of a packed R-tree. Every page
+    entry lives in contiguous typed arrays (left, right, bottom, top, mhv,
+    ref), and each page is a slice [page_start, page_start + page_count) of
+    them. For a leaf page ref holds obj_ids; for an inner page it holds child
+    page numbers. Pages are numbered in level order, so page 0 is the root.
+
+    It is not the storage of RTreeNode pages, which keep their entries as
+    objects: it has no insert, delete or update, and changes to the tree it
+    was built from don't reach it. Rebuild it with from_node after writes.
+    """
+
+    __slots__ = {'left', 'right', 'bottom', 'top', 'mhv', 'ref',
+                 'page_start', 'page_count', 'page_leaf', 'objs'}
+
+    def __init__(self, left, right, bottom, top, mhv, ref,
+                 page_start, page_count, page_leaf, objs = None):
+        self.left = left
+        self.right = right
+        self.bottom = bottom
+        self.top = top
+        self.mhv = mhv
+        self.ref = ref
+        self.page_start = page_start
+        self.page_count = page_count
+        self.page_leaf = page_leaf
+        self.objs = objs
+
+    @classmethod
+    def from_node(cls, root):
+        """ Flattens the RTreeNode tree rooted at root, in level order, flushing
+        its buffered inserts first. Only 2-d trees can be flattened.
+        """
+        dims = getattr(root.mbr, 'dims', 2)
+        if dims != 2:
+            raise ValueError("ColumnarRTree only holds 2-d trees, not %d-d ones." % dims)
+        root.flush()
+        columns = ([], [], [], [], [], [])
+        page_start, page_count, page_leaf = [], [], []
+        objs = []
+        pages = [root]
+        i = 0
+        while i < len(pages):
+            node = pages[i]
+            page_start.append(len(columns[0]))
+            page_count.append(len(node.page_entries))
+            page_leaf.append(node.is_leaf_node)
+            for entry in node.page_entries:
+                mbr = entry.mbr
+                if isinstance(entry, PointerEntry):
+                    ref = len(pages)
+                    pages.append(entry.child)
+                    objs.append(None)
+                else:
+                    ref = entry.obj_id
+                    objs.append(entry.obj)
+                for column, value in zip(columns, (mbr.left, mbr.right, mbr.bottom,
+                                                   mbr.top, entry.mhv, ref)):
+                    column.append(value)
+            i += 1
+        return cls._from_columns(columns, page_start, page_count, page_leaf, objs)
+
+    @classmethod
+    def bulk_load(cls, items, props = Properties(), fit_extent = False):
+        """ Packs (mbr, obj_id, obj) tuples directly into columnar pages, with the
+        same Hilbert ordering and page sizes as RTreeNode.bulk_load. The
+        rectangles must be 2-d.
+        """
+        items = list(items)
+        if not items:
+            return cls.from_node(RTreeNode(is_root = True, props = props))
+        if fit_extent:
+            props = props.with_extent(RTreeNode._extent([mbr for mbr, _, _ in items]))
+        bounds = rect_bounds([mbr for mbr, _, _ in items])
+        if bounds.shape[1] != 4:
+            raise ValueError("ColumnarRTree only holds 2-d trees, not %d-d ones." %
+                             (bounds.shape[1]//2))
+        keys = np.array(RTreeNode._hilbert_values([mbr for mbr, _, _ in items], props),
+                        dtype = np.uint64)
+        order = np.argsort(keys, kind = 'mergesort')
+        page_size = max(props['min_capacity'], 1,
+                        int(props['max_capacity']*props['fill_factor']))
+        assert page_size <= props['max_capacity']
+
+        # Pack bottom-up; each level is (bounds, mhv, ref, page sizes).
+        ids = np.array([obj_id for _, obj_id, _ in items], dtype = np.int64)
+        objs = [items[i][2] for i in order]
+        level = (bounds[order], keys[order], ids[order])
+        levels = []
+        while True:
+            sizes = RTreeNode._page_sizes(len(level[1]), page_size, props['min_capacity'])
+            levels.append(level + (sizes,))
+            if len(sizes) <= 1:
+                break
+            starts = np.cumsum([0] + sizes[:-1])
+            level_bounds = np.column_stack([np.minimum.reduceat(level[0][:, 0], starts),
+                                            np.maximum.reduceat(level[0][:, 1], starts),
+                                            np.minimum.reduceat(level[0][:, 2], starts),
+                                            np.maximum.reduceat(level[0][:, 3], starts)])
+            level = (level_bounds, np.maximum.reduceat(level[1], starts),
+                     np.arange(len(sizes), dtype = np.int64))
+        levels.reverse()
+
+        # Renumber child references from per-level to global page numbers.
+        page_offset = 0
+        refs = []
+        for depth, (_, _, ref, sizes) in enumerate(levels):
+            page_offset += len(sizes)
+            refs.append(ref + page_offset if depth < len(levels) - 1 else ref)
+        sizes = [size for level in levels for size in level[3]]
+        columns = np.concatenate([level[0] for level in levels])
+        num_inner = len(columns) - len(objs)
+        page_leaf = np.zeros(len(sizes), dtype = np.bool_)
+        page_leaf[len(sizes) - len(levels[-1][3]):] = True
+        return cls(columns[:, 0].copy(), columns[:, 1].copy(),
+                   columns[:, 2].copy(), columns[:, 3].copy(),
+                   np.concatenate([level[1] for level in levels]), np.concatenate(refs),
+                   np.cumsum([0] + sizes[:-1]).astype(np.int64),
+                   np.array(sizes, dtype = np.int64), page_leaf,
+                   [None]*num_inner + objs)
+
+    @classmethod
+    def _from_columns(cls, columns, page_start, page_count, page_leaf, objs):
+        left, right, bottom, top, mhv, ref = columns
+        return cls(np.array(left, dtype = np.float64), np.array(right, dtype = np.float64),
+                   np.array(bottom, dtype = np.float64), np.array(top, dtype = np.float64),
+                   np.array(mhv, dtype = np.uint64), np.array(ref, dtype = np.int64),
+                   np.array(page_start, dtype = np.int64),
+                   np.array(page_count, dtype = np.int64),
+                   np.array(page_leaf, dtype = np.bool_), objs)
+
+    @property
+    def num_pages(self):
+        return len(self.page_start)
+
+    @property
+    def nbytes(self):
+        arrays = [self.left, self.right, self.bottom, self.top, self.mhv, self.ref,
+                  self.page_start, self.page_count, self.page_leaf]
+        return sum(array.nbytes for array in arrays)
+
+    @property
+    def mbr(self):
+        if not self.page_count[0]:
+            return Rectangle.get_empty()
+        s, e = self.page_slice(0)
+        return Rectangle((self.left[s:e].min(), self.bottom[s:e].min()),
+                         (self.right[s:e].max(), self.top[s:e].max()))
+
+    def __len__(self):
+        return int(self.page_count[self.page_leaf].sum())
+
+    def page_slice(self, page):
+        start = self.page_start[page]
+        return start, start + self.page_count[page]
+
+    def page_intersects(self, page, query_rectangle):
+        """ Returns the entry indices of page whose rectangles intersect
+        query_rectangle, tested as one vectorized comparison.
+        """
+        s, e = self.page_slice(page)
+        mask = (self.right[s:e] > query_rectangle.left) & \
+            (self.left[s:e] < query_rectangle.right) & \
+            (self.top[s:e] > query_rectangle.bottom) & \
+            (self.bottom[s:e] < query_rectangle.top)
+        return np.flatnonzero(mask) + s
+
+    def page_contains_point(self, page, point):
+        """ Returns the entry indices of page whose rectangles contain point.
+        """
+        x, y = point
+        s, e = self.page_slice(page)
+        mask = (self.left[s:e] <= x) & (self.right[s:e] >= x) & \
+            (self.bottom[s:e] <= y) & (self.top[s:e] >= y)
+        return np.flatnonzero(mask) + s
+
+    def search_range(self, query_rectangle, objects = False):
+        """ Finds all rectangles intersected by a query rectangle.
+        """
+        return self._search(self.page_intersects, query_rectangle, objects)
+
+    def search_point(self, point, objects = False):
+        """ Finds all rectangles containing the query point.
+        """
+        return self._search(self.page_contains_point, point, objects)
+
+    def _search(self, page_filter, query, objects):
+        ans = []
+        stack = [0]
+        while stack:
+            page = stack.pop()
+            hits = page_filter(page, query)
+            if self.page_leaf[page]:
+                if objects:
+                    ans.extend(self.objs[i] for i in hits)
+                else:
+                    ans.extend(self.ref[hits].tolist())
+            else:
+                stack.extend(self.ref[hits].tolist())
+        return ans
+
+    def search_range_batch(self, query_rectangles, objects = False):
+        """ Returns a result list for each of query_rectangles. Each page is
+        visited once per batch and tested against all the queries that reached
+        it as a single (entries x queries) vectorized comparison.
+        """
+        return self._search_batch(rect_bounds(query_rectangles), False, objects)
+
+    def search_point_batch(self, points, objects = False):
+        """ Returns a result list for each of points.
+        """
+        return self._search_batch(point_bounds(points), True, objects)
+
+    def _search_batch(self, queries, closed, objects):
+        results = [[] for i in xrange(len(queries))]
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            page, active = stack.pop()
+            s, e = self.page_slice(page)
+            bounds = np.column_stack([self.left[s:e], self.right[s:e], 
+                                      self.bottom[s:e], self.top[s:e]])
+            mask = intersect_mask(bounds, queries[active], closed)
+            if self.page_leaf[page]:
+                rows, cols = np.nonzero(mask)
+                rows += s
+                if objects:
+                    values = [self.objs[row] for row in rows.tolist()]
+                else:
+                    values = self.ref[rows].tolist()
+                for query, value in itertools.izip(active[cols].tolist(), values):
+                    results[query].append(value)
+            else:
+                for i in xrange(e - s):
+                    hits = active[mask[i]]
+                    if hits.size:
+                        stack.append((int(self.ref[s + i]), hits))
+        return results
@@ -0,0 +1,287 @@
+from __future__ import absolute_import
+
+import itertools
+import threading
+
+from rtree.rtree import LeafEntry
+from rtree.rtree import PointerEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+
+
+class ConcurrentRTree(object):
+    """
+    An R-tree shared by any number of reader threads and serialized writers.
+
+    Readers never lock: each query runs against the root published when it
+    started, and nothing a query reads in a published tree is ever modified:
+    the entries, keys, MBRs and insert buffer of each page stay as they were.
+    Snapshots only support downward traversal, though. A page shared with a
+    later tree has its parent pointer moved to that tree, and the leaf index,
+    like stats, follows the latest tree. A write first copies the
+    region of the tree it can modify, meaning every page on the paths to the
+    leaves it targets plus all of those pages' children, because shifts, splits
+    and rebalancing redistribute whole cohorts. The write is applied to the
+    copy, which shares every other subtree with the published tree, and the
+    new root is then published with a single attribute assignment.
+
+    Each write copies O(height*max_capacity) pages. With an insert buffer,
+    inserts only copy the root page until the buffer is flushed, sharing the
+    buffered entries with the previous root, and a flush copies once per
+    cohort of leaves it fills rather than once per entry.
+    """
+
+    def __init__(self, root = None, props = Properties()):
+        self.root = RTreeNode(is_root = True, props = props) if root is None else root
+        self._write_lock = threading.Lock()
+
+    @property
+    def root(self):
+        return self._root
+
+    @root.setter
+    def root(self, root):
+        # Published roots share pages with later trees, so RTreeNode.flush
+        # refuses to merge their buffers in place.
+        root._published = True
+        self._root = root
+
+    def snapshot(self):
+        """ Returns the current root. It must be treated as read-only and only
+        traversed downwards, as queries do. Its insert buffer can't be flushed,
+        so persist the tree with dump, write_page_file or to_columnar rather
+        than by passing a snapshot to the storage functions.
+        """
+        return self.root
+
+    def search_range(self, query_rectangle, objects = False, limit = None):
+        return self.root.search_range(query_rectangle, objects, limit)
+
+    def search_point(self, point, objects = False, limit = None):
+        return self.root.search_point(point, objects, limit)
+
+    def search_k_nearest(self, k, point, objects = False, max_distance = None):
+        return self.root.search_k_nearest(k, point, objects, max_distance)
+
+    def search_where(self, node_pred = None, entry_pred = None, objects = False, limit = None):
+        return self.root.search_where(node_pred, entry_pred, objects, limit)
+
+    def progressive_range(self, query_rectangle, objects = False, order = 'overlap'):
+        """ Returns a ProgressiveQuery over the current snapshot, which later
+        writes don't affect.
+        """
+        return self.root.progressive_range(query_rectangle, objects, order)
+
+    def search_range_batch(self, query_rectangles, objects = False):
+        return self.root.search_range_batch(query_rectangles, objects)
+
+    def search_point_batch(self, points, objects = False):
+        return self.root.search_point_batch(points, objects)
+
+    def spatial_join(self, other, objects = False, plane_sweep = True):
+        """ Returns the list of pairs joining this tree with another
+        ConcurrentRTree. Both are flushed and joined holding both write locks.
+        """
+        locks = sorted(set([self._write_lock, other._write_lock]), key = id)
+        for lock in locks:
+            lock.acquire()
+        try:
+            self._flush()
+            other._flush()
+            return list(self.root.spatial_join(other.root, objects, plane_sweep))
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def dump(self, f, objects = False):
+        """ Flushes the tree and writes a snapshot of it with storage.dump,
+        holding the write lock.
+        """
+        from rtree.storage import dump
+        with self._write_lock:
+            self._flush()
+            dump(self.root, f, objects)
+
+    def write_page_file(self, path):
+        """ Flushes the tree and writes it to a page file with
+        storage.write_page_file, holding the write lock.
+        """
+        from rtree.storage import write_page_file
+        with self._write_lock:
+            self._flush()
+            write_page_file(self.root, path)
+
+    def to_columnar(self):
+        """ Flushes the tree and returns a ColumnarRTree copy of it, holding the
+        write lock.
+        """
+        from rtree.columnar import ColumnarRTree
+        with self._write_lock:
+            self._flush()
+            return ColumnarRTree.from_node(self.root)
+
+    def insert(self, leaf_entry):
+        with self._write_lock:
+            root = self.root
+            leaf_entry.mhv = root.hilbert_key(leaf_entry.mbr)
+            if root.props['insert_buffer_size'] > 0:
+                buffered = root._buffer
+                root = _copy_node(root, set())
+                root.is_root = True
+                root._buffer = _append(buffered, leaf_entry)
+                self.root = root
+                if root.num_buffered >= root.props['insert_buffer_size']:
+                    self._flush()
+                return
+            root = _copy_region(root, [root.choose_leaf(leaf_entry)])
+            root.insert(leaf_entry)
+            self.root = root
+
+    def flush(self):
+        with self._write_lock:
+            self._flush()
+
+    def _flush(self):
+        """ Flushes the insert buffer one cohort at a time, publishing a new root
+        after each. A whole flush can't be applied to one copy, because shifts
+        higher up may move the remaining target leaves under pages outside the
+        copied region. Readers still see each entry in either the buffer or a
+        leaf.
+        """
+        if not self.root.num_buffered:
+            return
+        self.root.stats['flush'] += 1
+        while self.root.num_buffered:
+            root = self.root
+            pending = sorted(root._buffer, key = lambda entry: entry.mhv)
+            if root.is_leaf_node:
+                root = _copy_region(root, [root])
+                pending = pending[:1]
+                root._insert_keyed(pending[0])
+            else:
+                cohort = _first_cohort(root._route(pending))
+                root = _copy_region(root, [leaf for leaf, _ in cohort])
+                cohort = _first_cohort(root._route(pending))
+                RTreeNode._flush_cohort(cohort)
+                pending = [entry for _, entries in cohort for entry in entries]
+            flushed = set(id(entry) for entry in pending)
+            root._buffer = [entry for entry in root._buffer if id(entry) not in flushed] or None
+            self.root = root
+
+    def delete(self, leaf_entry):
+        with self._write_lock:
+            root = self.root
+            leaf = root.find_leaf(leaf_entry)
+            root = _copy_region(root, [leaf] if leaf is not None else [])
+            found = root.delete(leaf_entry)
+            self.root = root
+            return found
+
+    def delete_batch(self, leaf_entries):
+        with self._write_lock:
+            root = self.root
+            leaf_entries = list(leaf_entries)
+            leaves = [root.find_leaf(leaf_entry) for leaf_entry in leaf_entries]
+            root = _copy_region(root, [leaf for leaf in leaves if leaf is not None])
+            num_deleted = root.delete_batch(leaf_entries)
+            self.root = root
+            return num_deleted
+
+    def update(self, obj_id, new_mbr):
+        with self._write_lock:
+            buffer_size = self.root.props['insert_buffer_size']
+            if buffer_size > 1 and self.root.num_buffered + 1 >= buffer_size:
+                # A relocation must not trigger a whole flush on one copy.
+                self._flush()
+            root = self.root
+            moved = LeafEntry(new_mbr, obj_id, None, root.hilbert_key(new_mbr))
+            leaves = [root.choose_leaf(moved), root._leaf_of(obj_id)]
+            root = _copy_region(root, [leaf for leaf in leaves if leaf is not None])
+            # Entries are updated in place, so the copy gets its own entry.
+            entries = root._buffer or []
+            leaf = root._leaf_of(obj_id)
+            if leaf is not None:
+                entries = leaf.page_entries
+            for i, entry in enumerate(entries):
+                if entry.obj_id == obj_id:
+                    entries[i] = LeafEntry(entry.mbr, obj_id, entry.obj, entry.mhv)
+                    break
+            found = root.update(obj_id, new_mbr)
+            self.root = root
+            return found
+
+
+def _first_cohort(groups):
+    parent = groups[0][0].parent
+    return [(leaf, entries) for leaf, entries in groups if leaf.parent is parent]
+
+
+def _copy_region(root, leaves):
+    """ Returns a copy of the tree rooted at root in which the pages on the
+    paths from the root to leaves, and all of their children, are copied. All
+    other subtrees are shared.
+    """
+    path = set()
+    for leaf in leaves:
+        node = leaf
+        while node is not None and node not in path:
+            path.add(node)
+            node = node.parent
+    copy = _copy_node(root, path)
+    copy.is_root = True
+    # The write may modify the buffer in place, so it gets its own.
+    copy._buffer = list(root._buffer) if root._buffer else None
+    return copy
+
+
+def _copy_node(node, path):
+    if node.is_leaf_node:
+        entries = list(node.page_entries)
+    elif node in path:
+        entries = [PointerEntry(entry.mbr, _copy_node(entry.child, path))
+                   for entry in node.page_entries]
+    else:
+        entries = [PointerEntry(entry.mbr, entry.child) for entry in node.page_entries]
+    return RTreeNode(props = node.props, stats = node.stats, page_entries = entries,
+                     leaf_index = node.leaf_index)
+
+
+def _append(buffered, entry):
+    """ Returns a buffer holding the entries of buffered followed by entry.
+    """
+    if isinstance(buffered, _SharedBuffer):
+        return buffered.appended(entry)
+    return _SharedBuffer(list(buffered or []) + [entry])
+
+
+class _SharedBuffer(object):
+    """
+    An insert buffer made of the first n entries of a list shared with the
+    buffers of earlier roots. Appending to the newest buffer extends the list
+    in place, which the earlier buffers, each reading only its own prefix,
+    never see; so filling a buffer of B entries costs O(B) rather than O(B**2).
+    It is read-only otherwise, and a write that modifies the buffer copies it
+    into a list first.
+    """
+
+    __slots__ = ('_entries', '_n')
+
+    def __init__(self, entries):
+        self._entries = entries
+        self._n = len(entries)
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return itertools.islice(self._entries, self._n)
+
+    def appended(self, entry):
+        """ Returns a new buffer with entry appended, leaving this one as is.
+        """
+        entries = self._entries
+        if len(entries) != self._n:
+            # A later buffer already extended the list past this one.
+            entries = entries[:self._n]
+        entries.append(entry)
+        return _SharedBuffer(entries)
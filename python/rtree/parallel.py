@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.storage import PageFile
+from rtree.types import Rectangle
+from rtree.utils import HilbertQuantizer
+from rtree.utils import point_bounds
+from rtree.utils import rect_bounds
+
+# Each worker process maps the page file once; the OS page cache backs every
+# mapping of it, so the tree is shared between workers rather than copied.
+_pages = None
+
+
+def _init_worker(path):
+    global _pages
+    _pages = PageFile(path)
+
+
+def _pack(results):
+    """ Packs per-query lists of obj_ids into (counts, obj_ids) arrays.
+    """
+    counts = np.array([len(result) for result in results], dtype = np.int64)
+    ids = np.fromiter((obj_id for result in results for obj_id in result),
+                      dtype = np.int64, count = int(counts.sum()))
+    return counts, ids
+
+
+def _search_chunk(args):
+    queries, closed = args
+    return _pack(_pages._search_batch(queries, closed))
+
+
+def _nearest_chunk(args):
+    k, points, max_distance = args
+    return _pack([_pages.search_k_nearest(k, point, max_distance) for point in points])
+
+
+def _encode_chunk(args):
+    props, bounds = args
+    xs = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0])/2.
+    ys = bounds[:, 2] + (bounds[:, 3] - bounds[:, 2])/2.
+    return np.array(Properties(**props).quantizer.keys(xs, ys), dtype = np.uint64)
+
+
+def _sort_partition(keys):
+    return np.argsort(keys, kind = 'mergesort')
+
+
+def parallel_bulk_load(items, props = Properties(), stats = None, fit_extent = False, 
+                       processes = None):
+    """ Builds the same tree as RTreeNode.bulk_load, encoding and sorting the
+    Hilbert keys in a pool of processes.
+
+    Workers only ever see compact arrays. The parent splits the item bounds
+    into one chunk per worker to be encoded, partitions the keys into ranges
+    of the curve at sampled quantiles, and has each worker sort one range. The
+    sorted ranges concatenate into the global order, which the parent packs
+    into pages and stitches under shared upper levels. Node objects are built
+    in the parent, because pickling subtrees back from workers costs several
+    times more than building them. The items' rectangles must be 2-d.
+    """
+    items = list(items)
+    if not items:
+        return RTreeNode.bulk_load(items, props, stats)
+    bounds = rect_bounds([mbr for mbr, _, _ in items])
+    if bounds.shape[1] != 4:
+        raise ValueError("parallel_bulk_load only builds 2-d trees, not %d-d ones." %
+                         (bounds.shape[1]//2))
+    if fit_extent:
+        props = props.with_extent(Rectangle((bounds[:, 0].min(), bounds[:, 2].min()),
+                                            (bounds[:, 1].max(), bounds[:, 3].max())))
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = np.array_split(bounds, processes)
+        keys = np.concatenate(pool.map(_encode_chunk, [(dict(props), chunk) for chunk in chunks]))
+        # Equal keys always fall in the same range, and a stable grouping keeps
+        # them in input order, as the serial sort does.
+        sample = np.sort(keys[::max(len(keys)//(64*processes), 1)])
+        splitters = sample[[len(sample)*i//processes for i in xrange(1, processes)]]
+        part = np.searchsorted(splitters, keys, side = 'right')
+        index = np.argsort(part, kind = 'mergesort')
+        ends = np.searchsorted(part[index], np.arange(processes + 1))
+        parts = [index[ends[i]:ends[i + 1]] for i in xrange(processes)]
+        orders = pool.map(_sort_partition, [keys[part] for part in parts])
+    finally:
+        pool.close()
+        pool.join()
+    order = np.concatenate([part[local] for part, local in zip(parts, orders)])
+    entries = [LeafEntry(items[i][0], items[i][1], items[i][2], mhv)
+               for i, mhv in itertools.izip(order.tolist(), keys[order].tolist())]
+    return RTreeNode._pack(entries, props, stats)
+
+
+class ParallelQueryExecutor(object):
+    """
+    Serves batches of queries from a pool of worker processes, each reading the
+    same page file written by storage.write_page_file through its own memory
+    map. Only the query arrays and the result arrays are pickled: a batch is
+    ordered along a Hilbert curve over its query centers and split into chunks
+    of chunk_size queries, so each worker walks the pages once per chunk of 
+    nearby queries. Each chunk's results come back as a count per query and
+    one flat array of obj_ids.
+    """
+
+    def __init__(self, path, processes = None, chunk_size = 256):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._pool = multiprocessing.Pool(processes, _init_worker, (path,))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_range_batch(self, query_rectangles):
+        """ Lazily yields (index, obj_ids) pairs, obj_ids being an int64 array, 
+        for each of query_rectangles as the workers complete them.
+        """
+        bounds = rect_bounds(query_rectangles)
+        order = self._order(bounds)
+        return self._imap(_search_chunk, order,
+                          [(chunk, False) for chunk in self._chunks(bounds[order])])
+
+    def iter_point_batch(self, points):
+        """ Lazily yields (index, obj_ids) pairs for each of points.
+        """
+        bounds = point_bounds(points)
+        order = self._order(bounds)
+        return self._imap(_search_chunk, order,
+                          [(chunk, True) for chunk in self._chunks(bounds[order])])
+
+    def iter_k_nearest_batch(self, k, points, max_distance = None):
+        """ Lazily yields (index, obj_ids) pairs for each of points, where obj_ids
+        are the k nearest, nearest first.
+        """
+        bounds = point_bounds(points)
+        order = self._order(bounds)
+        points = [tuple(point) for point in bounds[order][:, [0, 2]].tolist()]
+        return self._imap(_nearest_chunk, order,
+                          [(k, chunk, max_distance) for chunk in self._chunks(points)])
+
+    def search_range_batch(self, query_rectangles):
+        """ Returns an int64 array of obj_ids for each of query_rectangles.
+        """
+        return self._collect(self.iter_range_batch(query_rectangles), len(query_rectangles))
+
+    def search_point_batch(self, points):
+        return self._collect(self.iter_point_batch(points), len(points))
+
+    def search_k_nearest_batch(self, k, points, max_distance = None):
+        return self._collect(self.iter_k_nearest_batch(k, points, max_distance), len(points))
+
+    @staticmethod
+    def _order(bounds):
+        """ Returns the permutation sorting query bounds by the Hilbert keys of
+        their centers on a 2**16 grid spanning the batch.
+        """
+        if not len(bounds):
+            return np.arange(0)
+        xs = (bounds[:, 0] + bounds[:, 1])/2.
+        ys = (bounds[:, 2] + bounds[:, 3])/2.
+        scale = tuple((1 << 16)/max(values.max() - values.min(), 1e-300) for values in (xs, ys))
+        quantizer = HilbertQuantizer(16, scale, (xs.min(), ys.min()))
+        return np.argsort(quantizer.keys(xs, ys), kind = 'mergesort')
+
+    def _chunks(self, queries):
+        return [queries[i:i + self.chunk_size] for i in xrange(0, len(queries), self.chunk_size)]
+
+    def _imap(self, task, order, chunks):
+        indices = iter(order.tolist())
+        for counts, ids in self._pool.imap(task, chunks):
+            for result in np.split(ids, np.cumsum(counts)[:-1]):
+                yield next(indices), result
+
+    @staticmethod
+    def _collect(pairs, n):
+        results = [None]*n
+        for index, result in pairs:
+            results[index] = result
+        return results
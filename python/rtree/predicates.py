@@ -0,0 +1,69 @@
+""" Predicates for RTreeNode.search_where, pushed down into the traversal.
+
+Each helper returns a Predicate pair: node is tested on the MBR of each
+subtree, which is only descended into if it holds, and entry is tested on each
+LeafEntry. The node test must hold for every subtree that could contain a
+matching entry; None means it always holds. Pairs unpack into the node_pred
+and entry_pred arguments:
+
+    root.search_where(*all_of(within(viewport), obj_matches(is_road)))
+"""
+
+import collections
+
+Predicate = collections.namedtuple('Predicate', ['node', 'entry'])
+
+
+def intersects(rect):
+    """ Matches entries whose MBRs intersect rect, like search_range.
+    """
+    return Predicate(rect.intersects_rect, lambda entry: rect.intersects_rect(entry.mbr))
+
+
+def contains_point(point):
+    """ Matches entries whose MBRs contain point, like search_point.
+    """
+    return Predicate(lambda mbr: mbr.contains_point(point),
+                     lambda entry: entry.mbr.contains_point(point))
+
+
+def within(rect):
+    """ Matches entries whose MBRs lie inside rect, edges included.
+    """
+    left, right, bottom, top = rect.left, rect.right, rect.bottom, rect.top
+    return Predicate(lambda mbr: mbr.right >= left and mbr.left <= right and
+                     mbr.top >= bottom and mbr.bottom <= top,
+                     lambda entry: rect.contains_rect(entry.mbr))
+
+
+def contains(rect):
+    """ Matches entries whose MBRs contain rect.
+    """
+    return Predicate(lambda mbr: mbr.contains_rect(rect),
+                     lambda entry: entry.mbr.contains_rect(rect))
+
+
+def obj_matches(fn):
+    """ Matches entries for whose obj fn returns True. It can't prune subtrees.
+    """
+    return Predicate(None, lambda entry: fn(entry.obj))
+
+
+def all_of(*predicates):
+    """ Matches entries that all of predicates match.
+    """
+    return Predicate(_conjunction([p.node for p in predicates if p.node is not None]),
+                     _conjunction([p.entry for p in predicates if p.entry is not None]))
+
+
+def _conjunction(fns):
+    if not fns:
+        return None
+    fn = fns[0]
+    for other in fns[1:]:
+        fn = _both(fn, other)
+    return fn
+
+
+def _both(first, second):
+    return lambda arg: first(arg) and second(arg)
@@ -1,23 +1,115 @@
+from __future__ import absolute_import
+
 import bisect
+import heapq
 import itertools
+import time
+import warnings
+
+from rtree.cache import QueryCache
+from rtree.types import Box
+from rtree.types import Rectangle
+from rtree.utils import HilbertQuantizer
+from rtree.utils import capacity_kmeans
+from rtree.utils import intersect_mask
+from rtree.utils import point_bounds
+from rtree.utils import rect_bounds
+from rtree.utils import union_area
 
-# TODO: make sure fixed property fields aren't being recalculated all the time.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class Statistics(dict):
     """ Keeps track of R-Tree operation statistics and functions calls.
+
+    The structural counters are maintained as the tree changes. Queries are
+    only profiled while hooks are registered: every sample_every-th query is
+    timed, added to the query totals, and passed to each hook as a dict of
+    its metrics (query, nodes_visited, entries_tested, pruning_ratio,
+    results, wall_time).
     """
     def __init__(self, *args, **kwargs):
         super(Statistics, self).__init__(*args, **kwargs)        
         self['overflow'] = kwargs.get("overflow", 0)
         self['split'] = kwargs.get("split", 0)
         self['condense'] = kwargs.get("condense", 0)
+        self['flush'] = kwargs.get("flush", 0)
+        self['cache_hits'] = kwargs.get("cache_hits", 0)
+        self['cache_misses'] = kwargs.get("cache_misses", 0)
         self['leaf_nodes'] = kwargs.get("leaf_nodes", 0)
         self['internal_nodes'] = kwargs.get("internal_nodes", 0)
         self['tree_height'] = kwargs.get("tree_height", 0)
+        self['queries'] = kwargs.get("queries", 0)
+        self['nodes_visited'] = kwargs.get("nodes_visited", 0)
+        self['entries_tested'] = kwargs.get("entries_tested", 0)
+        self['results'] = kwargs.get("results", 0)
+        self['query_time'] = kwargs.get("query_time", 0.)
+        self.hooks = []
+        self.sample_every = 1
+        self._num_started = 0
+
+    def add_hook(self, hook):
+        """ Registers a callable to receive the metrics dict of profiled queries.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def start_query(self, query):
+        """ Returns a profile for a query about to run, or None if it shouldn't be
+        profiled.
+        """
+        if not self.hooks:
+            return None
+        self._num_started += 1
+        if self._num_started % self.sample_every:
+            return None
+        return (query, time.time())
+
+    def end_query(self, profile, nodes_visited, entries_tested, entries_passed, results):
+        """ Completes a profile from start_query and reports it to the hooks.
+        """
+        query, start = profile
+        metrics = {'query': query, 'nodes_visited': nodes_visited, 
+                   'entries_tested': entries_tested, 'results': results,
+                   'pruning_ratio': 1 - float(entries_passed)/entries_tested if entries_tested else 0.,
+                   'wall_time': time.time() - start}
+        self['queries'] += 1
+        self['nodes_visited'] += nodes_visited
+        self['entries_tested'] += entries_tested
+        self['results'] += results
+        self['query_time'] += metrics['wall_time']
+        for hook in self.hooks:
+            hook(metrics)
 
 
 class Properties(dict):
     """ Configures the RTree.
+
+    Hilbert keys are computed on a 2**hilbert_resolution grid, where a centroid
+    (x, y) falls in cell (floor(x*hilbert_scale), floor(y*hilbert_scale)),
+    clamped onto the grid. If world_extent is set to a Rectangle (or Box), the grid
+    instead spans that rectangle, so small or negative coordinates such as
+    longitude/latitude spread over the whole curve. hilbert_cache_size > 0
+    enables an LRU cache of keys by grid cell.
+
+    With insert_buffer_size > 0, inserts into the root are buffered and merged
+    into the leaves in bulk once that many are pending. With leaf_index, the
+    tree maps each obj_id to the leaf holding it, so obj_ids must be unique.
+    With query_cache_size > 0, the root caches that many search_range results
+    (which needs numpy), and each change to the tree invalidates the results
+    of the queries whose rectangles it touches.
+
+    split_policy 'hilbert' routes inserts by Hilbert key and deals a cohort's
+    entries out over its pages in key order on overflow, underflow or flush.
+    'kmeans' (which needs numpy) follows the Hilbert cR-tree instead: an
+    overflowing page is split in two by clustering its entries' centroids,
+    inserts go to the page needing the least enlargement, and cohorts are
+    redistributed by clustering, each time with at most k_means_iterations
+    rounds of k-means (10 if 0). Pages then overlap less, but are less full.
     """
     
     def __init__(self, *args, **kwargs):
@@ -25,6 +117,46 @@ class Properties(dict):
         self['max_capacity'] = kwargs.get("max_capacity", 0)
         self['min_capacity'] = kwargs.get("min_capacity", 0)
         self['k_means_size'] = kwargs.get("k_means_size", 0)
+        self['k_means_iterations'] = kwargs.get("k_means_iterations", 0)
+        self['fill_factor'] = kwargs.get("fill_factor", 1.0)
+        self['hilbert_resolution'] = kwargs.get("hilbert_resolution", 32)
+        self['hilbert_scale'] = kwargs.get("hilbert_scale", 1.0)
+        self['hilbert_cache_size'] = kwargs.get("hilbert_cache_size", 0)
+        self['world_extent'] = kwargs.get("world_extent", None)
+        self['insert_buffer_size'] = kwargs.get("insert_buffer_size", 0)
+        self['leaf_index'] = kwargs.get("leaf_index", False)
+        self['split_policy'] = kwargs.get("split_policy", 'hilbert')
+        self['query_cache_size'] = kwargs.get("query_cache_size", 0)
+        assert self['split_policy'] in ('hilbert', 'kmeans')
+        self._quantizer = None
+
+    def __setitem__(self, key, value):
+        super(Properties, self).__setitem__(key, value)
+        self._quantizer = None
+
+    @property
+    def quantizer(self):
+        """ The HilbertQuantizer for these properties, shared by every node using
+        them.
+        """
+        if self._quantizer is None:
+            resolution = self['hilbert_resolution']
+            extent = self['world_extent']
+            if extent is None:
+                origin, scale = (0, 0), self['hilbert_scale']
+            else:
+                cells = float(1 << resolution)
+                origin = tuple(extent.lo)
+                scale = tuple(cells/(hi - lo) if hi > lo else 1. 
+                              for lo, hi in zip(extent.lo, extent.hi))
+            self._quantizer = HilbertQuantizer(resolution, scale, origin,
+                                               self['hilbert_cache_size'])
+        return self._quantizer
+
+    def with_extent(self, world_extent):
+        """ Returns a copy of these properties with a different world_extent.
+        """
+        return Properties(**dict(self, world_extent = world_extent))
 
 
 class PointerEntry(object):
@@ -37,7 +169,7 @@ class PointerEntry(object):
     def __init__(self, mbr, child):
         self.mbr = mbr 
         self.child = child
-        self.mhv = None
+        self.mhv = child.mhv if child is not None and child.page_entries else None
 
     def get_dotstring_repr(self):
         assert False
@@ -48,16 +180,17 @@ class PointerEntry(object):
 
 
 class LeafEntry(object):
-    """ Object stored at an entry.
+    """ Object stored at an entry. Its Hilbert key mhv is assigned by the tree
+    it is inserted into, unless given.
     """
 
     __slots__ = {'mbr', 'obj_id', 'obj', 'mhv'}
 
-    def __init__(self, mbr, obj_id, obj = None):
+    def __init__(self, mbr, obj_id, obj = None, mhv = None):
         self.mbr = mbr
         self.obj_id = obj_id
         self.obj = obj
-        self.mhv = mbr.hilbert_value
+        self.mhv = mhv
 
     def get_dotstring_repr(self):
         assert False
@@ -72,32 +205,143 @@ class RTreeNode(object):
     A page is collection of entries. A page can either be for an inner node, in
     which case all of its entries are PointerEntries; or it can be a leaf node, and 
     all of its entries are LeafEntries. It has a fixed capacity.
+
+    Each page caches its MBR, its largest Hilbert value (LHV) and the sorted
+    Hilbert keys of its entries. These are maintained incrementally as entries
+    are added or removed, and adjust_tree only propagates them upwards while
+    they actually change.
+
+    The root may also hold an insert buffer of keyed LeafEntries not yet placed
+    in a leaf. Queries consult it, and flush merges it into the tree.
+
+    Like stats, the optional leaf_index dict (obj_id -> leaf node) is shared by
+    all the nodes of a tree, and each leaf keeps it current for its entries.
     """
 
     # __slots__ = {'is_root', 'stats', 'max_capacity', 'min_capacity', 'k_means_size', 'page_entries', 'mbr'}
 
-    def __init__(self, is_root = False, parent = None, props = Properties(), stats = Statistics(), page_entries = None):
+    def __init__(self, is_root = False, parent = None, props = Properties(), stats = None, 
+                 page_entries = None, leaf_index = None):
         self.is_root = is_root
-        self.stats = stats
+        self.stats = Statistics() if stats is None else stats
+        self.props = props
         self.max_capacity = props['max_capacity']
         self.min_capacity = props['min_capacity']
         self.k_means_size = props['k_means_size']
         assert not page_entries or (len(page_entries) <= self.max_capacity)
-        self.page_entries = page_entries if page_entries else []
         self.parent = parent 
-        #self.mbr = Rectangle.merge_by_mbr([entry.mbr for entry in self.page_entries])
+        self._mbr = None
+        self._mhv = None
+        self._buffer = None
+        self._query_cache = None
+        self._modifications = 0
+        self._published = False
+        if is_root and leaf_index is None and props['leaf_index']:
+            leaf_index = {}
+        self.leaf_index = leaf_index
+        self._set_entries(page_entries if page_entries else [])
+        if is_root:
+            self.stats.update(self.census())
+
+    @classmethod
+    def bulk_load(cls, items, props = Properties(), stats = None, fit_extent = False):
+        """ Builds a tree bottom-up from an iterable of (mbr, obj_id, obj) tuples
+        and returns its root. Entries are keyed and sorted by Hilbert value
+        once, then packed into pages of max_capacity*fill_factor entries.
+
+        With fit_extent, the tree gets a copy of props whose world_extent is
+        the bounding rectangle of the items.
+        """
+        items = list(items)
+        if fit_extent and items:
+            props = props.with_extent(cls._extent([mbr for mbr, _, _ in items]))
+        keys = cls._hilbert_values([mbr for mbr, _, _ in items], props)
+        entries = [LeafEntry(mbr, obj_id, obj, mhv) 
+                   for (mbr, obj_id, obj), mhv in itertools.izip(items, keys)]
+        entries.sort(key = lambda entry: entry.mhv)
+        return cls._pack(entries, props, stats)
+
+    @classmethod
+    def _pack(cls, sorted_entries, props, stats = None):
+        """ Packs Hilbert-sorted LeafEntries into pages level by level and
+        returns the root.
+        """
+        entries = sorted_entries
+        stats = Statistics() if stats is None else stats
+        leaf_index = {} if props['leaf_index'] else None
+        page_size = max(props['min_capacity'], 1,
+                        int(props['max_capacity']*props['fill_factor']))
+        assert page_size <= props['max_capacity']
+        level = cls._pack_level(entries, page_size, props, stats, leaf_index)
+        while len(level) > 1:
+            entries = [PointerEntry(node.mbr, node) for node in level]
+            level = cls._pack_level(entries, page_size, props, stats, leaf_index)
+        if level:
+            root = level[0]
+            root.is_root = True
+            stats.update(root.census())
+        else:
+            root = cls(is_root = True, props = props, stats = stats)
+        return root
+
+    @staticmethod
+    def _extent(rects):
+        """ Returns the bounding rectangle of rects.
+        """
+        if np is None or not isinstance(rects[0], Rectangle):
+            return rects[0].merge_by_mbr(rects)
+        bounds = rect_bounds(rects)
+        return Rectangle((bounds[:, 0].min(), bounds[:, 2].min()),
+                         (bounds[:, 1].max(), bounds[:, 3].max()))
+
+    @staticmethod
+    def _hilbert_values(rects, props):
+        """ Returns the Hilbert keys of the centroids of rects under props, encoded
+        in a single vectorized pass when numpy is available.
+        """
+        if np is None or not rects or not isinstance(rects[0], Rectangle):
+            return [props.quantizer.key(rect.centroid) for rect in rects]
+        bounds = rect_bounds(rects)
+        xs = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0])/2.
+        ys = bounds[:, 2] + (bounds[:, 3] - bounds[:, 2])/2.
+        return props.quantizer.keys(xs, ys)
+
+    @classmethod
+    def _pack_level(cls, sorted_entries, page_size, props, stats, leaf_index = None):
+        """ Packs Hilbert-sorted entries into a list of sibling pages.
+        """
+        nodes = []
+        start = 0
+        for size in cls._page_sizes(len(sorted_entries), page_size, props['min_capacity']):
+            nodes.append(cls(props = props, stats = stats, leaf_index = leaf_index,
+                             page_entries = sorted_entries[start:start + size]))
+            start += size
+        return nodes
+
+    @staticmethod
+    def _page_sizes(n, page_size, min_capacity):
+        """ Returns page sizes for packing n entries, keeping the trailing page at
+        or above min_capacity by evening it out with its predecessor.
+        """
+        sizes = [page_size]*(n//page_size)
+        if n % page_size:
+            sizes.append(n % page_size)
+        if len(sizes) > 1 and sizes[-1] < min_capacity:
+            total = sizes[-2] + sizes[-1]
+            sizes[-2:] = [total - total//2, total//2]
+        return sizes
 
     @property 
     def is_leaf_node(self):
-        return len(self.page_entries) > 0 and isinstance(self.page_entries[0], LeafEntry)
+        return len(self.page_entries) == 0 or isinstance(self.page_entries[0], LeafEntry)
 
     @property
     def is_full_node(self):
-        return len(self.page_entries) == self.max_capacity
+        return len(self.page_entries) >= self.max_capacity
 
     @property
     def mhv_values(self):
-        return [entry.mhv for entry in self.page_entries]
+        return self._keys
 
     @property 
     def num_children(self):
@@ -105,11 +349,11 @@ class RTreeNode(object):
         
     @property
     def mbr(self):
-        return Rectangle.merge_by_mbr([entry.mbr for entry in self.page_entries])
+        return self._mbr
 
     @property
     def mhv(self):
-        return max([entry.mhv for entry in self.page_entries])
+        return self._mhv
 
     @property 
     def num_cohort(self):
@@ -120,92 +364,581 @@ class RTreeNode(object):
         entries = [entry.child.page_entries for entry in self.parent.page_entries]
         return list(itertools.chain.from_iterable(entries))
 
+    def census(self):
+        """ Counts the leaf and internal nodes and the height of the subtree.
+        """
+        ans = {'leaf_nodes': 0, 'internal_nodes': 0, 'tree_height': 0}
+        level = [self]
+        while level:
+            ans['tree_height'] += 1
+            if level[0].is_leaf_node:
+                ans['leaf_nodes'] += len(level)
+                break
+            ans['internal_nodes'] += len(level)
+            level = [entry.child for node in level for entry in node.page_entries]
+        return ans
+
+    def quality(self):
+        """ Returns per-level page quality of the subtree, from this node down:
+        the page count, the mean fill (entries/max_capacity), the entry overlap
+        (summed pairwise intersection area of the entries of each page over
+        their summed area), the child overlap (the same over inner pages only,
+        so 0 on the leaf level, as the benchmark has always reported it) and
+        the dead space (page area not covered by any of its entries over the
+        summed page area). Areas of N-d Boxes are taken over their first two
+        axes only, with a warning.
+        """
+        if getattr(self.mbr, 'dims', 2) != 2:
+            warnings.warn("RTreeNode.quality measures N-d pages over their first two axes only.",
+                          stacklevel = 2)
+        levels = []
+        level = [self]
+        while level:
+            entries = area = overlap = page_area = dead = 0.
+            for node in level:
+                entries += len(node.page_entries)
+                if not node.page_entries:
+                    continue
+                bounds = rect_bounds([entry.mbr for entry in node.page_entries])
+                w = np.minimum(bounds[:, np.newaxis, 1], bounds[np.newaxis, :, 1]) - \
+                    np.maximum(bounds[:, np.newaxis, 0], bounds[np.newaxis, :, 0])
+                h = np.minimum(bounds[:, np.newaxis, 3], bounds[np.newaxis, :, 3]) - \
+                    np.maximum(bounds[:, np.newaxis, 2], bounds[np.newaxis, :, 2])
+                pairs = np.triu(np.clip(w, 0, None)*np.clip(h, 0, None), 1)
+                area += ((bounds[:, 1] - bounds[:, 0])*(bounds[:, 3] - bounds[:, 2])).sum()
+                overlap += pairs.sum()
+                mbr = node.mbr
+                page_area += (mbr.right - mbr.left)*(mbr.top - mbr.bottom)
+                dead += (mbr.right - mbr.left)*(mbr.top - mbr.bottom) - union_area(bounds[:, :4])
+            entry_overlap = round(float(overlap/area), 4) if area else 0.
+            levels.append({'pages': len(level),
+                           'fill': round(entries/(len(level)*self.max_capacity), 4),
+                           'entry_overlap': entry_overlap,
+                           'child_overlap': 0. if level[0].is_leaf_node else entry_overlap,
+                           'dead_space': round(float(dead/page_area), 4) if page_area else 0.})
+            level = [entry.child for node in level if not node.is_leaf_node
+                     for entry in node.page_entries]
+        return levels
+
+    def _spawn(self, page_entries = None):
+        """ Returns a new, detached node sharing this node's configuration.
+        """
+        return RTreeNode(props = self.props, stats = self.stats, page_entries = page_entries,
+                         leaf_index = self.leaf_index)
+
+    def _set_entries(self, sorted_entries):
+        """ Replaces page_entries with Hilbert-sorted entries, adopting any child
+        nodes and recomputing the cached fields. Returns True if the MBR or LHV
+        changed.
+        """
+        self.page_entries = sorted_entries
+        if self.is_leaf_node:
+            if self.leaf_index is not None:
+                for entry in sorted_entries:
+                    self.leaf_index[entry.obj_id] = self
+        else:
+            for entry in sorted_entries:
+                entry.child.parent = self
+        return self._refresh()
+
+    def _refresh(self):
+        """ Recomputes the cached keys, MBR and LHV from page_entries. Returns True
+        if the MBR or LHV changed.
+        """
+        old_mbr, old_mhv = self._mbr, self._mhv
+        self._keys = [entry.mhv for entry in self.page_entries]
+        self._mbr = self._merge_entries()
+        self._mhv = self._keys[-1] if self._keys else None
+        return self._mbr != old_mbr or self._mhv != old_mhv
+
+    def _merge_entries(self):
+        """ Returns the MBR of page_entries. That of an empty page is an empty
+        Box with the dimension of a Box world_extent, or else of the page's last
+        MBR, or else an empty Rectangle, so that emptying a page of an N-d tree
+        doesn't give it a 2-d MBR.
+        """
+        rects = [entry.mbr for entry in self.page_entries]
+        if rects:
+            return rects[0].merge_by_mbr(rects)
+        like = self.props['world_extent']
+        if like is None:
+            like = self._mbr
+        if isinstance(like, Box):
+            return Box.get_empty(like.dims)
+        return Rectangle.get_empty()
+
+    def hilbert_key(self, mbr):
+        """ Returns the Hilbert key of a rectangle's centroid in this tree.
+        """
+        return self.props.quantizer.key(mbr.centroid)
+
     def next_entry_by_mhv(self, h):
         """ Returns next page entry with the minimum Hilbert value greater than h.
         """ 
-        return bisect.bisect_left(self.mhv_values, h)
+        return bisect.bisect_left(self._keys, h)
 
     def insert_entry(self, entry):
-        """ Inserts into page_entries an entry keyed by its Hilbert value.
+        """ Inserts into page_entries an entry keyed by its Hilbert value. Returns
+        True if the MBR or LHV changed.
         """
-        assert False
+        index = bisect.bisect_right(self._keys, entry.mhv)
+        self._keys.insert(index, entry.mhv)
+        self.page_entries.insert(index, entry)
+        if isinstance(entry, PointerEntry):
+            entry.child.parent = self
+        elif self.leaf_index is not None:
+            self.leaf_index[entry.obj_id] = self
+        old_mbr, old_mhv = self._mbr, self._mhv
+        if len(self.page_entries) == 1:
+            self._mbr = entry.mbr
+        else:
+            self._mbr = self._mbr.get_mbr(entry.mbr)
+        self._mhv = self._keys[-1]
+        return self._mbr != old_mbr or self._mhv != old_mhv
 
-    def iter(self, pred):
-        """ Walks all the pages and page entries in a DFS fashion.
-        TODO: Implement as an iterator and re-express search operations over the tree.
+    def remove_entry(self, index):
+        """ Removes and returns the entry at index, only rescanning the page for
+        the MBR when the removed entry lies on its boundary.
         """
-        assert False
+        entry = self.page_entries.pop(index)
+        self._keys.pop(index)
+        self._mhv = self._keys[-1] if self._keys else None
+        mbr = self._mbr
+        if not mbr.strictly_contains_rect(entry.mbr):
+            self._mbr = self._merge_entries()
+        return entry
 
-    def search_range(self, query_rectangle, objects = False):
-        """Finds all rectangles that are stored in an R-tree , which
-        are intersected by a query rectangle. 
+    def _refresh_entry(self, child):
+        """ Copies the cached MBR and LHV of child into its PointerEntry on this
+        page, moving the entry if its LHV passed a neighbour's, which can happen
+        when pages are clustered rather than split by key. Returns True if this
+        page's own MBR or LHV changed.
+        """
+        for i, entry in enumerate(self.page_entries):
+            if entry.child is child:
+                break
+        else:
+            raise ValueError("Node is not a child of this page; its parent link is broken.")
+        if entry.mbr == child.mbr and entry.mhv == child.mhv:
+            return False
+        shrunk = not child.mbr.contains_rect(entry.mbr)
+        entry.mbr = child.mbr
+        entry.mhv = child.mhv
+        self._keys[i] = child.mhv
+        if (i > 0 and self._keys[i - 1] > child.mhv) or \
+                (i + 1 < len(self._keys) and self._keys[i + 1] < child.mhv):
+            del self._keys[i], self.page_entries[i]
+            i = bisect.bisect_right(self._keys, child.mhv)
+            self._keys.insert(i, child.mhv)
+            self.page_entries.insert(i, entry)
+        old_mbr, old_mhv = self._mbr, self._mhv
+        if shrunk:
+            self._mbr = self._merge_entries()
+        else:
+            self._mbr = self._mbr.get_mbr(child.mbr)
+        self._mhv = self._keys[-1]
+        return self._mbr != old_mbr or self._mhv != old_mhv
+
+    def _refresh_entries(self):
+        """ Copies the cached MBR and LHV of every child into its PointerEntry.
+        Clustered pages may change order, so under the kmeans split policy the
+        entries are re-sorted. Returns True if this page's own MBR or LHV
+        changed.
         """
-        if objects:
-            assert False, "Returning full objects not implemented yet."
-        ans = []
         for entry in self.page_entries:
-            if entry.mbr.intersects_rect(query_rectangle) and self.is_leaf_node:
-                ans.append(entry.obj_id)
-            elif entry.mbr.intersects_rect(query_rectangle):
-                ans.extend(entry.child.search_range(query_rectangle, objects))
-        return ans
+            entry.mbr = entry.child.mbr
+            entry.mhv = entry.child.mhv
+        if self.props['split_policy'] == 'kmeans':
+            self.page_entries.sort(key = lambda entry: entry.mhv)
+        return self._refresh()
+
+    def iter(self, pred = None, query = 'iter'):
+        """ Walks all the pages and page entries in a DFS fashion, lazily yielding
+        the LeafEntries for which pred holds. pred is also applied to each
+        PointerEntry, and a subtree is only descended into if it holds there.
+        Buffered entries are tested last. query names the walk in profiled
+        Statistics.
+        """
+        return self._walk(pred, pred, query)
+
+    def iter_where(self, node_pred = None, entry_pred = None, objects = False, limit = None):
+        """ Lazily yields the obj_ids (or objects) of the LeafEntries for which
+        entry_pred holds, only descending into subtrees whose MBRs node_pred
+        holds for. Either may be None, and the pairs built by rtree.predicates
+        unpack into them.
+        """
+        pointer_pred = None
+        if node_pred is not None:
+            pointer_pred = lambda entry: node_pred(entry.mbr)
+        return self._stream(self._walk(pointer_pred, entry_pred, 'where'), objects, limit)
+
+    def search_where(self, node_pred = None, entry_pred = None, objects = False, limit = None):
+        return list(self.iter_where(node_pred, entry_pred, objects, limit))
+
+    def _walk(self, pointer_pred, entry_pred, query):
+        profile = self.stats.start_query(query)
+        nodes = tested = passed = results = 0
+        stack = [self]
+        try:
+            while stack:
+                node = stack.pop()
+                nodes += 1
+                tested += len(node.page_entries)
+                if node.is_leaf_node:
+                    for entry in node.page_entries:
+                        if entry_pred is None or entry_pred(entry):
+                            results += 1
+                            yield entry
+                else:
+                    for entry in reversed(node.page_entries):
+                        if pointer_pred is None or pointer_pred(entry):
+                            passed += 1
+                            stack.append(entry.child)
+            if self._buffer:
+                tested += len(self._buffer)
+                for entry in list(self._buffer):
+                    if entry_pred is None or entry_pred(entry):
+                        results += 1
+                        yield entry
+        finally:
+            if profile is not None:
+                self.stats.end_query(profile, nodes, tested, passed + results, results)
+
+    def iter_range(self, query_rectangle, objects = False, limit = None):
+        """ Lazily yields the obj_ids (or objects) of all rectangles intersected
+        by a query rectangle, stopping after limit results if given.
+        """
+        entries = self.iter(lambda entry: entry.mbr.intersects_rect(query_rectangle), 'range')
+        return self._stream(entries, objects, limit)
+
+    def iter_point(self, point, objects = False, limit = None):
+        """ Lazily yields the obj_ids (or objects) of all rectangles containing the
+        query point, stopping after limit results if given.
+        """
+        entries = self.iter(lambda entry: entry.mbr.contains_point(point), 'point')
+        return self._stream(entries, objects, limit)
+
+    @staticmethod
+    def _stream(entries, objects, limit):
+        results = (entry.obj if objects else entry.obj_id for entry in entries)
+        return results if limit is None else itertools.islice(results, limit)
+
+    def search_range(self, query_rectangle, objects = False, limit = None):
+        """Finds all rectangles that are stored in an R-tree , which
+        are intersected by a query rectangle. A root with a query cache serves
+        repeated queries from it.
+        """
+        cache = self.query_cache
+        if cache is None:
+            return list(self.iter_range(query_rectangle, objects, limit))
+        key = (query_rectangle.bounds, objects)
+        result = cache.get(key)
+        if result is not None:
+            self.stats['cache_hits'] += 1
+            return result[:limit]
+        self.stats['cache_misses'] += 1
+        if limit is not None:
+            return list(self.iter_range(query_rectangle, objects, limit))
+        result = list(self.iter_range(query_rectangle, objects))
+        cache.put(key, query_rectangle, result)
+        return result[:]
+
+    @property
+    def query_cache(self):
+        """ The root's QueryCache, created on first use, or None if the tree
+        isn't configured with one.
+        """
+        if self._query_cache is None and self.is_root and self.props['query_cache_size'] > 0:
+            self._query_cache = QueryCache(self.props['query_cache_size'])
+        return self._query_cache
+
+    def _invalidate(self, mbrs):
+        """ Records a change to the tree within mbrs, dropping the cached query
+        results it invalidates.
+        """
+        self._modifications += 1
+        if self._query_cache is not None:
+            self._query_cache.invalidate(mbrs)
 
     def contains_point(self, point):
-        """ 
+        """ Returns True if the page's MBR contains the point.
         """
-        assert False
+        return len(self.page_entries) > 0 and self._mbr.contains_point(point)
 
-    def search_point(self, point, objects = False):
+    def search_point(self, point, objects = False, limit = None):
         """Finds all rectangles that are stored in an RTree, which
         contain the query point. 
         """
-        if objects:
-            assert False, "Returning full objects not implemented yet."
-        ans = []
-        for entry in self.page_entries:
-            if entry.mbr.contains_point(query_rectangle) and self.is_leaf_node:
-                ans.append(entry.obj_id)
-            elif entry.mbr.contains_point(query_rectangle):
-                ans.extend(entry.child.search_point(query_rectangle, objects))
-        return ans
+        return list(self.iter_point(point, objects, limit))
+
+    def search_range_batch(self, query_rectangles, objects = False):
+        """ Returns a result list for each of query_rectangles, as search_range
+        would. The tree is walked once for the whole batch, and each visited
+        page is tested against all the queries that reached it at once.
+        """
+        return self._search_batch(rect_bounds(query_rectangles), False, objects)
+
+    def search_point_batch(self, points, objects = False):
+        """ Returns a result list for each of points, as search_point would.
+        """
+        return self._search_batch(point_bounds(points), True, objects)
+
+    def _search_batch(self, queries, closed, objects):
+        assert np is not None, "Batched search requires numpy."
+        profile = self.stats.start_query('batch')
+        nodes = tested = passed = num_results = 0
+        results = [[] for i in xrange(len(queries))]
+        # Buffered entries are tested as if they were one more leaf page.
+        stack = [(self.page_entries, np.arange(len(queries)))]
+        if self._buffer:
+            stack.append((self._buffer, stack[0][1]))
+        while stack:
+            page_entries, active = stack.pop()
+            nodes += 1
+            if not page_entries:
+                continue
+            mask = intersect_mask(rect_bounds([entry.mbr for entry in page_entries]),
+                                  queries[active], closed)
+            tested += mask.size
+            for entry, row in itertools.izip(page_entries, mask):
+                hits = active[row]
+                if not hits.size:
+                    continue
+                passed += hits.size
+                if isinstance(entry, LeafEntry):
+                    num_results += hits.size
+                    result = entry.obj if objects else entry.obj_id
+                    for query in hits.tolist():
+                        results[query].append(result)
+                else:
+                    stack.append((entry.child.page_entries, hits))
+        if profile is not None:
+            self.stats.end_query(profile, nodes, tested, passed, num_results)
+        return results
+
+    def spatial_join(self, other, objects = False, plane_sweep = True):
+        """ Lazily yields (obj_id, other_obj_id) pairs (or object pairs) for all
+        intersecting rectangles of this tree and other. Both trees are descended
+        in lockstep, only following pairs of entries whose MBRs intersect;
+        when the trees differ in height, the deeper one is descended alone. 
+        Within a pair of pages, candidates are found by a plane sweep along x
+        unless plane_sweep is False. Both trees' insert buffers are flushed
+        first.
+        """
+        self.flush()
+        other.flush()
+        find_pairs = RTreeNode._sweep_pairs if plane_sweep else RTreeNode._nested_pairs
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if not a.page_entries or not b.page_entries:
+                continue
+            # Only entries overlapping the other page's MBR can take part.
+            entries_a = [e for e in a.page_entries if e.mbr.intersects_rect(b.mbr)]
+            entries_b = [e for e in b.page_entries if e.mbr.intersects_rect(a.mbr)]
+            if a.is_leaf_node and b.is_leaf_node:
+                for ea, eb in find_pairs(entries_a, entries_b):
+                    if objects:
+                        yield ea.obj, eb.obj
+                    else:
+                        yield ea.obj_id, eb.obj_id
+            elif a.is_leaf_node:
+                stack.extend((a, eb.child) for eb in entries_b)
+            elif b.is_leaf_node:
+                stack.extend((ea.child, b) for ea in entries_a)
+            else:
+                stack.extend((ea.child, eb.child) for ea, eb in find_pairs(entries_a, entries_b))
+
+    @staticmethod
+    def _nested_pairs(entries_a, entries_b):
+        for ea in entries_a:
+            for eb in entries_b:
+                if ea.mbr.intersects_rect(eb.mbr):
+                    yield ea, eb
+
+    @staticmethod
+    def _sweep_pairs(entries_a, entries_b):
+        """ Yields intersecting (ea, eb) pairs by sweeping both entry lists in order
+        of their left edges.
+        """
+        key = lambda entry: entry.mbr.left
+        a = sorted(entries_a, key = key)
+        b = sorted(entries_b, key = key)
+        i = j = 0
+        while i < len(a) and j < len(b):
+            if a[i].mbr.left <= b[j].mbr.left:
+                k = j
+                while k < len(b) and b[k].mbr.left < a[i].mbr.right:
+                    if a[i].mbr.intersects_rect(b[k].mbr):
+                        yield a[i], b[k]
+                    k += 1
+                i += 1
+            else:
+                k = i
+                while k < len(a) and a[k].mbr.left < b[j].mbr.right:
+                    if a[k].mbr.intersects_rect(b[j].mbr):
+                        yield a[k], b[j]
+                    k += 1
+                j += 1
 
     def insert(self, leaf_entry):
-        """ Inserts a new entry leaf_entry in an RTree
+        """ Inserts a new entry leaf_entry in an RTree, keying it by the tree's
+        Hilbert quantization. If the tree has an insert buffer, the entry is
+        buffered, and the buffer is flushed once it is full.
         """
+        leaf_entry.mhv = self.hilbert_key(leaf_entry.mbr)
+        self._invalidate([leaf_entry.mbr])
+        buffer_size = self.props['insert_buffer_size']
+        if buffer_size > 0 and self.is_root:
+            if self._buffer is None:
+                self._buffer = []
+            self._buffer.append(leaf_entry)
+            if len(self._buffer) >= buffer_size:
+                self.flush()
+            return
+        self._insert_keyed(leaf_entry)
+
+    def _insert_keyed(self, leaf_entry):
         leaf = self.choose_leaf(leaf_entry)
         if not leaf.is_full_node:
-            index = self.next_entry_by_mhv(leaf_entry.mhv)
-            self.page_entries.insert(index, leaf_entry)
+            leaf.insert_entry(leaf_entry)
+            leaf.adjust_tree()
         else:
             split_node = leaf.handle_overflow(leaf_entry)
-        self.adjust_tree(split_node)
+            leaf.adjust_tree(split_node, cohort_changed = True)
 
-    def adjust_tree(self, split_node = None):
-        """Propagate from node, adjusting covering rectangles and propagating nodes
-        splits as necessary.
+    @property
+    def num_buffered(self):
+        return len(self._buffer) if self._buffer else 0
+
+    def flush(self):
+        """ Merges the insert buffer into the tree. The buffered entries are
+        sorted by Hilbert value and routed down together; each group of sibling
+        leaves receiving entries then either takes them in place or, if one of
+        them would overflow, has its whole cohort redistributed once, adding as
+        many leaves as needed. A root published by a ConcurrentRTree shares its
+        pages with later trees, so flushing it raises ValueError.
         """
-        if self.is_root:
-            return 
-        parent = self.parent
-        if not parent.is_full_node:
-            index = parent.next_entry_by_mhv(split_node.mhv)
-            parent.page_entries.insert(index, split_node)
+        if not self._buffer:
+            return
+        if self._published:
+            raise ValueError("Cannot flush a ConcurrentRTree snapshot, whose pages are "
+                             "shared; use the ConcurrentRTree's own methods.")
+        pending = sorted(self._buffer, key = lambda entry: entry.mhv)
+        self._buffer = None
+        self._modifications += 1
+        self.stats['flush'] += 1
+        # Until the root has children there is no cohort to distribute over.
+        while pending and self.is_leaf_node:
+            self._insert_keyed(pending.pop(0))
+        groups = self._route(pending)
+        while groups:
+            parent = groups[0][0].parent
+            cohort = [(leaf, entries) for leaf, entries in groups if leaf.parent is parent]
+            groups = [(leaf, entries) for leaf, entries in groups if leaf.parent is not parent]
+            RTreeNode._flush_cohort(cohort)
+
+    @staticmethod
+    def _flush_cohort(cohort):
+        """ Merges routed (leaf, entries) groups whose leaves are siblings into
+        their leaves, redistributing the cohort if one of them would overflow.
+        """
+        if all(len(leaf.page_entries) + len(entries) <= leaf.max_capacity 
+               for leaf, entries in cohort):
+            for leaf, entries in cohort:
+                leaf._set_entries(sorted(leaf.page_entries + entries, 
+                                         key = lambda entry: entry.mhv))
+                leaf.adjust_tree()
         else:
-            new_split = parent.handle_overflow(split_node)
-        # adjust
-        # recurse
+            entries = [entry for _, group in cohort for entry in group]
+            cohort[0][0]._merge_cohort(entries)
+
+    def _route(self, sorted_entries):
+        """ Returns (leaf, entries) pairs, in order, assigning each of the sorted
+        entries to the leaf choose_leaf would pick for it.
+        """
+        keys = [entry.mhv for entry in sorted_entries]
+        groups = []
+        stack = [(self, 0, len(keys))]
+        while stack:
+            node, lo, hi = stack.pop()
+            if node.is_leaf_node:
+                groups.append((node, sorted_entries[lo:hi]))
+                continue
+            children = []
+            last = len(node.page_entries) - 1
+            for i, entry in enumerate(node.page_entries):
+                end = hi if i == last else bisect.bisect_right(keys, node._keys[i], lo, hi)
+                if end > lo:
+                    children.append((entry.child, lo, end))
+                lo = end
+            stack.extend(reversed(children))
+        return groups
+
+    def _merge_cohort(self, entries):
+        """ Redistributes the entries of this node's cohort together with new
+        entries over the cohort, adding as many siblings as needed and then
+        inserting them into the parent one by one.
+        """
+        self.stats['overflow'] += 1
+        e = self.cohort_entries + entries
+        e.sort(key = lambda entry: entry.mhv)
+        siblings = [entry.child for entry in self.parent.page_entries]
+        num_nodes = max(len(siblings), -(-len(e)//self.max_capacity))
+        new_nodes = [self._spawn() for i in xrange(num_nodes - len(siblings))]
+        self._redistribute(e, siblings + new_nodes)
+        self.stats['split'] += len(new_nodes)
+        self.stats['leaf_nodes' if self.is_leaf_node else 'internal_nodes'] += len(new_nodes)
+        siblings[0].adjust_tree(cohort_changed = True)
+        prev = siblings[-1]
+        for node in new_nodes:
+            prev.adjust_tree(node)
+            prev = node
+
+    def adjust_tree(self, split_node = None, cohort_changed = False):
+        """Propagate from node, adjusting covering rectangles and propagating nodes
+        splits as necessary. If cohort_changed, all of the node's siblings were
+        redistributed. Stops as soon as a level's MBR and LHV are unchanged.
+        """
+        node = self
+        while not node.is_root:
+            parent = node.parent
+            if cohort_changed:
+                changed = parent._refresh_entries()
+            else:
+                changed = parent._refresh_entry(node)
+            cohort_changed = False
+            if split_node is not None:
+                entry = PointerEntry(split_node.mbr, split_node)
+                if not parent.is_full_node:
+                    parent.insert_entry(entry)
+                    split_node = None
+                else:
+                    split_node = parent.handle_overflow(entry)
+                    cohort_changed = True
+                changed = True
+            if not changed:
+                return
+            node = parent
 
     def get_parent_entry(self):
         for entry in self.parent.page_entries:
             if entry.child is self:
                 return entry
 
-    def handle_overflow(self, leaf_entry):
-        """ Returns a new node if an split has actually occurred, or None.
+    def handle_overflow(self, entry):
+        """ Returns a new node if an split has actually occurred, or None. The root
+        has no cohort, so it grows the tree by a level instead. Under the kmeans
+        split policy, the node is always split in two by clustering.
         """
+        self.stats['overflow'] += 1
+        if self.is_root:
+            return self._grow_root(entry)
+        if self.props['split_policy'] == 'kmeans':
+            return self._cluster_split(entry)
         n = self.num_cohort
-        e = self.cohort_entries + leaf_entry
-        e = sorted(e, key = lambda entry: entry.mhv, reverse = True)
+        e = self.cohort_entries + [entry]
+        e.sort(key = lambda entry: entry.mhv)
         if len(e) <= n*self.max_capacity:
             return self._handle_shift(e)
         else:
@@ -215,72 +948,462 @@ class RTreeNode(object):
         """ If we have space amongst the sibling nodes, redistribute the entries 
         in sorted order.
         """ 
-        for i in xrange(self.parent.num_children):
-            self.parent.page_entries[i].child.page_entries = []
-            j = 0
-            new_allocation = len(e)/self.parent.num_children
-            while j < new_allocation and len(e) > 0:
-                self.parent.page_entries[i].child.page_entries.append(e.pop())
-                j += 1
+        siblings = [entry.child for entry in self.parent.page_entries]
+        self._redistribute(sorted_entries, siblings)
         return None
 
     def _handle_split(self, sorted_entries):
         """ If we lack space amongst the sibling nodes, add a new node and 
         redistribute the entries in sorted order.
         """ 
-        new_node = RTreeNode(is_root = False, parent = None)
-        for i in xrange(self.parent.num_children):
-            self.parent.page_entries[i].child.page_entries = []
-            new_allocation = len(e)/(self.parent.num_children + 1)
-            while j < new_allocation and len(e) > 0:
-                self.parent.page_entries[i].child.page_entries.append(e.pop())
+        new_node = self._spawn()
+        siblings = [entry.child for entry in self.parent.page_entries]
+        self._redistribute(sorted_entries, siblings + [new_node])
+        self.stats['split'] += 1
+        self.stats['leaf_nodes' if new_node.is_leaf_node else 'internal_nodes'] += 1
+        return new_node
+
+    def _cluster_split(self, entry):
+        """ Splits the node's entries and entry into two clusters by k-means,
+        like the Hilbert cR-tree, instead of deferring the split to the cohort.
+        Clustering only the overflowing page leaves the clusters room to
+        follow the data; clustering a nearly full cohort would force points
+        into whichever pages still have room.
+        """
+        e = self.page_entries + [entry]
+        e.sort(key = lambda entry: entry.mhv)
+        new_node = self._spawn()
+        self._redistribute(e, [self, new_node])
+        self.stats['split'] += 1
+        self.stats['leaf_nodes' if new_node.is_leaf_node else 'internal_nodes'] += 1
         return new_node
-            
+
+    def _grow_root(self, entry):
+        """ Splits an overflowing root into two children, keeping the root node 
+        itself as the entry point of the tree.
+        """
+        e = self.page_entries + [entry]
+        e.sort(key = lambda entry: entry.mhv)
+        children = [self._spawn(), self._spawn()]
+        self._redistribute(e, children)
+        self._set_entries([PointerEntry(child.mbr, child) for child in children])
+        self.stats['split'] += 1
+        self.stats['tree_height'] += 1
+        self.stats['internal_nodes'] += 1
+        self.stats['leaf_nodes' if children[0].is_leaf_node else 'internal_nodes'] += 1
+        return None
+
+    @staticmethod
+    def _distribute(sorted_entries, nodes):
+        """ Deals sorted entries out evenly over nodes, in order.
+        """
+        n, extra = divmod(len(sorted_entries), len(nodes))
+        start = 0
+        for i, node in enumerate(nodes):
+            size = n + (1 if i < extra else 0)
+            node._set_entries(sorted_entries[start:start + size])
+            start += size
+
+    def _redistribute(self, sorted_entries, nodes):
+        """ Redistributes sorted entries over nodes by the tree's split policy.
+        With 'kmeans', the Hilbert-order deal seeds a capacity-bounded k-means
+        over the entries' centroids. The clusters keep their entries in
+        Hilbert order and are assigned to nodes in order of their largest key,
+        so the parent's pages stay sorted by LHV.
+        """
+        if self.props['split_policy'] != 'kmeans' or not 1 < len(nodes) <= len(sorted_entries):
+            return self._distribute(sorted_entries, nodes)
+        assert np is not None, "The kmeans split policy requires numpy."
+        n, k = len(sorted_entries), len(nodes)
+        bounds = rect_bounds([entry.mbr for entry in sorted_entries])
+        points = (bounds[:, 0::2] + bounds[:, 1::2])/2.
+        min_size = min(max(self.min_capacity, 1), n//k)
+        labels = capacity_kmeans(points, np.arange(n)*k//n, min_size, self.max_capacity,
+                                 self.props['k_means_iterations'] or 10)
+        groups = [[] for i in xrange(k)]
+        for entry, label in itertools.izip(sorted_entries, labels.tolist()):
+            groups[label].append(entry)
+        groups.sort(key = lambda group: group[-1].mhv)
+        for node, group in itertools.izip(nodes, groups):
+            node._set_entries(group)
 
     def find_leaf(self, leaf_entry):
-        """ Find the leaf containing the leaf_entry.
+        """ Find the leaf containing an entry with the obj_id and MBR of
+        leaf_entry, looking it up in the leaf index if the tree has one.
         """
-        for entry in self.page_entries:
-            if self.is_leaf_node and entry.mbr == leaf_entry.mbr:
-                return entry
-            elif not self.is_leaf_node and entry.mbr.intersects_rect(entry.mbr):
-                return entry.child.find_each(leaf_entry)
+        if self.leaf_index is not None:
+            leaf = self.leaf_index.get(leaf_entry.obj_id)
+            if leaf is not None and leaf._entry_index(leaf_entry) is not None:
+                return leaf
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf_node:
+                if node._entry_index(leaf_entry) is not None:
+                    return node
+            else:
+                stack.extend(entry.child for entry in reversed(node.page_entries)
+                             if entry.mbr.contains_rect(leaf_entry.mbr))
+        return None
+
+    def _entry_index(self, leaf_entry):
+        """ Returns the index of the entry of this leaf with the obj_id and MBR of
+        leaf_entry, or None.
+        """
+        for i, entry in enumerate(self.page_entries):
+            if entry.obj_id == leaf_entry.obj_id and entry.mbr == leaf_entry.mbr:
+                return i
         return None
             
     def choose_leaf(self, leaf_entry):
-        """ Returns the leaf node in which to place the new leaf_entry.
+        """ Returns the leaf node in which to place the new leaf_entry: by Hilbert
+        key, or under the kmeans split policy, whose pages interleave along the
+        curve, by least MBR enlargement.
         """
         if self.is_leaf_node:
             return self
+        elif self.props['split_policy'] == 'kmeans':
+            mbr = leaf_entry.mbr
+            child = min(self.page_entries, 
+                        key = lambda entry: (entry.mbr.get_mbr(mbr).area - entry.mbr.area,
+                                             entry.mbr.area)).child
+            return child.choose_leaf(leaf_entry)
         else:
-            next_entry = self.next_entry_by_mhv(leaf_entry.mhv)
+            next_entry = min(self.next_entry_by_mhv(leaf_entry.mhv), len(self.page_entries) - 1)
             child = self.page_entries[next_entry].child
             return child.choose_leaf(leaf_entry)    
 
     def delete(self, leaf_entry):
-        """ Deletes the leaf_entry.
+        """ Deletes the entry with the obj_id and MBR of leaf_entry. Returns True
+        if one was found.
         """
+        if self._delete_buffered(leaf_entry):
+            self._invalidate([leaf_entry.mbr])
+            return True
         leaf = self.find_leaf(leaf_entry)
         if leaf is None:
-            return 
-        for i in xrange(len(leaf.entries)):
-            entry = leaf.entries[i]
-            if entry.mbr == leaf_entry.mbr:
-                leaf.entries.pop(i)
-        # for underflow:
-        # redistribute entries from sibling nodes as in handle_overflow
-        # self.adjust_tree()
-
-        #         leaf.condense_tree()
-        #         break
-        # if self.num_children == 1:
-        #     self = self.page_entries[0].child
-        #     self.parent = None
-
-    def search_k_nearest(self, k, point):
+            return False
+        self._invalidate([leaf_entry.mbr])
+        entry = leaf.remove_entry(leaf._entry_index(leaf_entry))
+        if leaf.leaf_index is not None:
+            leaf.leaf_index.pop(entry.obj_id, None)
+        leaf.condense_tree()
+        return True
+
+    def delete_batch(self, leaf_entries):
+        """ Deletes the entries with the obj_ids and MBRs of leaf_entries, and
+        returns how many were found. All the entries are removed from their
+        leaves first, and then each touched cohort is rebalanced once, level by
+        level up to the root.
+        """
+        removed = {}
+        leaves = []
+        mbrs = []
+        num_deleted = 0
+        for leaf_entry in leaf_entries:
+            if self._delete_buffered(leaf_entry):
+                mbrs.append(leaf_entry.mbr)
+                num_deleted += 1
+                continue
+            leaf = self.find_leaf(leaf_entry)
+            if leaf is None:
+                continue
+            key = (leaf_entry.obj_id, leaf_entry.mbr)
+            if leaf not in removed:
+                removed[leaf] = set()
+                leaves.append(leaf)
+            if key not in removed[leaf]:
+                removed[leaf].add(key)
+                mbrs.append(leaf_entry.mbr)
+                num_deleted += 1
+        self._invalidate(mbrs)
+        for leaf in leaves:
+            keys = removed[leaf]
+            entries = []
+            for entry in leaf.page_entries:
+                if (entry.obj_id, entry.mbr) in keys:
+                    keys.discard((entry.obj_id, entry.mbr))
+                    if leaf.leaf_index is not None:
+                        leaf.leaf_index.pop(entry.obj_id, None)
+                else:
+                    entries.append(entry)
+            leaf._set_entries(entries)
+        if leaves:
+            RTreeNode._condense(leaves)
+        return num_deleted
+
+    def update(self, obj_id, new_mbr):
+        """ Moves the entry of obj_id to new_mbr. Returns True if it was found.
+
+        The entry is found through the leaf index when the tree has one, and
+        otherwise by scanning the leaves. If its new Hilbert key still falls
+        between the other keys of its leaf, it is updated in place; otherwise it
+        is deleted and reinserted.
+        """
+        h = self.hilbert_key(new_mbr)
+        for entry in self._buffer or []:
+            if entry.obj_id == obj_id:
+                self._invalidate([entry.mbr, new_mbr])
+                entry.mbr, entry.mhv = new_mbr, h
+                return True
+        leaf = self._leaf_of(obj_id)
+        if leaf is None:
+            return False
+        for i, entry in enumerate(leaf.page_entries):
+            if entry.obj_id == obj_id:
+                break
+        else:
+            return False
+        self._invalidate([entry.mbr, new_mbr])
+        leaf.remove_entry(i)
+        entry.mbr = new_mbr
+        entry.mhv = h
+        keys = leaf.mhv_values
+        if keys and keys[0] <= h <= keys[-1]:
+            leaf.insert_entry(entry)
+            leaf.adjust_tree()
+        else:
+            if self.leaf_index is not None:
+                del self.leaf_index[obj_id]
+            leaf.condense_tree()
+            self.insert(entry)
+        return True
+
+    def _leaf_of(self, obj_id):
+        """ Returns the leaf holding an entry of obj_id, or None. A leaf index
+        entry that has gone stale falls back to the scan.
+        """
+        if self.leaf_index is not None:
+            leaf = self.leaf_index.get(obj_id)
+            if leaf is None or any(entry.obj_id == obj_id for entry in leaf.page_entries):
+                return leaf
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not node.is_leaf_node:
+                stack.extend(entry.child for entry in node.page_entries)
+            elif any(entry.obj_id == obj_id for entry in node.page_entries):
+                return node
+        return None
+
+    def _delete_buffered(self, leaf_entry):
+        if self._buffer:
+            for i, entry in enumerate(self._buffer):
+                if entry.obj_id == leaf_entry.obj_id and entry.mbr == leaf_entry.mbr:
+                    del self._buffer[i]
+                    if self.leaf_index is not None:
+                        self.leaf_index.pop(entry.obj_id, None)
+                    return True
+        return False
+
+    def condense_tree(self):
+        """ Rebalances the pages on the path up from this node after a deletion
+        and adjusts the covering rectangles above.
+        """
+        RTreeNode._condense([self])
+
+    @staticmethod
+    def _condense(nodes):
+        """ Propagates deletions from nodes, all on the same level, up to the root.
+        Each parent of a changed node is visited once per level: if one of its
+        children underflowed, its cohort is rebalanced, and its cached fields 
+        are refreshed. Propagation stops where nothing changed. Finally, a root
+        left with a single child absorbs it.
+        """
+        level = nodes
+        root = None
+        while level:
+            parents = []
+            seen = set()
+            for node in level:
+                if node.is_root:
+                    root = node
+                elif node.parent not in seen:
+                    seen.add(node.parent)
+                    parents.append(node.parent)
+            level = []
+            for parent in parents:
+                old_mbr, old_mhv = parent.mbr, parent.mhv
+                removed = parent._rebalance_children() 
+                parent._refresh_entries()
+                if removed or parent.mbr != old_mbr or parent.mhv != old_mhv:
+                    level.append(parent)
+        if root is not None:
+            root._shrink_root()
+
+    def _rebalance_children(self):
+        """ Handles underflowing children of this node, mirroring _handle_shift:
+        if the cohort has enough entries to keep every child at min_capacity,
+        its entries are redistributed over all the children; otherwise over as
+        few as they fill, and the remaining children are removed. Returns True
+        if any children were removed.
+        """
+        children = [entry.child for entry in self.page_entries]
+        min_fill = max(self.min_capacity, 1)
+        if all(len(child.page_entries) >= min_fill for child in children):
+            return False
+        e = [entry for child in children for entry in child.page_entries]
+        e.sort(key = lambda entry: entry.mhv)
+        num = len(children)
+        if len(e) < num*min_fill:
+            num = min(num, max(len(e)//min_fill, -(-len(e)//self.max_capacity)))
+        before = self._count_types(children + [self])
+        keep, drop = children[:num], children[num:]
+        if keep:
+            self._redistribute(e, keep)
+        for child in drop:
+            child._set_entries([])
+            child.parent = None
+        self._set_entries([PointerEntry(child.mbr, child) for child in keep])
+        after = self._count_types(keep + [self])
+        self.stats['leaf_nodes'] += after[0] - before[0]
+        self.stats['internal_nodes'] += after[1] - before[1]
+        self.stats['condense'] += 1
+        if self.is_root and not keep:
+            self.stats['tree_height'] = 1
+        return len(drop) > 0
+
+    @staticmethod
+    def _count_types(nodes):
+        leaves = sum(1 for node in nodes if node.is_leaf_node)
+        return leaves, len(nodes) - leaves
+
+    def _shrink_root(self):
+        """ While the root has a single child, replaces the root's entries with 
+        the child's, removing a level.
+        """
+        while not self.is_leaf_node and len(self.page_entries) == 1:
+            child = self.page_entries[0].child
+            self._set_entries(child.page_entries)
+            child._set_entries([])
+            child.parent = None
+            self.stats['internal_nodes'] -= 1
+            self.stats['tree_height'] -= 1
+            self.stats['condense'] += 1
+
+    def iter_nearest(self, point, objects = False, max_distance = None):
+        """ Lazily yields (distance, obj_id) pairs (or (distance, obj) pairs) in
+        order of increasing distance from point, optionally stopping past
+        max_distance. Pages are expanded best-first from a priority queue keyed
+        on MINDIST, so only pages closer than the last result are visited.
+        """
+        profile = self.stats.start_query('nearest')
+        nodes = tested = passed = results = 0
+        counter = itertools.count()
+        heap = [(0, next(counter), self)]
+        for entry in self._buffer or []:
+            d = entry.mbr.min_distance(point)
+            if max_distance is None or d <= max_distance:
+                heap.append((d, next(counter), entry))
+        heapq.heapify(heap)
+        try:
+            while heap:
+                dist, _, item = heapq.heappop(heap)
+                if isinstance(item, LeafEntry):
+                    results += 1
+                    yield dist, item.obj if objects else item.obj_id
+                    continue
+                nodes += 1
+                tested += len(item.page_entries)
+                for entry in item.page_entries:
+                    d = entry.mbr.min_distance(point)
+                    if max_distance is None or d <= max_distance:
+                        passed += 1
+                        target = entry if item.is_leaf_node else entry.child
+                        heapq.heappush(heap, (d, next(counter), target))
+        finally:
+            if profile is not None:
+                self.stats.end_query(profile, nodes, tested, passed, results)
+
+    def search_k_nearest(self, k, point, objects = False, max_distance = None):
         """ Returns the k-nearest neighbors from a specified point
         """
-        assert False
+        nearest = self.iter_nearest(point, objects, max_distance)
+        return [result for _, result in itertools.islice(nearest, k)]
+
+    def progressive_range(self, query_rectangle, objects = False, order = 'overlap'):
+        """ Returns a ProgressiveQuery answering a range query in installments,
+        each within a budget of pages or time.
+        """
+        return ProgressiveQuery(self, query_rectangle, objects, order)
+
+
+class ProgressiveQuery(object):
+    """
+    A range query answered in installments, for when a fast partial answer
+    beats a late complete one. Each call to fetch visits pages until its
+    budget runs out and returns the new results; complete tells whether any
+    pages are left, and the next call resumes where the last one stopped.
+
+    Pages are visited best-first. With order 'overlap' the priority is the
+    fraction of a page's area the query covers, so pages holding mostly
+    results come first; with order 'hilbert' it is the distance along the
+    Hilbert curve from the query's center to the page's key range.
+
+    The query holds on to the pages it has yet to visit, so the tree must not
+    be modified until it completes: fetch raises RuntimeError if it was. A
+    ConcurrentRTree snapshot never is.
+    """
+
+    def __init__(self, root, query_rectangle, objects = False, order = 'overlap'):
+        assert order in ('overlap', 'hilbert')
+        self.root = root
+        self.query_rectangle = query_rectangle
+        self.objects = objects
+        self.order = order
+        self.nodes_visited = 0
+        self._modifications = root._modifications
+        self._center_key = root.hilbert_key(query_rectangle) if order == 'hilbert' else None
+        self._counter = itertools.count()
+        self._heap = [(0, next(self._counter), root)] if root.page_entries else []
+        self._buffered = [entry for entry in root._buffer or []
+                          if entry.mbr.intersects_rect(query_rectangle)]
+
+    @property
+    def complete(self):
+        return not self._heap and not self._buffered
+
+    def fetch(self, max_nodes = None, max_time = None):
+        """ Returns the obj_ids (or objects) found on up to max_nodes more pages,
+        stopping early once max_time seconds have passed. At least one page is
+        visited per call, so repeated calls always complete the query.
+        """
+        if self.root._modifications != self._modifications:
+            raise RuntimeError("The tree was modified during a progressive query.")
+        profile = self.root.stats.start_query('progressive')
+        deadline = None if max_time is None else time.time() + max_time
+        query = self.query_rectangle
+        ans = [entry.obj if self.objects else entry.obj_id for entry in self._buffered]
+        self._buffered = []
+        nodes = tested = passed = 0
+        heap = self._heap
+        while heap:
+            if nodes and ((max_nodes is not None and nodes >= max_nodes) or
+                          (deadline is not None and time.time() >= deadline)):
+                break
+            _, _, node = heapq.heappop(heap)
+            nodes += 1
+            tested += len(node.page_entries)
+            for entry in node.page_entries:
+                if not entry.mbr.intersects_rect(query):
+                    continue
+                passed += 1
+                if node.is_leaf_node:
+                    ans.append(entry.obj if self.objects else entry.obj_id)
+                else:
+                    # Ties go to the newest page, descending to leaves first.
+                    heapq.heappush(heap, (self._priority(entry), -next(self._counter), entry.child))
+        self.nodes_visited += nodes
+        if profile is not None:
+            self.root.stats.end_query(profile, nodes, tested, passed, len(ans))
+        return ans
 
-from itertools import izip
-argmax = lambda array: max(izip(array, xrange(len(array))))[1]
+    def _priority(self, entry):
+        if self.order == 'overlap':
+            area = entry.mbr.area
+            if area <= 0:
+                return -1.
+            return -entry.mbr.get_intersect_area(self.query_rectangle)/float(area)
+        h = self._center_key
+        lo, hi = entry.child.mhv_values[0], entry.mhv
+        return 0 if lo <= h <= hi else min(abs(h - lo), abs(h - hi))
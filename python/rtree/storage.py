@@ -0,0 +1,363 @@
+from __future__ import absolute_import
+
+import cPickle as pickle
+import heapq
+import itertools
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from rtree.rtree import LeafEntry
+from rtree.rtree import PointerEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.rtree import Statistics
+from rtree.types import Box
+from rtree.types import Rectangle
+from rtree.utils import intersect_mask
+from rtree.utils import point_bounds
+from rtree.utils import rect_bounds
+
+# Page file layout: a HEADER_SIZE byte header followed by num_pages fixed-size
+# pages in level order, page 0 being the root. Each page is a small header
+# (leaf flag, entry count) and max_capacity entry slots of binary rectangle,
+# Hilbert value and reference, where the reference is an obj_id in a leaf page
+# and a child page number in an inner page. Objects themselves aren't stored.
+
+PAGE_FILE_MAGIC = 'RTPG'
+PAGE_FILE_VERSION = 1
+HEADER_FORMAT = '<4sIIIQ'
+HEADER_SIZE = 64
+PAGE_ALIGNMENT = 64
+
+# Snapshot layout: a header (magic, version, objects flag, length of the
+# Properties), the Properties as JSON, then one block per tree level from the
+# root down. A level block is (num_pages, num_entries), the entry count of each
+# page and the level's entries as ENTRY_DTYPE records; the children of an inner
+# level are the pages of the next level, in order. A (0, 0) block ends the
+# levels, optionally followed by a single pickled list of the leaf objects,
+# which load only unpickles if the snapshot was dumped with objects.
+
+SNAPSHOT_MAGIC = 'RTSN'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER_FORMAT = '<4sIBI'
+LEVEL_HEADER_FORMAT = '<QQ'
+
+ENTRY_DTYPE = np.dtype([('left', '<f8'), ('right', '<f8'), ('bottom', '<f8'), ('top', '<f8'),
+                        ('mhv', '<u8'), ('ref', '<i8')])
+
+
+def page_dtype(max_capacity):
+    """ Returns the numpy record type of one page, padded to PAGE_ALIGNMENT.
+    """
+    size = 16 + ENTRY_DTYPE.itemsize*max_capacity
+    size += -size % PAGE_ALIGNMENT
+    return np.dtype({'names': ['leaf', 'count', 'entries'],
+                     'formats': ['u1', '<u4', (ENTRY_DTYPE, (max_capacity,))],
+                     'offsets': [0, 4, 16], 'itemsize': size})
+
+
+def write_page_file(root, path):
+    """ Writes the tree rooted at root to a page file at path, streaming one
+    page at a time in level order. Buffered inserts are flushed first. Only
+    2-d trees can be written.
+    """
+    _check_planar(root)
+    root.flush()
+    dtype = page_dtype(root.max_capacity)
+    page = np.zeros(1, dtype = dtype)
+    with open(path, 'wb') as f:
+        f.write('\0'*HEADER_SIZE)
+        pages = [root]
+        i = 0
+        while i < len(pages):
+            node = pages[i]
+            page[...] = 0
+            page['leaf'] = node.is_leaf_node
+            page['count'] = len(node.page_entries)
+            entries = page['entries'][0]
+            for j, entry in enumerate(node.page_entries):
+                if node.is_leaf_node:
+                    ref = entry.obj_id
+                else:
+                    ref = len(pages)
+                    pages.append(entry.child)
+                mbr = entry.mbr
+                entries[j] = (mbr.left, mbr.right, mbr.bottom, mbr.top, entry.mhv, ref)
+            f.write(page.tobytes())
+            i += 1
+        header = struct.pack(HEADER_FORMAT, PAGE_FILE_MAGIC, PAGE_FILE_VERSION,
+                             dtype.itemsize, root.max_capacity, len(pages))
+        f.seek(0)
+        f.write(header)
+
+
+class PageFile(object):
+    """
+    Read-only view of a page file written by write_page_file. The file is
+    memory-mapped and pages are numpy record views straight onto the map, so
+    queries read pages zero-copy through the OS page cache, which is shared
+    between processes opening the same file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, page_size, max_capacity, num_pages = \
+            struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        dtype = page_dtype(max_capacity)
+        error = None
+        if magic != PAGE_FILE_MAGIC:
+            error = "Not an R-tree page file: %r" % path
+        elif version != PAGE_FILE_VERSION:
+            error = "Unsupported page file version %d" % version
+        elif dtype.itemsize != page_size or len(self._mmap) < HEADER_SIZE + num_pages*page_size:
+            error = "Corrupt page file: %r" % path
+        if error is not None:
+            self._mmap.close()
+            self._file.close()
+            raise ValueError(error)
+        self.max_capacity = max_capacity
+        self.pages = np.frombuffer(self._mmap, dtype = dtype, count = num_pages,
+                                   offset = HEADER_SIZE)
+
+    def close(self):
+        self.pages = None
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def num_pages(self):
+        return len(self.pages)
+
+    @property
+    def mbr(self):
+        entries = self.page_entries(0)
+        if not len(entries):
+            return Rectangle.get_empty()
+        return Rectangle((entries['left'].min(), entries['bottom'].min()),
+                         (entries['right'].max(), entries['top'].max()))
+
+    def page_entries(self, page):
+        """ Returns a zero-copy record view of the entries of a page.
+        """
+        record = self.pages[page]
+        return record['entries'][:record['count']]
+
+    def search_range(self, query_rectangle):
+        """ Finds the obj_ids of all rectangles intersected by a query rectangle.
+        """
+        q = query_rectangle
+        return self._search(lambda e: (e['right'] > q.left) & (e['left'] < q.right) &
+                            (e['top'] > q.bottom) & (e['bottom'] < q.top))
+
+    def search_point(self, point):
+        """ Finds the obj_ids of all rectangles containing the query point.
+        """
+        x, y = point
+        return self._search(lambda e: (e['left'] <= x) & (e['right'] >= x) &
+                            (e['bottom'] <= y) & (e['top'] >= y))
+
+    def _search(self, entry_mask):
+        ans = []
+        stack = [0]
+        while stack:
+            page = stack.pop()
+            entries = self.page_entries(page)
+            refs = entries['ref'][entry_mask(entries)].tolist()
+            if self.pages[page]['leaf']:
+                ans.extend(refs)
+            else:
+                stack.extend(refs)
+        return ans
+
+    def search_k_nearest(self, k, point, max_distance = None):
+        """ Returns the obj_ids of the k rectangles nearest to point, expanding
+        pages best-first by MINDIST as RTreeNode.iter_nearest does.
+        """
+        x, y = point
+        counter = itertools.count()
+        heap = [(0., next(counter), True, 0)]
+        ans = []
+        while heap and len(ans) < k:
+            dist, _, is_page, ref = heapq.heappop(heap)
+            if not is_page:
+                ans.append(ref)
+                continue
+            entries = self.page_entries(ref)
+            dx = np.maximum(np.maximum(entries['left'] - x, x - entries['right']), 0)
+            dy = np.maximum(np.maximum(entries['bottom'] - y, y - entries['top']), 0)
+            dists = np.sqrt(dx*dx + dy*dy).tolist()
+            leaf = bool(self.pages[ref]['leaf'])
+            for d, child in zip(dists, entries['ref'].tolist()):
+                if max_distance is None or d <= max_distance:
+                    heapq.heappush(heap, (d, next(counter), not leaf, child))
+        return ans
+
+    def search_range_batch(self, query_rectangles):
+        """ Returns the obj_ids found for each of query_rectangles, walking the
+        file once for the whole batch.
+        """
+        return self._search_batch(rect_bounds(query_rectangles), False)
+
+    def search_point_batch(self, points):
+        """ Returns the obj_ids found for each of points.
+        """
+        return self._search_batch(point_bounds(points), True)
+
+    def _search_batch(self, queries, closed):
+        results = [[] for i in xrange(len(queries))]
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            page, active = stack.pop()
+            entries = self.page_entries(page)
+            bounds = np.column_stack([entries['left'], entries['right'],
+                                      entries['bottom'], entries['top']])
+            mask = intersect_mask(bounds, queries[active], closed)
+            if self.pages[page]['leaf']:
+                rows, cols = np.nonzero(mask)
+                for query, ref in zip(active[cols].tolist(), entries['ref'][rows].tolist()):
+                    results[query].append(ref)
+            else:
+                for ref, row in zip(entries['ref'].tolist(), mask):
+                    hits = active[row]
+                    if hits.size:
+                        stack.append((ref, hits))
+        return results
+
+
+def dump(root, f, objects = False):
+    """ Writes a snapshot of the tree rooted at root to the file object f, one
+    level at a time. Leaf objects are only written if objects is True.
+    Buffered inserts are flushed first. Only 2-d trees can be written.
+    """
+    _check_planar(root)
+    root.flush()
+    props = _dump_props(root.props)
+    f.write(struct.pack(SNAPSHOT_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                        objects, len(props)))
+    f.write(props)
+    objs = []
+    level = [root]
+    while level:
+        next_level = []
+        rows = []
+        for node in level:
+            for entry in node.page_entries:
+                if node.is_leaf_node:
+                    ref = entry.obj_id
+                    if objects:
+                        objs.append(entry.obj)
+                else:
+                    ref = len(next_level)
+                    next_level.append(entry.child)
+                mbr = entry.mbr
+                rows.append((mbr.left, mbr.right, mbr.bottom, mbr.top, entry.mhv, ref))
+        counts = np.array([len(node.page_entries) for node in level], dtype = '<u4')
+        f.write(struct.pack(LEVEL_HEADER_FORMAT, len(level), len(rows)))
+        f.write(counts.tobytes())
+        f.write(np.array(rows, dtype = ENTRY_DTYPE).tobytes())
+        level = next_level
+    f.write(struct.pack(LEVEL_HEADER_FORMAT, 0, 0))
+    if objects:
+        pickle.dump(objs, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load(f, stats = None):
+    """ Restores a tree written by dump from the file object f and returns its
+    root. Nodes are rebuilt bottom-up from the stored rectangles and Hilbert
+    values, without re-running insertion or Hilbert encoding.
+    """
+    magic, version, objects, props_size = _read_struct(f, SNAPSHOT_HEADER_FORMAT)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not an R-tree snapshot.")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version %d" % version)
+    props = _load_props(f.read(props_size))
+    stats = Statistics() if stats is None else stats
+    leaf_index = {} if props['leaf_index'] else None
+    levels = []
+    while True:
+        num_pages, num_entries = _read_struct(f, LEVEL_HEADER_FORMAT)
+        if not num_pages:
+            break
+        counts = np.frombuffer(f.read(4*num_pages), dtype = '<u4')
+        entries = np.frombuffer(f.read(ENTRY_DTYPE.itemsize*num_entries), dtype = ENTRY_DTYPE)
+        levels.append((counts.tolist(), entries))
+    objs = pickle.load(f) if objects else None
+
+    children = None
+    for counts, entries in reversed(levels):
+        columns = [entries[name].tolist() for name in ENTRY_DTYPE.names]
+        rects = [Rectangle((left, bottom), (right, top)) 
+                 for left, right, bottom, top in zip(*columns[:4])]
+        if children is None:
+            page_entries = [LeafEntry(rect, obj_id, None, mhv)
+                            for rect, mhv, obj_id in zip(rects, columns[4], columns[5])]
+            if objs is not None:
+                for entry, obj in zip(page_entries, objs):
+                    entry.obj = obj
+        else:
+            page_entries = [PointerEntry(rect, children[ref]) 
+                            for rect, ref in zip(rects, columns[5])]
+        nodes = []
+        start = 0
+        for count in counts:
+            nodes.append(RTreeNode(props = props, stats = stats, leaf_index = leaf_index,
+                                   page_entries = page_entries[start:start + count]))
+            start += count
+        children = nodes
+    root = children[0]
+    root.is_root = True
+    stats.update(root.census())
+    return root
+
+
+def _check_planar(root):
+    """ Raises ValueError unless the tree rooted at root is 2-d, since pages
+    hold (left, right, bottom, top) bounds and 64-bit Hilbert keys.
+    """
+    dims = getattr(root.mbr, 'dims', 2)
+    if dims != 2:
+        raise ValueError("Only 2-d trees can be stored, not %d-d ones." % dims)
+
+
+def _dump_props(props):
+    """ Serializes Properties as JSON, the world_extent as its type and corners.
+    """
+    props = dict(props)
+    extent = props['world_extent']
+    if extent is not None:
+        props['world_extent'] = {'type': type(extent).__name__,
+                                 'lo': list(extent.lo), 'hi': list(extent.hi)}
+    return json.dumps(props, sort_keys = True)
+
+
+def _load_props(data):
+    try:
+        props = dict((str(key), value) for key, value in json.loads(data).items())
+    except ValueError:
+        raise ValueError("Corrupt snapshot properties.")
+    extent = props.get('world_extent')
+    if extent is not None:
+        types = {'Rectangle': Rectangle, 'Box': Box}
+        if extent.get('type') not in types:
+            raise ValueError("Unknown world_extent type %r" % extent.get('type'))
+        props['world_extent'] = types[extent['type']](extent['lo'], extent['hi'])
+    if isinstance(props.get('hilbert_scale'), list):
+        props['hilbert_scale'] = tuple(props['hilbert_scale'])
+    if 'split_policy' in props:
+        props['split_policy'] = str(props['split_policy'])
+    return Properties(**props)
+
+
+def _read_struct(f, fmt):
+    return struct.unpack(fmt, f.read(struct.calcsize(fmt)))
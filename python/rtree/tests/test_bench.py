@@ -0,0 +1,266 @@
+""" Reproducible benchmarks for the R-tree.
+
+Run as a script to benchmark build throughput, query latency, memory and page
+quality over seeded synthetic datasets, writing JSON that can be diffed
+between runs:
+
+    python -m rtree.tests.test_bench --sizes 1000 10000 --output bench.json
+    python -m rtree.tests.test_bench --compare before.json bench.json
+
+Under unittest, the harness itself is exercised at a small size.
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import unittest
+
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.types import Rectangle
+
+EXTENT = 100000.
+
+
+def uniform_items(n, seed):
+    """ Small squares scattered uniformly over the extent.
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in xrange(n):
+        x, y = rng.uniform(0, EXTENT), rng.uniform(0, EXTENT)
+        w, h = rng.uniform(1, 100), rng.uniform(1, 100)
+        items.append((Rectangle((x, y), (x + w, y + h)), i, None))
+    return items
+
+
+def clustered_items(n, seed, num_clusters = 20):
+    """ Small squares drawn from Gaussian clusters, like urban point data.
+    """
+    rng = random.Random(seed)
+    centers = [(rng.uniform(0, EXTENT), rng.uniform(0, EXTENT), rng.uniform(200, 3000))
+               for i in xrange(num_clusters)]
+    items = []
+    for i in xrange(n):
+        cx, cy, sigma = rng.choice(centers)
+        x, y = rng.gauss(cx, sigma), rng.gauss(cy, sigma)
+        x, y = min(max(x, 0), EXTENT), min(max(y, 0), EXTENT)
+        w, h = rng.uniform(1, 20), rng.uniform(1, 20)
+        items.append((Rectangle((x, y), (x + w, y + h)), i, None))
+    return items
+
+
+def road_items(n, seed, segments_per_road = 50):
+    """ Thin, elongated rectangles bounding consecutive segments of random
+    walks, like road networks.
+    """
+    rng = random.Random(seed)
+    items = []
+    while len(items) < n:
+        x, y = rng.uniform(0, EXTENT), rng.uniform(0, EXTENT)
+        heading = rng.uniform(0, 2*math.pi)
+        for i in xrange(min(segments_per_road, n - len(items))):
+            heading += rng.gauss(0, 0.3)
+            length = rng.expovariate(1/200.)
+            nx = min(max(x + length*math.cos(heading), 0), EXTENT)
+            ny = min(max(y + length*math.sin(heading), 0), EXTENT)
+            items.append((Rectangle((x, y), (nx, ny)), len(items), None))
+            x, y = nx, ny
+    return items
+
+
+DATASETS = {'uniform': uniform_items, 'clustered': clustered_items, 'roads': road_items}
+
+
+def range_queries(n, seed, size = EXTENT/100):
+    rng = random.Random(seed)
+    queries = []
+    for i in xrange(n):
+        x, y = rng.uniform(0, EXTENT - size), rng.uniform(0, EXTENT - size)
+        queries.append(Rectangle((x, y), (x + size, y + size)))
+    return queries
+
+
+def random_points(n, seed):
+    rng = random.Random(seed)
+    return [(rng.uniform(0, EXTENT), rng.uniform(0, EXTENT)) for i in xrange(n)]
+
+
+def percentiles(samples, ps = (50, 90, 99)):
+    """ Returns nearest-rank percentiles of samples, in microseconds.
+    """
+    samples = sorted(samples)
+    ans = {}
+    for p in ps:
+        index = max(int(math.ceil(p/100.*len(samples))) - 1, 0)
+        ans['p%d_us' % p] = round(samples[index]*1e6, 2) if samples else None
+    return ans
+
+
+def time_calls(fn, args):
+    latencies = []
+    for arg in args:
+        start = time.time()
+        fn(arg)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def tree_nbytes(root):
+    """ Estimates the memory held by the tree's nodes, entries and rectangles.
+    """
+    total = 0
+    for node in walk_nodes(root):
+        total += sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+        total += sys.getsizeof(node.page_entries) + sys.getsizeof(node.mhv_values)
+        for entry in node.page_entries:
+            total += sys.getsizeof(entry) + sys.getsizeof(entry.mbr)
+    return total
+
+
+def walk_nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if not node.is_leaf_node:
+            stack.extend(entry.child for entry in node.page_entries)
+
+
+def page_quality(root):
+    """ Returns per-level page counts, fill, child overlap (comparable with
+    earlier runs), entry overlap and dead space, from the root down, as
+    reported by RTreeNode.quality.
+    """
+    return root.quality()
+
+
+def run_benchmark(dataset, n, props, num_queries = 200, k = 10, seed = 0, incremental = True):
+    """ Benchmarks building and querying one tree, returning a dict of results.
+    """
+    items = DATASETS[dataset](n, seed)
+    result = {'dataset': dataset, 'n': n, 'seed': seed,
+              'max_capacity': props['max_capacity'], 'min_capacity': props['min_capacity'],
+              'split_policy': props['split_policy']}
+
+    start = time.time()
+    root = RTreeNode.bulk_load(items, props)
+    result['bulk_load_per_sec'] = round(n/max(time.time() - start, 1e-9))
+    if incremental:
+        start = time.time()
+        inserted = RTreeNode(is_root = True, props = props)
+        for mbr, obj_id, obj in items:
+            inserted.insert(LeafEntry(mbr, obj_id, obj))
+        result['insert_per_sec'] = round(n/max(time.time() - start, 1e-9))
+        result['insert_quality'] = page_quality(inserted)
+
+    queries = range_queries(num_queries, seed + 1)
+    points = random_points(num_queries, seed + 2)
+    result['range_query'] = percentiles(time_calls(root.search_range, queries))
+    result['range_results_mean'] = sum(len(root.search_range(q)) for q in queries)/float(num_queries)
+    result['point_query'] = percentiles(time_calls(root.search_point, points))
+    result['knn_query'] = percentiles(time_calls(lambda p: root.search_k_nearest(k, p), points))
+    result['bytes_per_entry'] = round(tree_nbytes(root)/float(max(n, 1)), 1)
+    result['bulk_load_quality'] = page_quality(root)
+    return result
+
+
+def run_suite(datasets, sizes, props, **kwargs):
+    return {'python': platform.python_version(),
+            'results': [run_benchmark(dataset, n, props, **kwargs)
+                        for dataset in datasets for n in sizes]}
+
+
+def compare(before, after):
+    """ Yields (dataset, n, metric, before, after) for the numeric top-level and
+    latency metrics shared by two suite outputs.
+    """
+    index = dict(((r['dataset'], r['n']), r) for r in before['results'])
+    for new in after['results']:
+        old = index.get((new['dataset'], new['n']))
+        if old is None:
+            continue
+        for metric in sorted(new):
+            values = [(metric, old.get(metric), new[metric])]
+            if isinstance(new[metric], dict):
+                values = [('%s.%s' % (metric, key), old.get(metric, {}).get(key), value)
+                          for key, value in sorted(new[metric].items())]
+            for name, a, b in values:
+                if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                    yield new['dataset'], new['n'], name, a, b
+
+
+class BenchmarkTests(unittest.TestCase):
+    props = Properties(max_capacity = 16, min_capacity = 6)
+
+    def test_datasets(self):
+        for name, make in DATASETS.items():
+            items = make(300, 1)
+            self.assertTrue(len(items) == 300)
+            self.assertTrue([obj_id for _, obj_id, _ in items] == range(300))
+            self.assertTrue([mbr for mbr, _, _ in items] == [mbr for mbr, _, _ in make(300, 1)])
+
+    def test_percentiles(self):
+        ans = percentiles([i/1e6 for i in xrange(1, 101)])
+        self.assertTrue(ans == {'p50_us': 50, 'p90_us': 90, 'p99_us': 99})
+
+    def test_run_benchmark(self):
+        result = run_benchmark('clustered', 500, self.props, num_queries = 20)
+        for key in ['bulk_load_per_sec', 'insert_per_sec', 'range_query', 'point_query',
+                    'knn_query', 'bytes_per_entry', 'bulk_load_quality']:
+            self.assertTrue(key in result)
+        self.assertTrue(result['bulk_load_quality'][-1]['pages'] >= 500/16)
+        json.dumps(result)
+
+    def test_compare(self):
+        before = run_suite(['uniform'], [200], self.props, num_queries = 5, incremental = False)
+        rows = list(compare(before, before))
+        self.assertTrue(('uniform', 200, 'range_query.p50_us') in [row[:3] for row in rows])
+        self.assertTrue(all(a == b for _, _, _, a, b in rows))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'R-tree benchmarks.')
+    parser.add_argument('--datasets', nargs = '+', default = sorted(DATASETS),
+                        choices = sorted(DATASETS))
+    parser.add_argument('--sizes', nargs = '+', type = int, default = [1000, 10000])
+    parser.add_argument('--max-capacity', type = int, default = 32)
+    parser.add_argument('--min-capacity', type = int, default = 12)
+    parser.add_argument('--split-policy', default = 'hilbert', choices = ['hilbert', 'kmeans'])
+    parser.add_argument('--k-means-iterations', type = int, default = 0)
+    parser.add_argument('--queries', type = int, default = 500)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-insert', action = 'store_true',
+                        help = 'Skip the incremental insertion build.')
+    parser.add_argument('--output', help = 'JSON output path (default: stdout).')
+    parser.add_argument('--compare', nargs = 2, metavar = ('BEFORE', 'AFTER'),
+                        help = 'Print metric ratios between two JSON outputs.')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        before, after = [json.load(open(path)) for path in args.compare]
+        for dataset, n, metric, a, b in compare(before, after):
+            ratio = '%.3f' % (float(b)/a) if a else 'n/a'
+            print '%-10s %9d %-28s %14s %14s %8s' % (dataset, n, metric, a, b, ratio)
+        return
+
+    props = Properties(max_capacity = args.max_capacity, min_capacity = args.min_capacity,
+                       split_policy = args.split_policy,
+                       k_means_iterations = args.k_means_iterations)
+    results = run_suite(args.datasets, args.sizes, props, num_queries = args.queries,
+                        seed = args.seed, incremental = not args.no_insert)
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
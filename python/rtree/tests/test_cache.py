@@ -0,0 +1,104 @@
+import random
+import unittest
+
+from rtree.cache import QueryCache
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.tests.test_rtree import brute_force_range
+from rtree.tests.test_rtree import random_items
+from rtree.types import Box
+from rtree.types import Rectangle
+
+
+class QueryCacheTests(unittest.TestCase):
+    def test_lru(self):
+        cache = QueryCache(3)
+        for i in xrange(3):
+            cache.put(i, Rectangle((i*10, 0), (i*10 + 5, 5)), [i])
+        self.assertTrue(cache.get(0) == [0])
+        cache.put(3, Rectangle((30, 0), (35, 5)), [3])
+        self.assertTrue(len(cache) == 3)
+        self.assertTrue(cache.get(1) is None)
+        self.assertTrue(cache.get(0) == [0] and cache.get(3) == [3])
+        cache.clear()
+        self.assertTrue(len(cache) == 0 and cache.get(0) is None)
+
+    def test_invalidate(self):
+        cache = QueryCache(4)
+        cache.put('a', Rectangle((0, 0), (10, 10)), [1])
+        cache.put('b', Rectangle((20, 0), (30, 10)), [2])
+        self.assertTrue(cache.invalidate([Rectangle((40, 40), (50, 50))]) == 0)
+        self.assertTrue(cache.invalidate([Rectangle((10, 10), (15, 15))]) == 1)
+        self.assertTrue(cache.get('a') is None and cache.get('b') == [2])
+        cache.put('c', Rectangle((0, 20), (5, 25)), [3])
+        self.assertTrue(cache.invalidate([Rectangle((25, 5), (25, 5)),
+                                          Rectangle((1, 21), (2, 22))]) == 2)
+        self.assertTrue(len(cache) == 0 and cache.invalidate([]) == 0)
+
+    def test_invalidate_boxes(self):
+        # Windows over the same area at different times only clash in time.
+        cache = QueryCache(4)
+        cache.put('early', Box((0, 0, 0), (10, 10, 5)), [1])
+        cache.put('late', Box((0, 0, 20), (10, 10, 25)), [2])
+        self.assertTrue(cache.invalidate([Box((5, 5, 22), (6, 6, 23))]) == 1)
+        self.assertTrue(cache.get('early') == [1] and cache.get('late') is None)
+        # A 2-d rectangle is unbounded in time.
+        cache.put('area', Rectangle((0, 0), (10, 10)), [3])
+        self.assertTrue(cache.invalidate([Box((5, 5, 50), (6, 6, 51))]) == 1)
+        self.assertTrue(cache.invalidate([Rectangle((1, 1), (2, 2))]) == 1 and len(cache) == 0)
+
+
+class CachedRTreeTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3, query_cache_size = 16)
+
+    def test_consistency(self):
+        rng = random.Random(9)
+        items = dict((obj_id, mbr) for mbr, obj_id, _ in random_items(500))
+        root = RTreeNode.bulk_load([(mbr, obj_id, None) for obj_id, mbr in items.items()],
+                                   self.props)
+        viewports = [Rectangle((x, y), (x + 100, y + 100))
+                     for x, y in [(0, 0), (450, 450), (800, 100), (100, 800)]]
+        for step in xrange(400):
+            query = rng.choice(viewports)
+            pairs = [(mbr, obj_id, None) for obj_id, mbr in items.items()]
+            self.assertTrue(sorted(root.search_range(query)) == brute_force_range(pairs, query))
+            op = rng.random()
+            obj_id = rng.choice(items.keys())
+            if op < 0.3:
+                new_id = max(items) + 1
+                items[new_id] = random_items(1, seed = step)[0][0]
+                root.insert(LeafEntry(items[new_id], new_id))
+            elif op < 0.4:
+                self.assertTrue(root.delete(LeafEntry(items.pop(obj_id), obj_id)))
+            elif op < 0.5:
+                mbr = items[obj_id]
+                items[obj_id] = Rectangle((mbr.left + 20, mbr.bottom), (mbr.right + 20, mbr.top))
+                self.assertTrue(root.update(obj_id, items[obj_id]))
+            elif op < 0.55:
+                ids = rng.sample(items.keys(), 5)
+                self.assertTrue(root.delete_batch([LeafEntry(items.pop(i), i) for i in ids]) == 5)
+        self.assertTrue(root.stats['cache_hits'] > root.stats['cache_misses'] > 4)
+        self.assertTrue(len(root.query_cache) <= 16)
+
+    def test_spatial_invalidation(self):
+        items = random_items(300)
+        root = RTreeNode.bulk_load(items, self.props)
+        query = Rectangle((0, 0), (200, 200))
+        ans = root.search_range(query)
+        self.assertTrue(root.search_range(query) == ans and root.stats['cache_hits'] == 1)
+        ans.append(-1)
+        self.assertTrue(root.search_range(query, limit = 3) == ans[:3])
+        root.insert(LeafEntry(Rectangle((500, 500), (510, 510)), 1000))
+        self.assertTrue(root.search_range(query) == ans[:-1] and root.stats['cache_hits'] == 3)
+        root.insert(LeafEntry(Rectangle((195, 195), (205, 205)), 1001))
+        self.assertTrue(sorted(root.search_range(query)) == sorted(ans[:-1] + [1001]))
+        self.assertTrue(root.stats['cache_misses'] == 2)
+        self.assertTrue(RTreeNode.bulk_load(items, Properties(max_capacity = 8)).query_cache is None)
+
+
+if __name__ == '__main__':
+    for case in [QueryCacheTests, CachedRTreeTests]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
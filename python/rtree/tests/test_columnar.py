@@ -0,0 +1,70 @@
+import unittest
+
+from rtree.columnar import ColumnarRTree
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.tests.test_rtree import brute_force_range
+from rtree.tests.test_rtree import random_items
+from rtree.types import Box
+from rtree.types import Rectangle
+
+
+class ColumnarRTreeTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+    queries = [Rectangle((0, 0), (100, 100)), Rectangle((250, 400), (600, 420)),
+               Rectangle((-10, -10), (-5, -5)), Rectangle((0, 0), (2000, 2000))]
+
+    def test_from_node(self):
+        items = random_items(500)
+        tree = ColumnarRTree.from_node(RTreeNode.bulk_load(items, self.props))
+        self.assertTrue(len(tree) == 500)
+        self.assertTrue(tree.num_pages > 1 and not tree.page_leaf[0])
+        for query in self.queries:
+            self.assertTrue(sorted(tree.search_range(query)) == brute_force_range(items, query))
+
+    def test_bulk_load(self):
+        items = random_items(500)
+        tree = ColumnarRTree.bulk_load(items, self.props)
+        other = ColumnarRTree.from_node(RTreeNode.bulk_load(items, self.props))
+        for name in ['left', 'right', 'bottom', 'top', 'mhv', 'ref', 
+                     'page_start', 'page_count', 'page_leaf']:
+            self.assertTrue((getattr(tree, name) == getattr(other, name)).all())
+        self.assertTrue(tree.mbr == RTreeNode.bulk_load(items, self.props).mbr)
+        empty = ColumnarRTree.bulk_load([], self.props)
+        self.assertTrue(len(empty) == 0 and empty.search_range(self.queries[-1]) == [])
+
+    def test_boxes(self):
+        items = [(Box((mbr.left, mbr.bottom, i % 10), (mbr.right, mbr.top, i % 10 + 1)), i, None)
+                 for mbr, i, _ in random_items(100)]
+        self.assertRaises(ValueError, ColumnarRTree.from_node, RTreeNode.bulk_load(items, self.props))
+        self.assertRaises(ValueError, ColumnarRTree.bulk_load, items, self.props)
+        planar = [(Box((mbr.left, mbr.bottom), (mbr.right, mbr.top)), i, None)
+                  for mbr, i, _ in random_items(100)]
+        tree = ColumnarRTree.from_node(RTreeNode.bulk_load(planar, self.props))
+        self.assertTrue(sorted(tree.search_range(self.queries[0])) == 
+                        brute_force_range(planar, self.queries[0]))
+
+    def test_search_point(self):
+        items = [(Rectangle((i, i), (i + 2, i + 2)), i, 'obj%d' % i) for i in xrange(50)]
+        tree = ColumnarRTree.bulk_load(items, self.props)
+        self.assertTrue(sorted(tree.search_point((10, 10))) == [8, 9, 10])
+        self.assertTrue(sorted(tree.search_point((10, 10), objects = True)) == 
+                        ['obj10', 'obj8', 'obj9'])
+
+    def test_search_batch(self):
+        items = random_items(500)
+        tree = ColumnarRTree.bulk_load(items, self.props)
+        ans = tree.search_range_batch(self.queries)
+        self.assertTrue([sorted(a) for a in ans] == 
+                        [brute_force_range(items, query) for query in self.queries])
+        points = [(10, 10), (500, 500), (-1, -1)]
+        ans = tree.search_point_batch(points)
+        self.assertTrue([sorted(a) for a in ans] == 
+                        [sorted(tree.search_point(point)) for point in points])
+        self.assertTrue(tree.search_range_batch([]) == [])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(ColumnarRTreeTests)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
@@ -0,0 +1,182 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from rtree.concurrent import ConcurrentRTree
+from rtree.concurrent import _SharedBuffer
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.storage import PageFile
+from rtree.storage import dump
+from rtree.storage import load
+from rtree.storage import write_page_file
+from rtree.tests.test_rtree import brute_force_range
+from rtree.tests.test_rtree import check_tree
+from rtree.tests.test_rtree import random_items
+from rtree.tests.test_rtree import walk_nodes
+from rtree.types import Rectangle
+
+
+def fingerprint(root):
+    """ Returns everything a reader of the tree rooted at root can observe.
+    """
+    pages = []
+    for node in walk_nodes(root):
+        entries = [(entry.mbr.coordinates, entry.mhv,
+                    id(entry.child) if node.num_children else entry.obj_id)
+                   for entry in node.page_entries]
+        buffered = [(entry.mbr.coordinates, entry.obj_id) for entry in node._buffer or []]
+        pages.append((id(node), node.mbr.coordinates, node.mhv, list(node.mhv_values),
+                      entries, buffered))
+    return pages
+
+
+class ConcurrentRTreeTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+
+    def test_snapshots(self):
+        for props in [self.props,
+                      Properties(max_capacity = 8, min_capacity = 3, leaf_index = True),
+                      Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 16)]:
+            rng = random.Random(5)
+            items = dict((obj_id, mbr) for mbr, obj_id, _ in random_items(300))
+            tree = ConcurrentRTree(RTreeNode.bulk_load([(mbr, obj_id, None)
+                                                        for obj_id, mbr in items.items()], props))
+            snapshots = []
+            for step in xrange(600):
+                if step % 60 == 0:
+                    snapshots.append((tree.snapshot(), fingerprint(tree.snapshot())))
+                op = rng.random()
+                obj_id = rng.choice(items.keys())
+                if op < 0.55:
+                    new_id = max(items) + 1
+                    items[new_id] = random_items(1, seed = step)[0][0]
+                    tree.insert(LeafEntry(items[new_id], new_id))
+                elif op < 0.65:
+                    self.assertTrue(tree.delete(LeafEntry(items.pop(obj_id), obj_id)))
+                elif op < 0.95:
+                    mbr = items[obj_id]
+                    items[obj_id] = Rectangle((mbr.left + 3, mbr.bottom - 2), (mbr.right + 3, mbr.top))
+                    self.assertTrue(tree.update(obj_id, items[obj_id]))
+                else:
+                    ids = rng.sample(items.keys(), 10)
+                    deleted = [LeafEntry(items.pop(i), i) for i in ids]
+                    self.assertTrue(tree.delete_batch(deleted) == 10)
+            for root, pages in snapshots:
+                self.assertTrue(fingerprint(root) == pages)
+            tree.flush()
+            check_tree(self, tree.root)
+            pairs = [(mbr, obj_id, None) for obj_id, mbr in items.items()]
+            query = Rectangle((100, 100), (700, 800))
+            self.assertTrue(sorted(tree.search_range(query)) == brute_force_range(pairs, query))
+            self.assertTrue(all(tree.root.stats[key] == value
+                                for key, value in tree.root.census().items()))
+
+    def test_shared_buffer(self):
+        buffered = _SharedBuffer([1])
+        first, second = buffered.appended(2), buffered.appended(3)
+        self.assertTrue(list(buffered) == [1] and list(first) == [1, 2] and list(second) == [1, 3])
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 1000)
+        tree = ConcurrentRTree(RTreeNode.bulk_load(random_items(50, seed = 3), props))
+        items = random_items(600)
+        snapshots = []
+        for mbr, obj_id, obj in items:
+            if obj_id % 100 == 0:
+                snapshots.append(tree.snapshot())
+            tree.insert(LeafEntry(mbr, obj_id + 50, obj))
+        # Successive inserts extend one list of buffered entries.
+        self.assertTrue(tree.root._buffer._entries is snapshots[-1]._buffer._entries)
+        self.assertTrue(tree.delete(LeafEntry(items[0][0], 50)))
+        tree.insert(LeafEntry(items[0][0], 50))
+        for i, root in enumerate(snapshots):
+            self.assertTrue(root.num_buffered == 100*i)
+            self.assertTrue(sorted(entry.obj_id for entry in root._buffer or []) ==
+                            range(50, 50 + 100*i))
+        self.assertTrue(tree.root.num_buffered == 600)
+        check_tree(self, tree.root)
+
+    def test_persistence(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 50)
+        items = random_items(240)
+        tree = ConcurrentRTree(RTreeNode.bulk_load(items[:200], props))
+        for mbr, obj_id, obj in items[200:230]:
+            tree.insert(LeafEntry(mbr, obj_id, obj))
+        old = tree.snapshot()
+        for mbr, obj_id, obj in items[230:]:
+            tree.insert(LeafEntry(mbr, obj_id, obj))
+        query = Rectangle((-1, -1), (2000, 2000))
+        # The storage functions can't flush a snapshot's buffer into shared pages.
+        self.assertRaises(ValueError, dump, old, io.BytesIO())
+        self.assertRaises(ValueError, dump, tree.snapshot(), io.BytesIO())
+        self.assertRaises(ValueError, old.flush)
+        self.assertTrue(sorted(tree.search_range(query)) == range(240))
+        self.assertTrue(sorted(old.search_range(query)) == range(230))
+        f = io.BytesIO()
+        tree.dump(f)
+        f.seek(0)
+        self.assertTrue(sorted(load(f).search_range(query)) == range(240))
+        self.assertTrue(tree.root.num_buffered == 0 and sorted(old.search_range(query)) == range(230))
+        self.assertTrue(sorted(tree.to_columnar().search_range(query)) == range(240))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'tree.pages')
+            tree.write_page_file(path)
+            with PageFile(path) as pages:
+                self.assertTrue(sorted(pages.search_range(query)) == range(240))
+        finally:
+            shutil.rmtree(tmpdir)
+        # Flushed snapshots have nothing left to merge, so they can be written.
+        write_page_file(tree.snapshot(), os.devnull)
+        other = ConcurrentRTree(props = props)
+        other.insert(LeafEntry(Rectangle((0, 0), (2000, 2000)), 0))
+        self.assertTrue(sorted(pair[0] for pair in tree.spatial_join(other)) == range(240))
+        self.assertTrue(other.root.num_buffered == 0 and len(tree.spatial_join(tree)) >= 240)
+        check_tree(self, tree.root)
+
+    def test_readers(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 32)
+        tree = ConcurrentRTree(props = props)
+        items = random_items(1500)
+        query = Rectangle((-1, -1), (2000, 2000))
+        errors = []
+
+        def read():
+            seen = 0
+            while seen < len(items):
+                ans = sorted(tree.search_range(query))
+                # Items are inserted in obj_id order, so a snapshot holds a prefix.
+                if ans != range(len(ans)) or len(ans) < seen:
+                    errors.append(ans)
+                    return
+                seen = len(ans)
+                tree.search_k_nearest(3, (500, 500))
+
+        readers = [threading.Thread(target = read) for i in xrange(4)]
+        for reader in readers:
+            reader.start()
+        for mbr, obj_id, obj in items:
+            tree.insert(LeafEntry(mbr, obj_id, obj))
+        tree.flush()
+        for reader in readers:
+            reader.join()
+        self.assertTrue(errors == [])
+        check_tree(self, tree.root)
+        self.assertTrue(sorted(tree.search_range(query)) == range(len(items)))
+        progressive = tree.progressive_range(query)
+        ans = progressive.fetch(max_nodes = 5)
+        for mbr, obj_id, obj in random_items(200, seed = 1):
+            tree.insert(LeafEntry(mbr, obj_id + len(items), obj))
+        while not progressive.complete:
+            ans.extend(progressive.fetch(max_nodes = 5))
+        self.assertTrue(sorted(ans) == range(len(items)))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(ConcurrentRTreeTests)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
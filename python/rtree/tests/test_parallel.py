@@ -0,0 +1,103 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from rtree.parallel import ParallelQueryExecutor
+from rtree.parallel import parallel_bulk_load
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.storage import PageFile
+from rtree.storage import write_page_file
+from rtree.tests.test_rtree import brute_force_range
+from rtree.tests.test_rtree import random_items
+from rtree.types import Box
+from rtree.types import Rectangle
+
+
+class ParallelQueryExecutorTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tree.pages')
+        self.items = random_items(1000)
+        self.root = RTreeNode.bulk_load(self.items, self.props)
+        write_page_file(self.root, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_search_range_batch(self):
+        rng = random.Random(2)
+        queries = []
+        for i in xrange(300):
+            x, y = rng.uniform(0, 900), rng.uniform(0, 900)
+            queries.append(Rectangle((x, y), (x + rng.uniform(0, 100), y + rng.uniform(0, 100))))
+        with ParallelQueryExecutor(self.path, processes = 2, chunk_size = 64) as executor:
+            results = executor.search_range_batch(queries)
+            self.assertTrue(len(results) == 300)
+            for query, result in zip(queries, results):
+                self.assertTrue(result.dtype.kind == 'i')
+                self.assertTrue(sorted(result.tolist()) == brute_force_range(self.items, query))
+            self.assertTrue(executor.search_range_batch([]) == [])
+
+    def test_search_point_batch(self):
+        points = [(i*10.5, i*9.5) for i in xrange(100)]
+        with ParallelQueryExecutor(self.path, processes = 2, chunk_size = 16) as executor:
+            pairs = list(executor.iter_point_batch(points))
+        self.assertTrue(sorted(index for index, _ in pairs) == range(100))
+        for index, result in pairs:
+            point = points[index]
+            self.assertTrue(sorted(result.tolist()) == sorted(self.root.search_point(point)))
+
+    def test_search_k_nearest_batch(self):
+        points = [(i*10.5, 1000 - i*9.5) for i in xrange(50)]
+        with PageFile(self.path) as pages:
+            self.assertTrue(pages.search_k_nearest(5, (500, 500)) ==
+                            self.root.search_k_nearest(5, (500, 500)))
+        with ParallelQueryExecutor(self.path, processes = 2, chunk_size = 8) as executor:
+            results = executor.search_k_nearest_batch(5, points)
+            near = executor.search_k_nearest_batch(50, points[:3], max_distance = 20)
+        for point, result in zip(points, results):
+            self.assertTrue(result.tolist() == self.root.search_k_nearest(5, point))
+        for point, result in zip(points, near):
+            self.assertTrue(result.tolist() == self.root.search_k_nearest(50, point, max_distance = 20))
+
+
+class ParallelBulkLoadTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+
+    def levels(self, root):
+        level = [root]
+        while level:
+            yield [(entry.mhv, entry.mbr, getattr(entry, 'obj_id', None))
+                   for node in level for entry in node.page_entries]
+            level = [entry.child for node in level if not node.is_leaf_node
+                     for entry in node.page_entries]
+
+    def test_parallel_bulk_load(self):
+        # Coarse coordinates give many equal keys, which must keep input order.
+        items = []
+        for mbr, obj_id, _ in random_items(1000):
+            x, y = mbr.left//50*50, mbr.bottom//50*50
+            items.append((Rectangle((x, y), (x + 5, y + 5)), obj_id, 'obj%d' % obj_id))
+        expected = RTreeNode.bulk_load(items, self.props)
+        for processes in [1, 2, 3]:
+            root = parallel_bulk_load(items, self.props, processes = processes)
+            self.assertTrue(list(self.levels(root)) == list(self.levels(expected)))
+            self.assertTrue(root.stats['leaf_nodes'] == expected.stats['leaf_nodes'])
+        fitted = parallel_bulk_load(items, self.props, fit_extent = True, processes = 2)
+        self.assertTrue(list(self.levels(fitted)) == 
+                        list(self.levels(RTreeNode.bulk_load(items, self.props, fit_extent = True))))
+        self.assertTrue(parallel_bulk_load([], self.props).page_entries == [])
+        boxes = [(Box((0, 0, 0), (1, 1, 1)), 0, None)]
+        self.assertRaises(ValueError, parallel_bulk_load, boxes, self.props, processes = 1)
+
+
+if __name__ == '__main__':
+    for case in [ParallelQueryExecutorTests, ParallelBulkLoadTests]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
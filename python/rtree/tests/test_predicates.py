@@ -0,0 +1,74 @@
+import random
+import unittest
+
+from rtree.predicates import all_of
+from rtree.predicates import contains
+from rtree.predicates import contains_point
+from rtree.predicates import intersects
+from rtree.predicates import obj_matches
+from rtree.predicates import within
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.tests.test_rtree import random_items
+from rtree.types import Rectangle
+
+
+class PredicateTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 16)
+
+    def setUp(self):
+        rng = random.Random(6)
+        self.items = [(mbr, obj_id, {'kind': rng.choice(['road', 'river', 'park'])})
+                      for mbr, obj_id, _ in random_items(800, size = 60)]
+        self.root = RTreeNode.bulk_load(self.items[:700], self.props)
+        for mbr, obj_id, obj in self.items[700:]:
+            self.root.insert(LeafEntry(mbr, obj_id, obj))
+        self.assertTrue(self.root.num_buffered > 0)
+
+    def check(self, predicate, expected):
+        ans = self.root.search_where(*predicate)
+        self.assertTrue(sorted(ans) == sorted(obj_id for mbr, obj_id, obj in self.items
+                                              if expected(mbr, obj)))
+        return ans
+
+    def test_spatial_predicates(self):
+        query = Rectangle((200, 300), (500, 450))
+        ans = self.check(intersects(query), lambda mbr, obj: mbr.intersects_rect(query))
+        self.assertTrue(ans == self.root.search_range(query))
+        self.check(within(query), lambda mbr, obj: query.contains_rect(mbr))
+        self.check(within(Rectangle((0, 0), (1000, 1000))), lambda mbr, obj: mbr.right <= 1000 and 
+                   mbr.top <= 1000)
+        small = Rectangle((410, 410), (412, 413))
+        self.check(contains(small), lambda mbr, obj: mbr.contains_rect(small))
+        ans = self.check(contains_point((410, 410)), lambda mbr, obj: mbr.contains_point((410, 410)))
+        self.assertTrue(ans == self.root.search_point((410, 410)))
+
+    def test_object_filters(self):
+        query = Rectangle((100, 100), (700, 600))
+        is_road = lambda obj: obj['kind'] == 'road'
+        self.check(obj_matches(is_road), lambda mbr, obj: is_road(obj))
+        self.check(all_of(within(query), obj_matches(is_road)),
+                   lambda mbr, obj: is_road(obj) and query.contains_rect(mbr))
+        self.check(all_of(intersects(query), contains_point((300, 300)), obj_matches(is_road)),
+                   lambda mbr, obj: is_road(obj) and mbr.contains_point((300, 300)))
+        self.check(all_of(), lambda mbr, obj: True)
+        objs = self.root.search_where(*obj_matches(is_road), objects = True, limit = 5)
+        self.assertTrue(len(objs) == 5 and all(is_road(obj) for obj in objs))
+
+    def test_pruning(self):
+        visited = []
+        self.root.stats.add_hook(visited.append)
+        far = Rectangle((5000, 5000), (5001, 5001))
+        self.assertTrue(self.root.search_where(*all_of(within(far), obj_matches(bool))) == [])
+        self.root.search_where(entry_pred = lambda entry: False)
+        self.root.stats.remove_hook(visited.append)
+        self.assertTrue(visited[0]['nodes_visited'] == 1)
+        self.assertTrue(visited[1]['nodes_visited'] == self.root.stats['leaf_nodes'] + 
+                        self.root.stats['internal_nodes'])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(PredicateTests)
+    unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
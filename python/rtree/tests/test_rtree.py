@@ -1,11 +1,67 @@
+import itertools
+import random
 import unittest
+import warnings
 
-from rtree.types import LeafEntry
-from rtree.types import PointerEntry
+from rtree.rtree import LeafEntry
+from rtree.rtree import PointerEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.types import Box
 from rtree.types import Rectangle
 
 
+def random_items(n, seed = 0, extent = 1000, size = 10):
+    rng = random.Random(seed)
+    items = []
+    for i in xrange(n):
+        x, y = rng.randint(0, extent), rng.randint(0, extent)
+        w, h = rng.randint(1, size), rng.randint(1, size)
+        items.append((Rectangle((x, y), (x + w, y + h)), i, None))
+    return items
+
+
+def brute_force_range(items, query):
+    return sorted(obj_id for mbr, obj_id, _ in items if mbr.intersects_rect(query))
+
+
+def walk_nodes(node):
+    yield node
+    if not node.is_leaf_node:
+        for entry in node.page_entries:
+            for child in walk_nodes(entry.child):
+                yield child
+
+
+def check_tree(test, node):
+    """ Checks page capacities, key order and that the cached fields of every
+    page match its entries.
+    """
+    test.assertTrue(len(node.page_entries) <= node.max_capacity)
+    test.assertTrue(node.mhv_values == sorted(node.mhv_values))
+    test.assertTrue(node.mhv_values == [entry.mhv for entry in node.page_entries])
+    mbrs = [entry.mbr for entry in node.page_entries]
+    if mbrs:
+        test.assertTrue(node.mbr == type(mbrs[0]).merge_by_mbr(mbrs))
+    if not node.is_root:
+        entry = node.get_parent_entry()
+        test.assertTrue(entry.mbr == node.mbr and entry.mhv == node.mhv)
+    if not node.is_leaf_node:
+        for entry in node.page_entries:
+            test.assertTrue(entry.child.parent is node)
+            check_tree(test, entry.child)
+
+
+def build_tree(items, props):
+    root = RTreeNode(is_root = True, props = props)
+    for mbr, obj_id, obj in items:
+        root.insert(LeafEntry(mbr, obj_id, obj))
+    return root
+
+
 class RTreeTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+
     def test_pointer_entry(self):
         self.assertTrue(False)
 
@@ -16,43 +72,541 @@ class RTreeTests(unittest.TestCase):
         self.assertTrue(False)
         
     def test_properties(self):
-        self.assertTrue(False)
+        props = Properties(max_capacity = 8, hilbert_resolution = 16, hilbert_cache_size = 64)
+        self.assertTrue(props['min_capacity'] == 0 and props['fill_factor'] == 1.0)
+        self.assertTrue(props.quantizer is props.quantizer)
+        self.assertTrue(props.quantizer.resolution == 16 and props.quantizer.cache_size == 64)
+        root = RTreeNode(is_root = True, props = props)
+        self.assertTrue(root.props is props and root.max_capacity == 8)
 
     def test_hilbert_access(self):
-        self.assertTrue(False)
+        rect = Rectangle((10, 10), (15, 15))
+        root = RTreeNode(is_root = True, props = self.props)
+        self.assertTrue(root.hilbert_key(rect) == rect.hilbert_value)
+        props = Properties(max_capacity = 8, min_capacity = 3, hilbert_scale = 0.1)
+        root = RTreeNode(is_root = True, props = props)
+        entry = LeafEntry(rect, 1)
+        root.insert(entry)
+        self.assertTrue(entry.mhv == Rectangle((1, 1), (1.5, 1.5)).hilbert_value)
+        items = random_items(100)
+        bulk = RTreeNode.bulk_load(items, props)
+        self.assertTrue(sorted(entry.mhv for entry in bulk.iter()) == 
+                        sorted(root.hilbert_key(mbr) for mbr, _, _ in items))
+
+    def test_world_extent(self):
+        rng = random.Random(3)
+        items = []
+        for i in xrange(500):
+            lon, lat = rng.uniform(-10, -9), rng.uniform(51, 52)
+            items.append((Rectangle((lon, lat), (lon + 1e-4, lat + 1e-4)), i, None))
+        flat = RTreeNode.bulk_load(items, self.props)
+        self.assertTrue(len(set(entry.mhv for entry in flat.iter())) == 1)
+        fitted = RTreeNode.bulk_load(items, self.props, fit_extent = True)
+        self.assertTrue(self.props['world_extent'] is None)
+        extent = fitted.props['world_extent']
+        self.assertTrue(extent.left >= -10 and extent.right <= -9 + 1e-4)
+        self.assertTrue(len(set(entry.mhv for entry in fitted.iter())) == 500)
+        check_tree(self, fitted)
+        query = Rectangle((-9.6, 51.2), (-9.5, 51.4))
+        self.assertTrue(sorted(fitted.search_range(query)) == brute_force_range(items, query))
+        self.assertTrue(len(fitted.search_range(query)) < len(items))
+
+        props = Properties(max_capacity = 8, min_capacity = 3, hilbert_resolution = 4,
+                           world_extent = Rectangle((-180, -90), (180, 90)))
+        self.assertTrue(props.quantizer.cell((-180, -90)) == (0, 0))
+        self.assertTrue(props.quantizer.cell((180, 90)) == (15, 15))
+        self.assertTrue(props.quantizer.cell((0, 0)) == (8, 8))
+        quantizer = props.quantizer
+        props['hilbert_resolution'] = 8
+        self.assertTrue(props.quantizer is not quantizer)
+        self.assertTrue(props.quantizer.cell((0, 0)) == (128, 128))
+        root = RTreeNode(is_root = True, props = props)
+        for mbr, obj_id, obj in items:
+            root.insert(LeafEntry(mbr, obj_id, obj))
+        check_tree(self, root)
+        self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
 
     def test_iter(self):
-        self.assertTrue(False)
+        items = random_items(300)
+        root = RTreeNode.bulk_load(items, self.props)
+        entries = list(root.iter())
+        self.assertTrue([entry.obj_id for entry in entries] == 
+                        [entry.obj_id for entry in sorted(entries, key = lambda e: e.mhv)])
+        self.assertTrue(sorted(entry.obj_id for entry in entries) == range(300))
+        query = Rectangle((0, 0), (300, 300))
+        ans = root.iter(lambda entry: entry.mbr.intersects_rect(query))
+        self.assertTrue(sorted(e.obj_id for e in ans) == brute_force_range(items, query))
+
+    def test_iter_range(self):
+        items = [(mbr, obj_id, 'obj%d' % obj_id) for mbr, obj_id, _ in random_items(300)]
+        root = RTreeNode.bulk_load(items, self.props)
+        query = Rectangle((0, 0), (500, 500))
+        expected = brute_force_range(items, query)
+        stream = root.iter_range(query)
+        self.assertTrue(next(stream) in expected)
+        self.assertTrue(len(root.search_range(query, limit = 5)) == 5)
+        self.assertTrue(sorted(root.search_range(query, objects = True)) == 
+                        sorted('obj%d' % obj_id for obj_id in expected))
+
+    def test_search_batch(self):
+        items = [(mbr, obj_id, 'obj%d' % obj_id) for mbr, obj_id, _ in random_items(400)]
+        root = build_tree(items, self.props)
+        queries = [Rectangle((0, 0), (100, 100)), Rectangle((250, 400), (600, 420)),
+                   Rectangle((-10, -10), (-5, -5))]
+        ans = root.search_range_batch(queries)
+        self.assertTrue([sorted(a) for a in ans] == 
+                        [brute_force_range(items, query) for query in queries])
+        ans = root.search_range_batch(queries, objects = True)
+        self.assertTrue([sorted(a) for a in ans] == 
+                        [sorted(root.search_range(query, objects = True)) for query in queries])
+        points = [(10, 10), (500, 500), (-1, -1)]
+        ans = root.search_point_batch(points)
+        self.assertTrue([sorted(a) for a in ans] == 
+                        [sorted(root.search_point(point)) for point in points])
+
+    def test_spatial_join(self):
+        items_a = random_items(300, seed = 1, size = 40)
+        items_b = random_items(100, seed = 2, size = 40)
+        expected = sorted((ida, idb) for ma, ida, _ in items_a for mb, idb, _ in items_b 
+                          if ma.intersects_rect(mb))
+        tree_a = build_tree(items_a, self.props)
+        tree_b = build_tree(items_b, self.props)
+        self.assertTrue(sorted(tree_a.spatial_join(tree_b)) == expected)
+        self.assertTrue(sorted(tree_a.spatial_join(tree_b, plane_sweep = False)) == expected)
+        swapped = sorted((idb, ida) for ida, idb in expected)
+        self.assertTrue(sorted(tree_b.spatial_join(tree_a)) == swapped)
+        small = build_tree(items_b[:5], self.props)
+        self.assertTrue(sorted(tree_a.spatial_join(small)) == 
+                        [pair for pair in expected if pair[1] in range(5)])
+
+    def test_statistics(self):
+        items = random_items(600)
+        root = build_tree(items, self.props)
+        stats = root.stats
+        census = root.census()
+        self.assertTrue(all(stats[key] == value for key, value in census.items()))
+        self.assertTrue(census['tree_height'] > 2)
+        self.assertTrue(stats['overflow'] >= stats['split'] > 0)
+        for mbr, obj_id, obj in items[:550]:
+            root.delete(LeafEntry(mbr, obj_id, obj))
+        self.assertTrue(stats['condense'] > 0)
+        self.assertTrue(all(stats[key] == value for key, value in root.census().items()))
+        self.assertTrue(stats['queries'] == 0)
+        self.assertTrue(RTreeNode(is_root = True, props = self.props).stats['leaf_nodes'] == 1)
+
+    def test_statistics_hooks(self):
+        root = RTreeNode.bulk_load(random_items(300), self.props)
+        reports = []
+        root.stats.add_hook(reports.append)
+        query = Rectangle((0, 0), (300, 300))
+        ans = root.search_range(query)
+        root.search_k_nearest(3, (10, 10))
+        root.search_range_batch([query, query])
+        self.assertTrue([report['query'] for report in reports] == ['range', 'nearest', 'batch'])
+        self.assertTrue(reports[0]['results'] == len(ans))
+        self.assertTrue(reports[0]['nodes_visited'] > 1)
+        self.assertTrue(0 < reports[0]['pruning_ratio'] < 1)
+        self.assertTrue(reports[2]['results'] == 2*len(ans))
+        self.assertTrue(root.stats['queries'] == 3 and root.stats['results'] == 3*len(ans) + 3)
+        root.stats.sample_every = 2
+        for i in xrange(4):
+            root.search_point((10, 10))
+        self.assertTrue(len(reports) == 5)
+        root.stats.remove_hook(reports.append)
+        root.search_point((10, 10))
+        self.assertTrue(len(reports) == 5)
+
+    def test_search_point(self):
+        items = [(Rectangle((i, i), (i + 2, i + 2)), i, None) for i in xrange(50)]
+        root = build_tree(items, self.props)
+        self.assertTrue(sorted(root.search_point((10, 10))) == [8, 9, 10])
+        self.assertTrue(root.search_point((-1, 10)) == [])
+        self.assertTrue(root.contains_point((10, 10)) and not root.contains_point((-1, 10)))
 
     def test_search_range(self):
-        self.assertTrue(False)
+        items = random_items(500)
+        root = RTreeNode.bulk_load(items, self.props)
+        for query in [Rectangle((0, 0), (100, 100)), Rectangle((250, 400), (600, 420)),
+                      Rectangle((-10, -10), (-5, -5))]:
+            ans = sorted(root.search_range(query))
+            self.assertTrue(ans == brute_force_range(items, query))
+
+    def test_bulk_load(self):
+        items = random_items(1000)
+        root = RTreeNode.bulk_load(items, self.props)
+        self.assertTrue(root.is_root)
+        leaves = [node for node in walk_nodes(root) if node.is_leaf_node]
+        self.assertTrue(sum(len(leaf.page_entries) for leaf in leaves) == 1000)
+        keys = [entry.mhv for leaf in leaves for entry in leaf.page_entries]
+        self.assertTrue(keys == sorted(keys))
+        for node in walk_nodes(root):
+            self.assertTrue(len(node.page_entries) <= self.props['max_capacity'])
+            if node is not root:
+                self.assertTrue(len(node.page_entries) >= self.props['min_capacity'])
+                entry = node.get_parent_entry()
+                self.assertTrue(entry.mbr == node.mbr)
+                self.assertTrue(entry.mhv == node.mhv)
+
+    def test_bulk_load_fill_factor(self):
+        props = Properties(max_capacity = 10, min_capacity = 4, fill_factor = 0.5)
+        root = RTreeNode.bulk_load(random_items(100), props)
+        leaves = [node for node in walk_nodes(root) if node.is_leaf_node]
+        self.assertTrue(len(leaves) == 20)
+        self.assertTrue(RTreeNode.bulk_load([], props).page_entries == [])
         
     def test_adjust_tree(self):
-        self.assertTrue(False)
+        props = Properties(max_capacity = 8, min_capacity = 3, fill_factor = 0.5)
+        root = RTreeNode.bulk_load(random_items(200), props)
+        leaf = root.choose_leaf(LeafEntry(Rectangle((0, 0), (1, 1)), -1))
+        leaf.insert_entry(LeafEntry(Rectangle((-50, -50), (-40, -40)), -1, mhv = 0))
+        self.assertTrue(leaf.get_parent_entry().mbr != leaf.mbr)
+        leaf.adjust_tree()
+        check_tree(self, root)
+        self.assertTrue(root.mbr.left == -50 and root.mbr.bottom == -50)
+        # A child missing from its parent's page fails rather than overwriting an entry.
+        stray = leaf._spawn([LeafEntry(Rectangle((0, 0), (1, 1)), -2, mhv = 0)])
+        stray.parent = leaf.parent
+        page = [(entry.mbr, entry.mhv) for entry in leaf.parent.page_entries]
+        self.assertRaises(ValueError, stray.adjust_tree)
+        self.assertTrue([(entry.mbr, entry.mhv) for entry in leaf.parent.page_entries] == page)
         
     def test_get_parent_entry(self):
-        self.assertTrue(False)
+        root = RTreeNode.bulk_load(random_items(100), self.props)
+        for entry in root.page_entries:
+            self.assertTrue(entry.child.get_parent_entry() is entry)
         
     def test_handle_overflow(self):
-        self.assertTrue(False)
+        root = RTreeNode(is_root = True, props = self.props)
+        for mbr, obj_id, obj in random_items(9):
+            root.insert(LeafEntry(mbr, obj_id, obj))
+        self.assertFalse(root.is_leaf_node)
+        self.assertTrue([len(entry.child.page_entries) for entry in root.page_entries] == [5, 4])
+        check_tree(self, root)
 
     def test_handle_shift(self):
-        self.assertTrue(False)
+        props = Properties(max_capacity = 4, min_capacity = 1)
+        entries = [LeafEntry(Rectangle((i, i), (i + 1, i + 1)), i, mhv = i) for i in xrange(6)]
+        root = RTreeNode.bulk_load([], props)
+        pages = [RTreeNode(props = props, page_entries = page) for page in [entries[:4], entries[4:]]]
+        root._set_entries([PointerEntry(page.mbr, page) for page in pages])
+        leaf = root.page_entries[0].child
+        self.assertTrue(leaf.handle_overflow(LeafEntry(Rectangle((0, 0), (1, 1)), 7, mhv = 3)) is None)
+        leaf.adjust_tree(cohort_changed = True)
+        self.assertTrue([len(entry.child.page_entries) for entry in root.page_entries] == [4, 3])
+        check_tree(self, root)
 
     def test_handle_split(self):
-        self.assertTrue(False)
+        props = Properties(max_capacity = 4, min_capacity = 1)
+        entries = [LeafEntry(Rectangle((i, i), (i + 1, i + 1)), i, mhv = i) for i in xrange(8)]
+        root = RTreeNode.bulk_load([], props)
+        pages = [RTreeNode(props = props, page_entries = page) for page in [entries[:4], entries[4:]]]
+        root._set_entries([PointerEntry(page.mbr, page) for page in pages])
+        leaf = root.page_entries[0].child
+        new_node = leaf.handle_overflow(LeafEntry(Rectangle((0, 0), (1, 1)), 8, mhv = 3))
+        self.assertTrue(new_node is not None and new_node.mhv == 7)
+        leaf.adjust_tree(new_node, cohort_changed = True)
+        self.assertTrue([len(entry.child.page_entries) for entry in root.page_entries] == [3, 3, 3])
+        check_tree(self, root)
 
     def test_find_leaf(self):
-        self.assertTrue(False)
+        items = random_items(300)
+        root = RTreeNode.bulk_load(items, self.props)
+        for mbr, obj_id, obj in items[:50]:
+            leaf = root.find_leaf(LeafEntry(mbr, obj_id, obj))
+            self.assertTrue(leaf.is_leaf_node and any(entry.mbr == mbr for entry in leaf.page_entries))
+        self.assertTrue(root.find_leaf(LeafEntry(Rectangle((-9, -9), (-8, -8)), -1)) is None)
 
     def test_insert(self):
-        self.assertTrue(False)
+        items = random_items(1000)
+        root = build_tree(items, self.props)
+        check_tree(self, root)
+        for query in [Rectangle((0, 0), (100, 100)), Rectangle((250, 400), (600, 420))]:
+            self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
         
+    def test_insert_buffer(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 50)
+        items = random_items(1000)
+        root = RTreeNode(is_root = True, props = props)
+        query = Rectangle((200, 200), (500, 500))
+        for i, (mbr, obj_id, obj) in enumerate(items):
+            root.insert(LeafEntry(mbr, obj_id, obj))
+            self.assertTrue(root.num_buffered == (i + 1) % 50)
+            if i % 97 == 0:
+                self.assertTrue(sorted(root.search_range(query)) == 
+                                brute_force_range(items[:i + 1], query))
+        root.insert(LeafEntry(Rectangle((300, 300), (301, 301)), 1000))
+        self.assertTrue(root.num_buffered == 1)
+        self.assertTrue(1000 in root.search_point((300.5, 300.5)))
+        self.assertTrue(1000 in root.search_range_batch([query, query])[1])
+        self.assertTrue(root.search_k_nearest(1, (300.5, 300.5)) == [1000])
+        self.assertTrue(root.update(1000, Rectangle((-20, -20), (-10, -10))))
+        self.assertTrue(root.num_buffered == 1 and root.search_point((-15, -15)) == [1000])
+        root.delete(LeafEntry(Rectangle((-20, -20), (-10, -10)), 1000))
+        self.assertTrue(root.num_buffered == 0)
+        self.assertTrue(sorted(entry.obj_id for entry in root.iter()) == range(1000))
+        check_tree(self, root)
+        stats = root.stats
+        self.assertTrue(stats['flush'] == 20)
+        self.assertTrue(all(stats[key] == value for key, value in root.census().items()))
+        self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
+
+    def test_flush(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 10**6)
+        items = random_items(500)
+        root = RTreeNode.bulk_load(items[:100], props)
+        for mbr, obj_id, obj in items[100:]:
+            root.insert(LeafEntry(mbr, obj_id, obj))
+        self.assertTrue(root.num_buffered == 400 and root.stats['flush'] == 0)
+        root.flush()
+        self.assertTrue(root.num_buffered == 0)
+        check_tree(self, root)
+        self.assertTrue(all(root.stats[key] == value for key, value in root.census().items()))
+        query = Rectangle((100, 100), (600, 400))
+        self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
+        root.flush()
+        self.assertTrue(root.stats['flush'] == 1)
+
     def test_delete(self):
-        self.assertTrue(False)
+        items = random_items(500)
+        root = build_tree(items, self.props)
+        for mbr, obj_id, obj in items[:400]:
+            self.assertTrue(root.delete(LeafEntry(mbr, obj_id, obj)))
+        self.assertFalse(root.delete(LeafEntry(items[0][0], 0)))
+        check_tree(self, root)
+        query = Rectangle((0, 0), (1000, 1000))
+        self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items[400:], query))
+        self.assertTrue(all(root.stats[key] == value for key, value in root.census().items()))
+        leaves = [node for node in walk_nodes(root) if node.is_leaf_node]
+        self.assertTrue(sum(len(leaf.page_entries) >= 3 for leaf in leaves) >= len(leaves) - 2)
+        for mbr, obj_id, obj in items[400:]:
+            root.delete(LeafEntry(mbr, obj_id, obj))
+        self.assertTrue(root.page_entries == [] and root.is_root)
+        self.assertTrue(all(root.stats[key] == value for key, value in root.census().items()))
+
+    def test_delete_same_mbr(self):
+        rect = Rectangle((5, 5), (6, 6))
+        items = random_items(100) + [(rect, 100 + i, None) for i in xrange(20)]
+        root = build_tree(items, self.props)
+        self.assertTrue(root.delete(LeafEntry(rect, 110)))
+        self.assertFalse(root.delete(LeafEntry(rect, 110)))
+        self.assertTrue(sorted(root.search_point((5.5, 5.5))) == 
+                        [100 + i for i in xrange(20) if i != 10])
+
+    def test_delete_batch(self):
+        items = random_items(2000)
+        root = RTreeNode.bulk_load(items, self.props)
+        expired = [LeafEntry(mbr, obj_id, obj) for mbr, obj_id, obj in items if obj_id % 5]
+        expired.append(LeafEntry(Rectangle((-9, -9), (-8, -8)), -1))
+        self.assertTrue(root.delete_batch(expired) == 1600)
+        check_tree(self, root)
+        self.assertTrue(all(root.stats[key] == value for key, value in root.census().items()))
+        self.assertTrue(root.stats['leaf_nodes'] <= 400//3 + 1)
+        query = Rectangle((100, 100), (700, 700))
+        self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items[::5], query))
+        self.assertTrue(root.delete_batch(LeafEntry(mbr, obj_id) for mbr, obj_id, _ in items) == 400)
+        self.assertTrue(root.page_entries == [] and root.stats['tree_height'] == 1)
+
+    def test_leaf_index(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, leaf_index = True)
+        items = random_items(600)
+        for root in [build_tree(items, props), RTreeNode.bulk_load(items, props)]:
+            self.assertTrue(len(root.leaf_index) == 600)
+            root.delete_batch(LeafEntry(mbr, obj_id) for mbr, obj_id, _ in items[:200])
+            for mbr, obj_id, obj in items[200:300]:
+                root.delete(LeafEntry(mbr, obj_id, obj))
+            self.assertTrue(sorted(root.leaf_index) == range(300, 600))
+            for node in walk_nodes(root):
+                for entry in node.page_entries if node.is_leaf_node else []:
+                    self.assertTrue(root.leaf_index[entry.obj_id] is node)
+            check_tree(self, root)
     
+    def test_update(self):
+        rng = random.Random(7)
+        for props in [self.props, Properties(max_capacity = 8, min_capacity = 3, leaf_index = True)]:
+            items = random_items(400)
+            root = build_tree(items, props)
+            leaves = root.stats['leaf_nodes']
+            for step in xrange(1000):
+                i = rng.randrange(len(items))
+                mbr, obj_id, obj = items[i]
+                dx, dy = rng.uniform(-5, 5), rng.uniform(-5, 5)
+                if step % 10 == 0:
+                    dx, dy = rng.uniform(-500, 500), rng.uniform(-500, 500)
+                new_mbr = Rectangle((mbr.left + dx, mbr.bottom + dy), (mbr.right + dx, mbr.top + dy))
+                self.assertTrue(root.update(obj_id, new_mbr))
+                items[i] = (new_mbr, obj_id, obj)
+            self.assertFalse(root.update(-1, new_mbr))
+            check_tree(self, root)
+            self.assertTrue(sorted(entry.obj_id for entry in root.iter()) == range(400))
+            for query in [Rectangle((0, 0), (300, 300)), Rectangle((-200, 500), (600, 1200))]:
+                self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
+            self.assertTrue(all(entry.mhv == root.hilbert_key(entry.mbr) for entry in root.iter()))
+            self.assertTrue(abs(root.stats['leaf_nodes'] - leaves) < leaves/2)
+            if root.leaf_index is not None:
+                for node in walk_nodes(root):
+                    for entry in node.page_entries if node.is_leaf_node else []:
+                        self.assertTrue(root.leaf_index[entry.obj_id] is node)
+
+    def test_update_buffered(self):
+        props = Properties(max_capacity = 8, min_capacity = 3, leaf_index = True,
+                           insert_buffer_size = 16)
+        items = random_items(100)
+        root = RTreeNode.bulk_load(items, props)
+        far = Rectangle((5, 990), (10, 995))
+        self.assertTrue(root.update(0, far) and root.num_buffered == 1)
+        self.assertTrue(0 not in root.leaf_index)
+        self.assertTrue(root.delete(LeafEntry(far, 0)))
+        self.assertFalse(root.update(0, Rectangle((1, 1), (2, 2))))
+        self.assertTrue(sorted(entry.obj_id for entry in root.iter()) == range(1, 100))
+        self.assertTrue(sorted(root.search_range(far)) == brute_force_range(items[1:], far))
+        # A stale index entry is caught rather than trusted.
+        root.leaf_index[0] = root.leaf_index[1]
+        self.assertFalse(root.update(0, far))
+        self.assertTrue(all(entry.mbr == mbr for (mbr, _, _), entry in
+                            zip(items[1:], sorted(root.iter(), key = lambda e: e.obj_id))))
+
+    def test_kmeans_split_policy(self):
+        items = random_items(1500, seed = 11)
+        quality = {}
+        for policy in ['hilbert', 'kmeans']:
+            props = Properties(max_capacity = 16, min_capacity = 6, split_policy = policy,
+                               k_means_iterations = 5)
+            root = build_tree(items, props)
+            check_tree(self, root)
+            for node in walk_nodes(root):
+                self.assertTrue(node.is_root or len(node.page_entries) >= 6)
+            quality[policy] = root.quality()
+            self.assertTrue(quality[policy][-1]['pages'] == root.stats['leaf_nodes'])
+            for query in [Rectangle((0, 0), (300, 300)), Rectangle((200, 500), (600, 1000))]:
+                self.assertTrue(sorted(root.search_range(query)) == brute_force_range(items, query))
+            for mbr, obj_id, obj in items[::3]:
+                self.assertTrue(root.delete(LeafEntry(mbr, obj_id, obj)))
+            check_tree(self, root)
+            self.assertTrue(len(list(root.iter())) == 1000)
+        self.assertTrue(quality['kmeans'][-2]['child_overlap'] < 
+                        quality['hilbert'][-2]['child_overlap'])
+
+    def test_quality(self):
+        root = RTreeNode(is_root = True, props = self.props)
+        self.assertTrue(root.quality() == [{'pages': 1, 'fill': 0., 'entry_overlap': 0.,
+                                            'child_overlap': 0., 'dead_space': 0.}])
+        for i, (x, y) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1)]):
+            root.insert(LeafEntry(Rectangle((x, y), (x + 1, y + 1)), i))
+        root.insert(LeafEntry(Rectangle((0, 0), (2, 2)), 4))
+        level, = root.quality()
+        self.assertTrue(level['pages'] == 1 and level['fill'] == 5/8.)
+        self.assertTrue(level['entry_overlap'] == 4/8. and level['child_overlap'] == 0.)
+        self.assertTrue(level['dead_space'] == 0.)
+        root.delete(LeafEntry(Rectangle((0, 0), (2, 2)), 4))
+        root.delete(LeafEntry(Rectangle((1, 0), (2, 1)), 1))
+        self.assertTrue(root.quality()[0]['dead_space'] == 0.25)
+        root = RTreeNode.bulk_load(random_items(200), self.props)
+        top, leaves = root.quality()[0], root.quality()[-1]
+        self.assertTrue(top['child_overlap'] == top['entry_overlap'] > 0)
+        self.assertTrue(leaves['child_overlap'] == 0. and leaves['entry_overlap'] > 0)
+
+    def test_boxes(self):
+        # Trajectory samples as (x, y, t) boxes.
+        rng = random.Random(8)
+        items = []
+        for i in xrange(600):
+            x, y, t = rng.uniform(0, 1000), rng.uniform(0, 1000), rng.uniform(0, 100)
+            items.append((Box((x, y, t), (x + rng.uniform(0, 10), y + rng.uniform(0, 10), t + 1)),
+                          i, None))
+        extent = Box((0, 0, 0), (1010, 1010, 101))
+        props = Properties(max_capacity = 8, min_capacity = 3, hilbert_resolution = 10,
+                           world_extent = extent, leaf_index = True)
+        self.assertTrue(props.quantizer.cell((1010, 0, 50.5)) == (1023, 0, 512))
+        for root in [build_tree(items, props), RTreeNode.bulk_load(items, props),
+                     RTreeNode.bulk_load(items, Properties(max_capacity = 8, min_capacity = 3),
+                                         fit_extent = True)]:
+            check_tree(self, root)
+            self.assertTrue(len(set(entry.mhv for entry in root.iter())) > 500)
+            window = Box((200, 200, 20), (600, 700, 40))
+            expected = brute_force_range(items, window)
+            self.assertTrue(0 < len(expected) < len(brute_force_range(items, Box((200, 200, 0),
+                                                                               (600, 700, 101)))))
+            self.assertTrue(sorted(root.search_range(window)) == expected)
+            self.assertTrue(sorted(root.search_range_batch([window])[0]) == expected)
+            point = items[0][0].centroid
+            self.assertTrue(0 in root.search_point(point))
+            self.assertTrue(0 in root.search_point_batch([point])[0])
+            self.assertTrue(root.search_k_nearest(1, point) == [0])
+        for mbr, obj_id, obj in items[:200]:
+            self.assertTrue(root.delete(LeafEntry(mbr, obj_id, obj)))
+        for mbr, obj_id, obj in items[200:300]:
+            self.assertTrue(root.update(obj_id, Box(mbr.lo, (mbr.hi[0], mbr.hi[1], 100))))
+        check_tree(self, root)
+        moved = Box((0, 0, 99), (1010, 1010, 101))
+        self.assertTrue(sorted(root.search_range(moved)) == 
+                        sorted(set(range(200, 300) + brute_force_range(items[300:], moved))))
+        # Emptied pages keep the tree's dimension, with or without a world_extent.
+        for root in [build_tree(items[:50], props), build_tree(items[:50], self.props)]:
+            self.assertTrue(root.delete_batch(LeafEntry(mbr, obj_id) for mbr, obj_id, _ in items[:50]))
+            self.assertTrue(root.mbr == Box.get_empty(3) and root.page_entries == [])
+            root.insert(LeafEntry(*items[0]))
+            self.assertTrue(root.mbr == items[0][0])
+            with warnings.catch_warnings(record = True) as caught:
+                warnings.simplefilter('always')
+                root.quality()
+            self.assertTrue(len(caught) == 1)
+
+    def test_progressive_range(self):
+        items = random_items(2000)
+        props = Properties(max_capacity = 8, min_capacity = 3, insert_buffer_size = 32)
+        root = RTreeNode.bulk_load(items[:1990], props)
+        for mbr, obj_id, obj in items[1990:]:
+            root.insert(LeafEntry(mbr, obj_id, obj))
+        query = Rectangle((100, 100), (700, 650))
+        expected = brute_force_range(items, query)
+        pages = root.stats['leaf_nodes'] + root.stats['internal_nodes']
+        for order in ['overlap', 'hilbert']:
+            progressive = root.progressive_range(query, order = order)
+            ans = progressive.fetch(max_nodes = 10)
+            self.assertTrue(not progressive.complete and progressive.nodes_visited == 10)
+            self.assertTrue(len(ans) > 0)
+            while not progressive.complete:
+                ans.extend(progressive.fetch(max_nodes = 7))
+            self.assertTrue(sorted(ans) == expected and len(set(ans)) == len(ans))
+            self.assertTrue(progressive.nodes_visited < pages)
+            self.assertTrue(progressive.fetch() == [])
+        # Pages covered by the query come first, so the first leaf is all results.
+        progressive = root.progressive_range(Rectangle((0, 0), (1000, 1000)))
+        first = progressive.fetch(max_nodes = root.stats['tree_height'])
+        self.assertTrue(len(first) >= 10 + props['min_capacity'])
+        # The first page visited is the root, which holds no results itself.
+        progressive = root.progressive_range(query)
+        buffered = brute_force_range(items[1990:], query)
+        self.assertTrue(sorted(progressive.fetch(max_time = 0)) == buffered and buffered)
+        self.assertTrue(progressive.nodes_visited == 1)
+        leaf = RTreeNode.bulk_load(items[:8], props)
+        progressive = leaf.progressive_range(Rectangle((0, 0), (500, 500)), objects = True)
+        self.assertTrue(len(progressive.fetch(max_time = 0)) == 
+                        len(brute_force_range(items[:8], Rectangle((0, 0), (500, 500)))))
+        self.assertTrue(progressive.complete)
+        self.assertTrue(RTreeNode(is_root = True, props = self.props).progressive_range(query).complete)
+        # Writes between fetches would drop or repeat results, so they are caught.
+        for write in [lambda: root.insert(LeafEntry(Rectangle((1, 1), (2, 2)), 5000)),
+                      lambda: root.delete(LeafEntry(items[0][0], 0)),
+                      lambda: root.update(1, Rectangle((3, 3), (4, 4))), root.flush]:
+            progressive = root.progressive_range(query)
+            progressive.fetch(max_nodes = 2)
+            write()
+            self.assertRaises(RuntimeError, progressive.fetch)
+
     def test_search_knn(self):
-        self.assertTrue(False)
+        items = random_items(500)
+        root = build_tree(items, self.props)
+        point = (420, 130)
+        distances = sorted(mbr.min_distance(point) for mbr, _, _ in items)
+        nearest = list(itertools.islice(root.iter_nearest(point), 25))
+        self.assertTrue([dist for dist, _ in nearest] == distances[:25])
+        ans = root.search_k_nearest(10, point)
+        self.assertTrue(ans == [obj_id for _, obj_id in nearest[:10]])
+        self.assertTrue(len(root.search_k_nearest(1000, point)) == 500)
+        close = root.search_k_nearest(1000, point, max_distance = 50)
+        self.assertTrue(len(close) == len([d for d in distances if d <= 50]))
+        self.assertTrue(RTreeNode.bulk_load([], self.props).search_k_nearest(3, point) == [])
 
 
 if __name__ == '__main__':
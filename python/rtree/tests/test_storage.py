@@ -0,0 +1,160 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from rtree.rtree import LeafEntry
+from rtree.rtree import Properties
+from rtree.rtree import RTreeNode
+from rtree.storage import PageFile
+from rtree.storage import dump
+from rtree.storage import load
+from rtree.storage import write_page_file
+from rtree.tests.test_rtree import brute_force_range
+from rtree.tests.test_rtree import build_tree
+from rtree.tests.test_rtree import random_items
+from rtree.types import Box
+from rtree.types import Rectangle
+
+
+class PageFileTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+    queries = [Rectangle((0, 0), (100, 100)), Rectangle((250, 400), (600, 420)),
+               Rectangle((-10, -10), (-5, -5)), Rectangle((0, 0), (2000, 2000))]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tree.pages')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_page_file(self):
+        items = random_items(500)
+        root = build_tree(items, self.props)
+        write_page_file(root, self.path)
+        with PageFile(self.path) as pages:
+            self.assertTrue(pages.max_capacity == 8)
+            self.assertTrue(pages.mbr == root.mbr)
+            self.assertTrue(os.path.getsize(self.path) == 64 + pages.num_pages*pages.pages.itemsize)
+            for query in self.queries:
+                self.assertTrue(sorted(pages.search_range(query)) == brute_force_range(items, query))
+            self.assertTrue(sorted(pages.search_point((10, 10))) == sorted(root.search_point((10, 10))))
+            ans = pages.search_range_batch(self.queries)
+            self.assertTrue([sorted(a) for a in ans] == 
+                            [brute_force_range(items, query) for query in self.queries])
+
+    def test_empty_page_file(self):
+        write_page_file(RTreeNode.bulk_load([], self.props), self.path)
+        with PageFile(self.path) as pages:
+            self.assertTrue(pages.num_pages == 1)
+            self.assertTrue(pages.search_range(self.queries[-1]) == [])
+
+    def test_bad_page_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('\0'*128)
+        self.assertRaises(ValueError, PageFile, self.path)
+        write_page_file(build_tree(random_items(50), self.props), self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(64 + 100)
+        self.assertRaises(ValueError, PageFile, self.path)
+
+
+class SnapshotTests(unittest.TestCase):
+    props = Properties(max_capacity = 8, min_capacity = 3)
+
+    def roundtrip(self, root, objects = False):
+        f = io.BytesIO()
+        dump(root, f, objects)
+        f.seek(0)
+        return load(f)
+
+    def assertSameTree(self, a, b):
+        self.assertTrue(a.is_leaf_node == b.is_leaf_node)
+        self.assertTrue(a.mbr == b.mbr and a.mhv == b.mhv)
+        self.assertTrue(len(a.page_entries) == len(b.page_entries))
+        for ea, eb in zip(a.page_entries, b.page_entries):
+            self.assertTrue(ea.mbr == eb.mbr and ea.mhv == eb.mhv)
+            if a.is_leaf_node:
+                self.assertTrue(ea.obj_id == eb.obj_id and ea.obj == eb.obj)
+            else:
+                self.assertTrue(eb.child.parent is b)
+                self.assertSameTree(ea.child, eb.child)
+
+    def test_roundtrip(self):
+        root = build_tree(random_items(500), self.props)
+        restored = self.roundtrip(root)
+        self.assertTrue(restored.is_root and restored.props == root.props)
+        self.assertSameTree(root, restored)
+        restored.insert(LeafEntry(Rectangle((1, 1), (2, 2)), 1000))
+        self.assertTrue(1000 in restored.search_range(Rectangle((0, 0), (3, 3))))
+
+    def test_roundtrip_objects(self):
+        items = [(mbr, obj_id, 'obj%d' % obj_id) for mbr, obj_id, _ in random_items(100)]
+        root = RTreeNode.bulk_load(items, self.props, fit_extent = True)
+        restored = self.roundtrip(root, objects = True)
+        self.assertTrue(restored.props['world_extent'] == root.props['world_extent'])
+        self.assertSameTree(root, restored)
+        self.assertTrue(all(entry.obj is None for entry in self.roundtrip(root).iter()))
+
+    def test_roundtrip_props(self):
+        items = [(Box((x.left, x.bottom), (x.right, x.top)), i, None)
+                 for x, i, _ in random_items(200)]
+        props = Properties(max_capacity = 8, min_capacity = 3, hilbert_scale = (2., 0.5),
+                           split_policy = 'kmeans', leaf_index = True)
+        restored = self.roundtrip(RTreeNode.bulk_load(items, props)).props
+        self.assertTrue(restored == props and restored['hilbert_scale'] == (2., 0.5))
+        root = RTreeNode.bulk_load(items, props, fit_extent = True)
+        restored = self.roundtrip(root).props
+        self.assertTrue(isinstance(restored['world_extent'], Box))
+        self.assertTrue(restored['world_extent'] == root.props['world_extent'])
+        self.assertTrue(restored.quantizer.key((500, 500)) == root.props.quantizer.key((500, 500)))
+
+    def test_boxes(self):
+        # 2-d Boxes round-trip as Rectangles; N-d trees are refused, not flattened.
+        items = [(Box((x.left, x.bottom), (x.right, x.top)), i, None)
+                 for x, i, _ in random_items(200)]
+        restored = self.roundtrip(RTreeNode.bulk_load(items, self.props))
+        query = Rectangle((0, 0), (300, 300))
+        self.assertTrue(sorted(restored.search_range(query)) == brute_force_range(items, query))
+        items = [(Box((x.left, x.bottom, i % 20), (x.right, x.top, i % 20 + 1)), i, None)
+                 for x, i, _ in random_items(200)]
+        props = Properties(max_capacity = 8, min_capacity = 3, hilbert_resolution = 16,
+                           world_extent = Box((0, 0, 0), (1010, 1010, 21)),
+                           insert_buffer_size = 16)
+        root = RTreeNode.bulk_load(items[:190], props)
+        for mbr, obj_id, obj in items[190:]:
+            root.insert(LeafEntry(mbr, obj_id, obj))
+        self.assertRaises(ValueError, dump, root, io.BytesIO())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(ValueError, write_page_file, root, os.path.join(tmpdir, 'tree.pages'))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertTrue(root.num_buffered == 10)
+        window = Box((0, 0, 0), (100, 100, 10))
+        self.assertTrue(sorted(root.search_range(window)) == brute_force_range(items, window))
+
+    def test_bad_snapshot(self):
+        f = io.BytesIO()
+        dump(RTreeNode.bulk_load(random_items(20), self.props), f)
+        data = f.getvalue()
+        self.assertRaises(ValueError, load, io.BytesIO('XXXX' + data[4:]))
+        self.assertRaises(ValueError, load, io.BytesIO(data[:4] + struct.pack('<I', 1) + data[8:]))
+        # The properties are data, never unpickled.
+        props = 'cos\nsystem\n(S"true"\ntR.'
+        header = struct.pack('<4sIBI', 'RTSN', 2, False, len(props))
+        self.assertRaises(ValueError, load, io.BytesIO(header + props))
+
+    def test_roundtrip_empty(self):
+        restored = self.roundtrip(RTreeNode.bulk_load([], self.props))
+        self.assertTrue(restored.is_root and restored.page_entries == [])
+
+
+if __name__ == '__main__':
+    for case in [PageFileTests, SnapshotTests]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity = 2).run(suite)
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 
+from rtree.types import Box
 from rtree.types import Rectangle
 
 
@@ -54,14 +55,65 @@ class RectangleTests(unittest.TestCase):
         t = Rectangle((0, 0), (15, 15))
         self.assertTrue(r.get_mbr(s) == t)
 
+    def test_intersect_area(self):
+        r = Rectangle((0, 0), (10, 10))
+        self.assertTrue(r.get_intersect_area(Rectangle((5, 5), (15, 15))) == 25)
+        self.assertTrue(r.get_intersect_area(Rectangle((2, 2), (3, 3))) == 1)
+        self.assertTrue(r.get_intersect_area(Rectangle((10, 10), (15, 15))) == 0)
+
+    def test_min_distance(self):
+        r = Rectangle((0, 0), (10, 10))
+        self.assertTrue(r.min_distance((5, 5)) == 0)
+        self.assertTrue(r.min_distance((10, 15)) == 5)
+        self.assertTrue(r.min_distance((13, 14)) == 5)
+
+
+class BoxTests(unittest.TestCase):
+    def test_properties(self):
+        b = Box((10, 0, 5), (0, 4, 7))
+        self.assertTrue(b.dims == 3 and list(b.lo) == [0, 0, 5] and list(b.hi) == [10, 4, 7])
+        self.assertTrue(b.area == 80 and b.centroid == (5, 2, 6))
+        self.assertTrue(b.bounds == (0, 10, 0, 4, 5, 7))
+        self.assertTrue((b.left, b.right, b.bottom, b.top) == (0, 10, 0, 4))
+        self.assertTrue(b == Box((0, 0, 5), (10, 4, 7)) and b != Box((0, 0, 5), (10, 4, 8)))
+        self.assertTrue(hash(b) == hash(Box((0, 0, 5), (10, 4, 7))))
+        self.assertTrue(b != Rectangle((0, 0), (10, 4)))
+
+    def test_predicates(self):
+        b = Box((0, 0, 0), (10, 10, 10))
+        self.assertTrue(b.contains_point((10, 5, 0)) and not b.contains_point((5, 5, 11)))
+        self.assertTrue(b.contains_rect(Box((0, 2, 2), (3, 3, 10))))
+        self.assertFalse(b.strictly_contains_rect(Box((0, 2, 2), (3, 3, 9))))
+        self.assertTrue(b.strictly_contains_rect(Box((1, 2, 2), (3, 3, 9))))
+        self.assertTrue(b.intersects_rect(Box((5, 5, 5), (15, 15, 15))))
+        self.assertFalse(b.intersects_rect(Box((5, 5, 10), (15, 15, 15))))
+        self.assertTrue(b.get_intersect_area(Box((5, 5, 5), (15, 15, 15))) == 125)
+        self.assertTrue(b.get_intersect_area(Box((5, 5, 10), (15, 15, 15))) == 0)
+        self.assertTrue(b.min_distance((13, 14, 5)) == 5 and b.min_distance((1, 1, 1)) == 0)
+
+    def test_mbr(self):
+        a = Box((0, 0, 0), (1, 1, 1))
+        b = Box((2, -1, 0), (3, 0, 5))
+        self.assertTrue(a.get_mbr(b) == Box((0, -1, 0), (3, 1, 5)))
+        self.assertTrue(Box.merge_by_mbr([a, b]) == a.get_mbr(b))
+        self.assertTrue(Box.merge_by_mbr([a]) == a)
+        self.assertTrue(a.get_mbr_point((4, 4, 4)) == Box((0, 0, 0), (4, 4, 4)))
+        self.assertTrue(Box.merge_by_mbr([], dims = 3) == Box.get_empty(3))
+        self.assertTrue(Box.get_empty(3).dims == 3)
+        self.assertRaises(ValueError, Box.merge_by_mbr, [])
+        self.assertRaises(ValueError, Box.merge_by_mbr, [a, Box((0, 0), (1, 1))])
+        self.assertRaises(ValueError, a.get_mbr, Box((0, 0), (1, 1)))
+        self.assertRaises(ValueError, a.get_mbr, Rectangle((0, 0), (1, 1)))
+
 
 class PageTests(unittest.TestCase):
     pass
 
 
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(RectangleTests)
-    unittest.TextTestRunner(verbosity = 2).run(suite)
+    for case in [RectangleTests, BoxTests]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity = 2).run(suite)
     unittest.main()
 
     suite = unittest.TestLoader().loadTestsFromTestCase(PageTests)
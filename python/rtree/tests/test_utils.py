@@ -1,6 +1,17 @@
+import itertools
+import random
 import unittest
 
+import numpy as np
+
+from rtree.utils import hilbert_decode_batch
 from rtree.utils import hilbert_encode
+from rtree.utils import hilbert_encode_batch
+from rtree.utils import hilbert_encode_nd
+from rtree.utils import HilbertQuantizer
+from rtree.utils import capacity_kmeans
+from rtree.utils import interleave_bits
+from rtree.utils import union_area
 
 
 class HilbertCurveTests(unittest.TestCase):
@@ -17,8 +28,98 @@ class HilbertCurveTests(unittest.TestCase):
         self.assertTrue(hilbert_encode((1, 0), 2) is 1)
         self.assertTrue(hilbert_encode((0, 2), 2) is 4)
 
+    def test_hilbert_batch(self):
+        rng = random.Random(0)
+        for r in [1, 2, 7, 16, 32]:
+            xs = [rng.randrange(1 << r) for i in xrange(200)]
+            ys = [rng.randrange(1 << r) for i in xrange(200)]
+            h = hilbert_encode_batch(xs, ys, r)
+            self.assertTrue(h.dtype == np.uint64)
+            self.assertTrue(h.tolist() == [hilbert_encode(p, r) for p in zip(xs, ys)])
+            x, y = hilbert_decode_batch(h, r)
+            self.assertTrue(x.tolist() == xs and y.tolist() == ys)
+
+    def test_hilbert_tables(self):
+        # Every cell of the curve is visited once, each step moving to a neighbour.
+        for r in [1, 3, 4, 5]:
+            n = 1 << r
+            cells = sorted((hilbert_encode((x, y), r), (x, y)) for x in xrange(n) for y in xrange(n))
+            self.assertTrue([h for h, _ in cells] == range(n*n))
+            for (_, (x0, y0)), (_, (x1, y1)) in zip(cells, cells[1:]):
+                self.assertTrue(abs(x1 - x0) + abs(y1 - y0) == 1)
+
+    def test_hilbert_nd(self):
+        for dims, r in [(1, 3), (2, 3), (3, 2), (3, 3), (4, 2)]:
+            n = 1 << r
+            cells = sorted((hilbert_encode_nd(cell, r), cell)
+                           for cell in itertools.product(xrange(n), repeat = dims))
+            self.assertTrue([h for h, _ in cells] == range(n**dims))
+            self.assertTrue(cells[0][1] == (0,)*dims)
+            for (_, a), (_, b) in zip(cells, cells[1:]):
+                self.assertTrue(sum(abs(u - v) for u, v in zip(a, b)) == 1)
+        q = HilbertQuantizer(resolution = 4, scale = 2.)
+        self.assertTrue(q.cell((1, 2.5, 100)) == (2, 5, 15))
+        self.assertTrue(q.key((1, 2.5, 100)) == hilbert_encode_nd((2, 5, 15), 4))
+
+    def test_interleave_bits(self):
+        self.assertTrue(interleave_bits(0, 0) == 0)
+        self.assertTrue(interleave_bits(1, 0) == 2 and interleave_bits(0, 1) == 1)
+        self.assertTrue(interleave_bits(0xFFFFFFFF, 0) == 0xAAAAAAAAAAAAAAAA)
+        self.assertTrue(interleave_bits(0b1010, 0b0110) == 0b10011100)
+
+    def test_hilbert_decode_curve(self):
+        x, y = hilbert_decode_batch(np.arange(16), 2)
+        points = zip(x.tolist(), y.tolist())
+        self.assertTrue(points[:5] == [(0, 0), (1, 0), (1, 1), (0, 1), (0, 2)])
+        self.assertTrue(len(set(points)) == 16)
+
+
+class HilbertQuantizerTests(unittest.TestCase):
+    def test_cell(self):
+        q = HilbertQuantizer(resolution = 4)
+        self.assertTrue(q.cell((3.7, 0.2)) == (3, 0))
+        self.assertTrue(q.cell((-3.7, 100)) == (0, 15))
+        q = HilbertQuantizer(resolution = 4, scale = (0.5, 2.), origin = (-10, 10))
+        self.assertTrue(q.cell((-10, 10)) == (0, 0))
+        self.assertTrue(q.cell((-5, 11.6)) == (2, 3))
+
+    def test_key(self):
+        q = HilbertQuantizer()
+        self.assertTrue(q.key((12.9, 7.1)) == hilbert_encode((12, 7), 32))
+        self.assertTrue(q.keys([12.9, -1], [7.1, 2**40]) == 
+                        [q.key((12.9, 7.1)), q.key((-1, 2**40))])
+
+    def test_cache(self):
+        q = HilbertQuantizer(resolution = 8, cache_size = 10)
+        for i in xrange(100):
+            self.assertTrue(q.key((i, i)) == hilbert_encode((i, i), 8))
+            self.assertTrue(len(q._cache) + len(q._old_cache) <= 10)
+        self.assertTrue((99, 99) in q._cache)
+        self.assertTrue(q.key((99, 99)) == hilbert_encode((99, 99), 8))
+
+
+class ClusteringTests(unittest.TestCase):
+    def test_capacity_kmeans(self):
+        rng = random.Random(4)
+        points = np.array([(rng.gauss(cx, 1), rng.gauss(cy, 1)) 
+                           for cx, cy in [(0, 0), (50, 0), (0, 50)] for i in xrange(10)])
+        order = np.array(rng.sample(range(30), 30))
+        labels = capacity_kmeans(points[order], np.arange(30)*3//30, 10, 10, 10)
+        for cluster in xrange(3):
+            members = set((order[labels == cluster]//10).tolist())
+            self.assertTrue(len(members) == 1)
+        labels = capacity_kmeans(points, np.arange(30)*2//30, 11, 19, 10)
+        counts = np.bincount(labels)
+        self.assertTrue(counts.min() >= 11 and counts.max() <= 19)
+
+    def test_union_area(self):
+        self.assertTrue(union_area(np.zeros((0, 4))) == 0.)
+        bounds = np.array([(0, 2, 0, 2), (1, 3, 1, 3), (5, 6, 5, 5)], dtype = np.float64)
+        self.assertTrue(union_area(bounds) == 7.)
+
 
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(HilbertCurveTests)
-    unittest.TextTestRunner(verbosity = 2).run(suite)
+    for case in [HilbertCurveTests, HilbertQuantizerTests, ClusteringTests]:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity = 2).run(suite)
     unittest.main()
@@ -1,7 +1,11 @@
+from __future__ import absolute_import
+
+import array
+import itertools
 import math
 
-# TODO: This produces a weird circular dependency
-# from rtree.utils import hilbert_encode
+from rtree.utils import hilbert_encode
+from rtree.utils import hilbert_encode_nd
 
 
 class Rectangle(object):
@@ -27,10 +31,11 @@ class Rectangle(object):
 
     @classmethod 
     def merge_by_mbr(cls, rects):
-        merged = Rectangle.get_empty()
-        for rect in rects:
-            merged = merged.get_mbr(rect)
-        return merged
+        rects = list(rects)
+        if not rects:
+            return Rectangle.get_empty()
+        return Rectangle((min(rect.left for rect in rects), min(rect.bottom for rect in rects)),
+                         (max(rect.right for rect in rects), max(rect.top for rect in rects)))
 
     @property
     def hilbert_value(self):
@@ -71,6 +76,20 @@ class Rectangle(object):
         d = (self.right, self.bottom)
         return [a, b, c, d]
 
+    @property
+    def lo(self):
+        return (self.left, self.bottom)
+
+    @property
+    def hi(self):
+        return (self.right, self.top)
+
+    @property
+    def bounds(self):
+        """ The (low, high) pair of each axis: (left, right, bottom, top).
+        """
+        return (self.left, self.right, self.bottom, self.top)
+
     def contains_point(self, point):
         x, y = point
         return (self.left <= x <= self.right) and (self.bottom <= y <= self.top)
@@ -80,8 +99,28 @@ class Rectangle(object):
         max_rect = (rect.right, rect.top)
         return self.contains_point(min_rect) and self.contains_point(max_rect)
 
+    def strictly_contains_rect(self, rect):
+        """ Returns True if rect lies inside the rectangle without touching its
+        edges.
+        """
+        return self.left < rect.left and rect.right < self.right and \
+            self.bottom < rect.bottom and rect.top < self.top
+
+    def min_distance(self, point):
+        """ Returns the minimum Euclidean distance (MINDIST) from a point to the
+        rectangle, which is 0 for points inside it.
+        """
+        x, y = point
+        dx = max(self.left - x, 0, x - self.right)
+        dy = max(self.bottom - y, 0, y - self.top)
+        return math.sqrt(dx*dx + dy*dy)
+
     def get_intersect_area(self, rect):
-        assert False
+        """ Returns the area of the intersection with another rectangle.
+        """
+        width = min(self.right, rect.right) - max(self.left, rect.left)
+        height = min(self.top, rect.top) - max(self.bottom, rect.bottom)
+        return width*height if width > 0 and height > 0 else 0
 
     def intersects_rect(self, rect):
         return self.right > rect.left and self.left < rect.right and self.top > rect.bottom and self.bottom < rect.top
@@ -110,44 +149,162 @@ class Rectangle(object):
         assert False
 
     def __eq__(self, rect):
+        if not isinstance(rect, Rectangle):
+            return False
         return (self.left == rect.left) and (self.right == rect.right) \
-            and (self.top == rect.top) and (self.bottom == rect.bottom) \
+            and (self.top == rect.top) and (self.bottom == rect.bottom)
+
+    def __ne__(self, rect):
+        return not self == rect
+
+    def __hash__(self):
+        return hash((self.left, self.right, self.bottom, self.top))
         
     def __repr__(self):
         return "%s<%r>" % (self.__class__.__name__, self.coordinates)
 
 
-def hilbert_encode((x, y), r):
-    """Gives a Hilbert fractal encoding of a grid point (x, y) in a grid of
-    resolution r (yielding a square grid of length 2**r).
-    """
-    mask = (1 << r) - 1
-    hodd = 0
-    heven = x ^ y
-    notx = ~x & mask
-    noty = ~y & mask
-    temp = notx ^ y
-    v0 = 0
-    v1 = 0
-    for k in xrange(1, r):
-        v1 = ((v1 & heven) | ((v0 ^ noty) & temp)) >> 1
-        v0 = ((v0 & (v1 ^ notx)) | (~v0 & (v1 ^ noty))) >> 1
-    hodd = (~v0 & (v1 ^ x)) | (v0 & (v1 ^ noty))
-    return interleave_bits(hodd, heven)
-
-
-def interleave_bits(odd, even):
-    """ Returns bit string from interleaving odd and even bit strings.
+class Box(object):
+    """ An axis-aligned box in any number of dimensions, such as (x, y, t). Its
+    corners are stored as compact arrays of doubles.
+
+    Box implements the parts of the Rectangle interface that RTreeNode uses,
+    so trees of Boxes are built, updated and queried by the same code, with
+    N-d Hilbert keys. area is the volume, and left, right, bottom and top are
+    the bounds of the first two axes.
     """
-    val = 0
-    max0 = max(odd, even)
-    n = 0
-    while (max0 > 0):
-        n += 1
-        max0 >>= 1
-    for i in xrange(n):
-        bitMask = 1 << i
-        a = (1 << (2*i)) if (even & bitMask) > 0  else 0
-        b = (1 << (2*i+1)) if (odd & bitMask) > 0 else 0
-        val += a + b
-    return val
+
+    __slots__ = {'lo', 'hi'}
+
+    def __init__(self, p1, p2):
+        assert len(p1) == len(p2)
+        self.lo = array.array('d', map(min, p1, p2))
+        self.hi = array.array('d', map(max, p1, p2))
+
+    @classmethod
+    def get_empty(cls, dims):
+        return cls((0,)*dims, (0,)*dims)
+
+    @classmethod
+    def merge_by_mbr(cls, boxes, dims = None):
+        """ Returns the MBR of boxes, which must all have the same dimension;
+        without boxes, the empty box of dims dimensions.
+        """
+        boxes = list(boxes)
+        if not boxes:
+            if dims is None:
+                raise ValueError("The dimension of an empty merge is unknown.")
+            return cls.get_empty(dims)
+        dims = len(boxes[0].lo)
+        if any(len(box.lo) != dims for box in boxes):
+            raise ValueError("Cannot merge boxes of different dimensions.")
+        return cls([min(axis) for axis in zip(*[box.lo for box in boxes])],
+                   [max(axis) for axis in zip(*[box.hi for box in boxes])])
+
+    @property
+    def dims(self):
+        return len(self.lo)
+
+    @property
+    def left(self):
+        return self.lo[0]
+
+    @property
+    def right(self):
+        return self.hi[0]
+
+    @property
+    def bottom(self):
+        return self.lo[1]
+
+    @property
+    def top(self):
+        return self.hi[1]
+
+    @property
+    def bounds(self):
+        """ The (low, high) pair of each axis, flattened.
+        """
+        return tuple(v for pair in itertools.izip(self.lo, self.hi) for v in pair)
+
+    @property
+    def hilbert_value(self):
+        """ Returns the Hilbert value of the box centroid.
+        """
+        return hilbert_encode_nd([int(v) for v in self.centroid], 32)
+
+    @property
+    def centroid(self):
+        return tuple((l + h)/2. for l, h in itertools.izip(self.lo, self.hi))
+
+    @property
+    def area(self):
+        volume = 1.
+        for l, h in itertools.izip(self.lo, self.hi):
+            volume *= h - l
+        return volume
+
+    def contains_point(self, point):
+        return all(l <= v <= h for l, v, h in itertools.izip(self.lo, point, self.hi))
+
+    def contains_rect(self, box):
+        return all(l <= ol and oh <= h for l, h, ol, oh in 
+                   itertools.izip(self.lo, self.hi, box.lo, box.hi))
+
+    def strictly_contains_rect(self, box):
+        return all(l < ol and oh < h for l, h, ol, oh in 
+                   itertools.izip(self.lo, self.hi, box.lo, box.hi))
+
+    def intersects_rect(self, box):
+        return all(h > ol and l < oh for l, h, ol, oh in 
+                   itertools.izip(self.lo, self.hi, box.lo, box.hi))
+
+    def min_distance(self, point):
+        """ Returns the minimum Euclidean distance (MINDIST) from a point to the
+        box, which is 0 for points inside it.
+        """
+        total = 0.
+        for l, v, h in itertools.izip(self.lo, point, self.hi):
+            d = max(l - v, 0, v - h)
+            total += d*d
+        return math.sqrt(total)
+
+    def get_intersect_area(self, box):
+        """ Returns the volume of the intersection with another box.
+        """
+        volume = 1.
+        for l, h, ol, oh in itertools.izip(self.lo, self.hi, box.lo, box.hi):
+            side = min(h, oh) - max(l, ol)
+            if side <= 0:
+                return 0
+            volume *= side
+        return volume
+
+    def get_mbr(self, box):
+        if len(box.lo) != len(self.lo):
+            raise ValueError("Cannot merge a %d-d box with a %d-d one." % (len(self.lo), len(box.lo)))
+        return Box(map(min, self.lo, box.lo), map(max, self.hi, box.hi))
+
+    def get_mbr_point(self, point):
+        return self.get_mbr(Box(point, point))
+
+    def __eq__(self, box):
+        if not isinstance(box, Box):
+            return False
+        return self.lo == box.lo and self.hi == box.hi
+
+    def __ne__(self, box):
+        return not self == box
+
+    def __hash__(self):
+        return hash((tuple(self.lo), tuple(self.hi)))
+
+    def __getstate__(self):
+        return (self.lo.tolist(), self.hi.tolist())
+
+    def __setstate__(self, state):
+        self.lo = array.array('d', state[0])
+        self.hi = array.array('d', state[1])
+
+    def __repr__(self):
+        return "%s<%r, %r>" % (self.__class__.__name__, tuple(self.lo), tuple(self.hi))
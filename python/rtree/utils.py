@@ -1,40 +1,366 @@
 # Useful utilities.
 # See http://stackoverflow.com/questions/106237/calculate-the-hilbert-value-of-a-point-for-use-in-a-hilbert-r-tree
 
-# TODO: Fix circular dependency 
-# TODO: Add some caching and memoization.
-# TODO: Switch to Hacker's Delight version.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _hilbert_step(state, xbit, ybit):
+    """ Advances the Hilbert curve state machine by one bit of x and y, returning
+    the quadrant digit (0-3) and the next state. A state is a transform of the
+    remaining lower bits: bit 0 swaps x and y, bit 1 complements both.
+    """
+    swap, flip = state & 1, state >> 1
+    rx, ry = xbit ^ flip, ybit ^ flip
+    if swap:
+        rx, ry = ry, rx
+    if not ry:
+        swap ^= 1
+        flip ^= rx
+    return (3*rx) ^ ry, swap | (flip << 1)
+
+
+def _nibble_table():
+    """ Returns the table, indexed by (state << 8) | (x nibble << 4) | y nibble, of
+    (8 bit key digits) | (next state << 8) for four steps of the state machine.
+    """
+    table = []
+    for state0 in xrange(4):
+        for xn in xrange(16):
+            for yn in xrange(16):
+                state, digits = state0, 0
+                for bit in xrange(3, -1, -1):
+                    digit, state = _hilbert_step(state, (xn >> bit) & 1, (yn >> bit) & 1)
+                    digits = (digits << 2) | digit
+                table.append(digits | (state << 8))
+    return table
+
+
+_HILBERT_NIBBLES = _nibble_table()
+_SPREAD_BYTE = [sum(((i >> bit) & 1) << (2*bit) for bit in xrange(8)) for i in xrange(256)]
+
 
 def hilbert_encode((x, y), r):
     """Gives a Hilbert fractal encoding of a grid point (x, y) in a grid of
-    resolution r (yielding a square grid of length 2**r).
+    resolution r (yielding a square grid of length 2**r). 
+
+    Table-driven: four bits of x and y are consumed per lookup. When r isn't a
+    multiple of four, x and y are padded with leading zeros, and the start
+    state is chosen so that the padding leaves the orientation unchanged.
+    """
+    padding = -r % 4
+    state = padding & 1
+    h = 0
+    for shift in xrange(r + padding - 4, -1, -4):
+        v = _HILBERT_NIBBLES[(state << 8) | (((x >> shift) & 15) << 4) | ((y >> shift) & 15)]
+        h = (h << 8) | (v & 255)
+        state = v >> 8
+    return h
+
+
+def interleave_bits(odd, even):
+    """ Returns bit string from interleaving odd and even bit strings.
     """
-    mask = (1 << r) - 1
-    hodd = 0
+    val = 0
+    shift = 0
+    while odd or even:
+        val |= (_SPREAD_BYTE[even & 255] | (_SPREAD_BYTE[odd & 255] << 1)) << shift
+        odd >>= 8
+        even >>= 8
+        shift += 16
+    return val
+
+
+def hilbert_encode_nd(cell, r):
+    """ Gives the Hilbert encoding of a grid point with any number of coordinates,
+    each of r bits, by Skilling's algorithm ("Programming the Hilbert curve",
+    2004): the coordinates are transformed in place into the transposed key,
+    whose bits are then interleaved, most significant first.
+    """
+    x = list(cell)
+    n = len(x)
+    q = 1 << (r - 1)
+    # Inverse undo of the excess work.
+    while q > 1:
+        p = q - 1
+        for i in xrange(n):
+            if x[i] & q:
+                x[0] ^= p
+            else:
+                t = (x[0] ^ x[i]) & p
+                x[0] ^= t
+                x[i] ^= t
+        q >>= 1
+    # Gray encode.
+    for i in xrange(1, n):
+        x[i] ^= x[i - 1]
+    t = 0
+    q = 1 << (r - 1)
+    while q > 1:
+        if x[n - 1] & q:
+            t ^= q - 1
+        q >>= 1
+    h = 0
+    for bit in xrange(r - 1, -1, -1):
+        for i in xrange(n):
+            h = (h << 1) | (((x[i] ^ t) >> bit) & 1)
+    return h
+
+
+class HilbertQuantizer(object):
+    """
+    Maps points to Hilbert keys on a grid of resolution r. A point (x, y) falls
+    in the grid cell floor((x - x0)*sx), floor((y - y0)*sy), clamped onto the
+    grid. With cache_size > 0, keys of recently used cells are cached.
+
+    Points with more than two coordinates are keyed by hilbert_encode_nd, with
+    a scalar scale applying to every axis and a default origin of zeros.
+    """
+
+    def __init__(self, resolution = 32, scale = 1., origin = (0, 0), cache_size = 0):
+        assert 0 < resolution <= 32
+        self.resolution = resolution
+        self.scale = scale if isinstance(scale, tuple) else (scale, scale)
+        self.origin = origin
+        self._uniform_scale = not isinstance(scale, tuple)
+        self.cache_size = cache_size
+        self._cache = {}
+        self._old_cache = {}
+        self._max_cell = (1 << resolution) - 1
+
+    def cell(self, point):
+        """ Returns the grid cell containing point.
+        """
+        if len(point) != 2:
+            return self._cell_nd(point)
+        x, y = point
+        fx = (x - self.origin[0])*self.scale[0]
+        fy = (y - self.origin[1])*self.scale[1]
+        # Truncation floors non-negative values; negative ones clamp to 0.
+        gx = int(fx) if fx > 0 else 0
+        gy = int(fy) if fy > 0 else 0
+        max_cell = self._max_cell
+        return (gx if gx < max_cell else max_cell, gy if gy < max_cell else max_cell)
+
+    def _cell_nd(self, point):
+        n = len(point)
+        scale = self.scale[:1]*n if self._uniform_scale else self.scale
+        origin = self.origin
+        if len(origin) != n:
+            assert not any(origin), "The origin has too few coordinates."
+            origin = (0,)*n
+        assert len(scale) == n, "The scale has too few coordinates."
+        cell = []
+        for v, v0, sv in zip(point, origin, scale):
+            g = int((v - v0)*sv) if v > v0 else 0
+            cell.append(g if g < self._max_cell else self._max_cell)
+        return tuple(cell)
+
+    def key(self, point):
+        """ Returns the Hilbert key of the grid cell containing point.
+        """
+        cell = self.cell(point)
+        if not self.cache_size:
+            return self._encode(cell)
+        h = self._cache.get(cell)
+        if h is None:
+            h = self._old_cache.get(cell)
+            if h is None:
+                h = self._encode(cell)
+            self._cache_insert(cell, h)
+        return h
+
+    def _encode(self, cell):
+        if len(cell) == 2:
+            return hilbert_encode(cell, self.resolution)
+        return hilbert_encode_nd(cell, self.resolution)
+
+    def _cache_insert(self, cell, h):
+        """ Approximates LRU with two generations of at most cache_size/2 cells
+        each: hits in the old generation are promoted, and when the new one fills
+        up the old one is dropped.
+        """
+        if len(self._cache) >= max(self.cache_size//2, 1):
+            self._old_cache = self._cache
+            self._cache = {}
+        self._cache[cell] = h
+
+    def keys(self, xs, ys):
+        """ Returns the Hilbert keys of arrays of points as a list, computed in
+        one vectorized pass when numpy is available.
+        """
+        if np is None:
+            return [self.key(point) for point in zip(xs, ys)]
+        gx = np.floor((np.asarray(xs, dtype = np.float64) - self.origin[0])*self.scale[0])
+        gy = np.floor((np.asarray(ys, dtype = np.float64) - self.origin[1])*self.scale[1])
+        gx = np.clip(gx, 0, self._max_cell)
+        gy = np.clip(gy, 0, self._max_cell)
+        return hilbert_encode_batch(gx, gy, self.resolution).tolist()
+
+
+def hilbert_encode_batch(xs, ys, r):
+    """ Vectorized hilbert_encode over arrays of grid coordinates. Coordinates
+    are truncated to integers and masked to r <= 32 bits; returns a uint64 array.
+    """
+    assert np is not None, "hilbert_encode_batch requires numpy."
+    assert 0 < r <= 32
+    one = np.uint64(1)
+    mask = np.uint64((1 << r) - 1)
+    x = np.asarray(xs, dtype = np.int64).astype(np.uint64) & mask
+    y = np.asarray(ys, dtype = np.int64).astype(np.uint64) & mask
     heven = x ^ y
     notx = ~x & mask
     noty = ~y & mask
     temp = notx ^ y
-    v0 = 0
-    v1 = 0
+    v0 = np.zeros_like(x)
+    v1 = np.zeros_like(x)
     for k in xrange(1, r):
-        v1 = ((v1 & heven) | ((v0 ^ noty) & temp)) >> 1
-        v0 = ((v0 & (v1 ^ notx)) | (~v0 & (v1 ^ noty))) >> 1
+        v1 = ((v1 & heven) | ((v0 ^ noty) & temp)) >> one
+        v0 = ((v0 & (v1 ^ notx)) | (~v0 & (v1 ^ noty))) >> one
     hodd = (~v0 & (v1 ^ x)) | (v0 & (v1 ^ noty))
-    return interleave_bits(hodd, heven)
+    return (_spread_bits(hodd) << one) | _spread_bits(heven)
 
-def interleave_bits(odd, even):
-    """ Returns bit string from interleaving odd and even bit strings.
+
+def hilbert_decode_batch(h, r):
+    """ Inverse of hilbert_encode_batch: returns uint64 arrays (xs, ys) of the grid
+    points with Hilbert values h in a grid of resolution r.
     """
-    val = 0
-    max0 = max(odd, even)
-    n = 0
-    while (max0 > 0):
-        n += 1
-        max0 >>= 1
-    for i in xrange(n):
-        bitMask = 1 << i
-        a = (1 << (2*i)) if (even & bitMask) > 0  else 0
-        b = (1 << (2*i+1)) if (odd & bitMask) > 0 else 0
-        val += a + b
-    return val
+    assert np is not None, "hilbert_decode_batch requires numpy."
+    assert 0 < r <= 32
+    one = np.uint64(1)
+    t = np.array(h, dtype = np.uint64)
+    x = np.zeros_like(t)
+    y = np.zeros_like(t)
+    for i in xrange(r):
+        s = np.uint64(1 << i)
+        rx = one & (t >> one)
+        ry = one & (t ^ rx)
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, s - one - x, x)
+        y = np.where(flip, s - one - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        x += s*rx
+        y += s*ry
+        t >>= np.uint64(2)
+    return x, y
+
+
+def rect_bounds(rects):
+    """ Returns an (n, 4) float64 array of (left, right, bottom, top) rows, or
+    for N-d Boxes an (n, 2N) array of their bounds.
+    """
+    assert np is not None, "rect_bounds requires numpy."
+    rects = list(rects)
+    if rects and getattr(rects[0], 'dims', 2) != 2:
+        return np.array([rect.bounds for rect in rects], dtype = np.float64)
+    return np.array([(rect.left, rect.right, rect.bottom, rect.top) for rect in rects],
+                    dtype = np.float64).reshape(-1, 4)
+
+
+def point_bounds(points):
+    """ Returns an (n, 4) float64 array of degenerate (x, x, y, y) rows, or
+    (n, 2N) rows for N-d points.
+    """
+    assert np is not None, "point_bounds requires numpy."
+    points = np.asarray(points, dtype = np.float64)
+    if points.ndim != 2:
+        points = points.reshape(-1, 2)
+    return np.repeat(points, 2, axis = 1)
+
+
+def intersect_mask(bounds, queries, closed = False):
+    """ Returns an (m, n) boolean array telling which of m (left, right, bottom,
+    top) rows in bounds intersect which of n rows in queries; rows of N-d
+    bounds hold a (low, high) pair per axis. Open intersection matches
+    Rectangle.intersects_rect; closed intersection also matches touching
+    edges, as Rectangle.contains_point does for degenerate queries.
+    """
+    b = bounds[:, :, np.newaxis]
+    q = queries.T[np.newaxis, :, :]
+    mask = None
+    for lo in xrange(0, bounds.shape[1], 2):
+        if closed:
+            axis = (b[:, lo + 1] >= q[:, lo]) & (b[:, lo] <= q[:, lo + 1])
+        else:
+            axis = (b[:, lo + 1] > q[:, lo]) & (b[:, lo] < q[:, lo + 1])
+        mask = axis if mask is None else mask & axis
+    return mask
+
+
+def union_area(bounds):
+    """ Returns the area covered by the union of the (left, right, bottom, top)
+    rows in bounds, by testing each cell of the grid their edges induce.
+    """
+    if not len(bounds):
+        return 0.
+    xs = np.unique(bounds[:, :2])
+    ys = np.unique(bounds[:, 2:])
+    cx = (xs[:-1] + xs[1:])/2.
+    cy = (ys[:-1] + ys[1:])/2.
+    inx = (bounds[:, 0, np.newaxis] <= cx) & (bounds[:, 1, np.newaxis] >= cx)
+    iny = (bounds[:, 2, np.newaxis] <= cy) & (bounds[:, 3, np.newaxis] >= cy)
+    covered = (inx[:, :, np.newaxis] & iny[:, np.newaxis, :]).any(axis = 0)
+    return float((np.diff(xs)[:, np.newaxis]*np.diff(ys)[np.newaxis, :])[covered].sum())
+
+
+def capacity_kmeans(points, labels, min_size, max_size, iterations):
+    """ Refines an initial assignment of the (n, d) array of points to k =
+    labels.max() + 1 clusters by at most iterations rounds of k-means, keeping
+    every cluster between min_size >= 1 and max_size points, which requires
+    k*min_size <= n <= k*max_size. Returns the labels.
+
+    Each round computes all point-to-center distances at once, then assigns
+    points in order of how much they stand to lose by missing their nearest
+    center, each to the nearest center with room. Once the points left only
+    just cover the clusters still short of min_size, they go to those.
+    """
+    n = len(points)
+    k = int(labels.max()) + 1
+    if k < 2:
+        return labels
+    for i in xrange(iterations):
+        counts = np.bincount(labels, minlength = k).astype(np.float64)
+        centers = np.column_stack([np.bincount(labels, points[:, axis], k)
+                                   for axis in xrange(points.shape[1])])/counts[:, np.newaxis]
+        d = ((points[:, np.newaxis, :] - centers[np.newaxis, :, :])**2).sum(axis = 2)
+        prefs = np.argsort(d, axis = 1)
+        nearest = np.partition(d, 1, axis = 1)
+        order = np.argsort(nearest[:, 0] - nearest[:, 1], kind = 'mergesort')
+        sizes = [0]*k
+        deficit = k*min_size
+        new_labels = np.empty(n, dtype = labels.dtype)
+        remaining = n
+        prefs = prefs.tolist()
+        for point in order.tolist():
+            for label in prefs[point]:
+                if sizes[label] >= max_size:
+                    continue
+                if remaining <= deficit and sizes[label] >= min_size:
+                    continue
+                break
+            if sizes[label] < min_size:
+                deficit -= 1
+            sizes[label] += 1
+            remaining -= 1
+            new_labels[point] = label
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+    return labels
+
+
+_SPREAD_MASKS = [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), 
+                 (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), 
+                 (1, 0x5555555555555555)]
+
+
+def _spread_bits(v):
+    """ Spreads the low 32 bits of each uint64 in v onto the even bit positions.
+    """
+    v = v & np.uint64(0xFFFFFFFF)
+    for shift, mask in _SPREAD_MASKS:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v